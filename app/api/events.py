@@ -1,14 +1,18 @@
-from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, status, Query
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, status, Query, Request
+from fastapi.responses import JSONResponse, Response
+from starlette.background import BackgroundTask
+from pydantic import ValidationError
+import orjson
 
-from app.models import EventModel, EventProcessingResponse
+from app.models import EventModel, EventProcessingResponse, BatchProcessingResponse
+from app.dedup_codec import DEDUP_FIELDS
 from app.services.kafka_service import KafkaService
 from app.deduplicator import Deduplicator
 from app.services.redis_service import RedisService
 from app.services.postgres_service import PostgresService
 from loguru import logger
 import time
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Union
 import random
 from datetime import datetime
 
@@ -17,8 +21,23 @@ router = APIRouter()
 kafka_service = None
 redis_service = None
 postgres_service = None
+bloom_filter = None
+hot_cache = None
+single_flight = None
+dedup_batcher = None
+deduplicator = None
+batch_writer = None
+batch_max_events = 1000
+batch_max_bytes = 4 * 1024 * 1024
+# api - уникальные события сохраняет в PostgreSQL сам API, consumer - только консьюмер пакетами
+write_path_mode = "api"
 
-def get_kafka_service():
+# Заранее закодированные части ответов /event и /event/raw
+_RAW_ACCEPTED_PREFIX = b'{"status":"accepted","is_duplicate":false,"message":"Event accepted for processing and storage","event_hash":"'
+_RAW_DUPLICATE_PREFIX = b'{"status":"rejected","is_duplicate":true,"message":"Event is a duplicate","event_hash":"'
+_RAW_RESPONSE_SUFFIX = b'"}'
+
+async def get_kafka_service():
     global kafka_service
     if kafka_service is None:
         raise HTTPException(
@@ -27,7 +46,7 @@ def get_kafka_service():
         )
     return kafka_service
 
-def get_redis_service():
+async def get_redis_service():
     global redis_service
     if redis_service is None:
         raise HTTPException(
@@ -36,7 +55,7 @@ def get_redis_service():
         )
     return redis_service
 
-def get_postgres_service():
+async def get_postgres_service():
     global postgres_service
     if postgres_service is None:
         raise HTTPException(
@@ -45,16 +64,66 @@ def get_postgres_service():
         )
     return postgres_service
 
-def get_deduplicator(redis=Depends(get_redis_service)):
+async def get_deduplicator():
+    if dedup_batcher is not None:
+        # Проверки одновременных запросов уходят в Redis общими пакетами
+        return dedup_batcher
+    if deduplicator is not None:
+        return deduplicator
+    return create_deduplicator(await get_redis_service())
+
+def create_deduplicator(redis: RedisService) -> Deduplicator:
     if hasattr(redis, 'redis_pool') and redis.redis_pool:
-        return Deduplicator(redis.redis, redis_pool=redis.redis_pool, shard_count=redis.shard_count)
+        return Deduplicator(redis.redis, redis_pool=redis.redis_pool, shard_count=redis.shard_count,
+                            bloom_filter=bloom_filter, codec=redis.codec, storage=redis.storage,
+                            router=redis.router, hot_cache=hot_cache, single_flight=single_flight)
     else:
-        return Deduplicator(redis.redis)
+        return Deduplicator(redis.redis, bloom_filter=bloom_filter, codec=redis.codec, storage=redis.storage,
+                            hot_cache=hot_cache, single_flight=single_flight)
+
+async def _publish_unique_event(kafka: KafkaService, postgres: PostgresService, message: Union[Dict[str, Any], bytes],
+                                event: Dict[str, Any], event_hash: str) -> None:
+    """Режим api: отправляет уникальное событие в Kafka и сохраняет в PostgreSQL (одна фоновая задача на запрос)."""
+    await kafka.send_message("product-events", message, key=event_hash)
+    await postgres.save_event(event, event_hash)
+
+async def _store_unique_events(kafka: KafkaService, postgres: PostgresService, deduplicator: Deduplicator,
+                               messages: List[Union[Dict[str, Any], bytes]], events: List[Dict[str, Any]],
+                               event_hashes: List[str]) -> bool:
+    """Режим consumer: публикует уникальные события в Kafka с ожиданием подтверждения брокера.
+
+    Ключ дедупликации уже записан, поэтому потерянная отправка означала бы потерю
+    события: повтор клиента был бы признан дубликатом. Если Kafka не подтвердила
+    отправку, события сохраняются в PostgreSQL напрямую; если не удалось и это,
+    записи дедупликации снимаются и возвращается False, чтобы клиент повторил запрос.
+
+    messages уходят в Kafka со служебным _dedup_hash, events - те же события без него:
+    в PostgreSQL они попадают в том же виде, что и через консьюмер, который это поле снимает.
+    Снятая запись остается в локальных кэшах дубликатов других воркеров (см. Deduplicator.forget).
+    """
+    if await kafka.send_batch("product-events", messages, event_hashes, confirm=True):
+        return True
+    logger.warning(f"Kafka did not confirm {len(messages)} events, saving them to PostgreSQL directly")
+    if await postgres.save_events_batch(events, event_hashes):
+        return True
+    logger.error(f"Failed to store {len(messages)} unique events, releasing their dedup records")
+    try:
+        await deduplicator.forget(events, event_hashes)
+    except Exception as e:
+        logger.error(f"Failed to release dedup records: {str(e)}")
+    return False
+
+def _store_failed_response(event_hash: str) -> Response:
+    return Response(
+        orjson.dumps({"status": "error", "is_duplicate": False,
+                      "message": "Event could not be stored, retry the request", "event_hash": event_hash}),
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        media_type="application/json"
+    )
 
 @router.post("/event", response_model=EventProcessingResponse)
 async def process_event(
     event: EventModel,
-    background_tasks: BackgroundTasks,
     kafka: KafkaService = Depends(get_kafka_service),
     deduplicator: Deduplicator = Depends(get_deduplicator),
     postgres: PostgresService = Depends(get_postgres_service)
@@ -62,43 +131,41 @@ async def process_event(
     start_time = time.time()
     
     try:
-        event_dict = {
-            'client_id': event.client_id,
-            'event_datetime': event.event_datetime,
-            'event_name': event.event_name,
-            'product_id': event.product_id,
-            'sid': event.sid,
-            'r': event.r
-        }
-        
+        # Поля модели лежат в ее __dict__: хешу и хранилищу нужен только event.get по полям дедупликации
+        event_dict = vars(event)
         event_hash = deduplicator.calculate_hash(event_dict)
-        dedup_result = await deduplicator.is_duplicate(event_dict)
+        dedup_result = await deduplicator.is_duplicate(event_dict, event_hash)
         
-        response = EventProcessingResponse(
-            status="rejected" if dedup_result.is_duplicate else "accepted",
-            is_duplicate=dedup_result.is_duplicate,
-            message="Event is a duplicate" if dedup_result.is_duplicate else "Event accepted for processing and storage",
-            event_hash=dedup_result.event_hash
-        )
-        
-        if not dedup_result.is_duplicate:
-            if hasattr(event, 'model_dump'):
-                full_event_dict = event.model_dump(exclude_unset=True)
+        if dedup_result.is_duplicate:
+            response = Response(_RAW_DUPLICATE_PREFIX + event_hash.encode() + _RAW_RESPONSE_SUFFIX,
+                                media_type="application/json")
+        elif write_path_mode == "consumer":
+            full_event_dict = event.model_dump(exclude_unset=True)
+            message = {**full_event_dict, '_dedup_hash': event_hash}
+            
+            if await _store_unique_events(kafka, postgres, deduplicator, [message], [full_event_dict],
+                                          [event_hash]):
+                response = Response(_RAW_ACCEPTED_PREFIX + event_hash.encode() + _RAW_RESPONSE_SUFFIX,
+                                    media_type="application/json")
             else:
-                full_event_dict = event.dict(exclude_unset=True)
-                
-            full_event_dict['_dedup_hash'] = dedup_result.event_hash
-                
-            background_tasks.add_task(kafka.send_message, "product-events", full_event_dict)
-            background_tasks.add_task(postgres.save_event, full_event_dict, dedup_result.event_hash)
-        
-        processing_time = (time.time() - start_time) * 1000
+                return _store_failed_response(event_hash)
+        else:
+            full_event_dict = event.model_dump(exclude_unset=True)
+            message = {**full_event_dict, '_dedup_hash': event_hash}
+            
+            response = Response(
+                _RAW_ACCEPTED_PREFIX + event_hash.encode() + _RAW_RESPONSE_SUFFIX,
+                media_type="application/json",
+                background=BackgroundTask(_publish_unique_event, kafka, postgres, message,
+                                          full_event_dict, event_hash)
+            )
         
         if random.random() < 0.01:
+            processing_time = (time.time() - start_time) * 1000
             if dedup_result.is_duplicate:
-                logger.info(f"Duplicate event rejected in {processing_time:.2f}ms, hash: {dedup_result.event_hash}")
+                logger.info(f"Duplicate event rejected in {processing_time:.2f}ms, hash: {event_hash}")
             else:
-                logger.info(f"Event processed and sent to Kafka in {processing_time:.2f}ms, hash: {dedup_result.event_hash}")
+                logger.info(f"Event processed and sent to Kafka in {processing_time:.2f}ms, hash: {event_hash}")
             
         return response
     
@@ -112,6 +179,213 @@ async def process_event(
             event_hash=None
         )
 
+@router.post("/event/raw", response_model=EventProcessingResponse)
+async def process_raw_event(request: Request):
+    """Быстрый прием события без построения EventModel.
+
+    Тело разбирается orjson, проверяется только наличие строковых полей
+    дедупликации. В Kafka уходят исходные байты запроса без повторной
+    сериализации, ответ собирается из заранее закодированных частей.
+    Остальные поля события не валидируются и сохраняются как пришли.
+    Сервисы берутся без Depends: разбор зависимостей FastAPI на этом
+    маршруте заметно дороже самой обработки.
+    """
+    kafka = await get_kafka_service()
+    postgres = await get_postgres_service()
+    deduplicator = await get_deduplicator()
+    body = await request.body()
+    try:
+        event = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return Response(b'{"detail":"Invalid JSON"}', status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        media_type="application/json")
+    if not isinstance(event, dict) or not all(isinstance(event.get(field), str) for field in DEDUP_FIELDS):
+        return Response(
+            orjson.dumps({"detail": f"Event must be an object with string fields: {', '.join(DEDUP_FIELDS)}"}),
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            media_type="application/json"
+        )
+    
+    try:
+        dedup_result = await deduplicator.is_duplicate(event)
+    except Exception as e:
+        logger.error(f"Error processing event: {str(e)}")
+        return Response(
+            orjson.dumps({"status": "error", "is_duplicate": False,
+                          "message": f"Error processing event: {str(e)}", "event_hash": None}),
+            media_type="application/json"
+        )
+    
+    event_hash = dedup_result.event_hash
+    if dedup_result.is_duplicate:
+        return Response(_RAW_DUPLICATE_PREFIX + event_hash.encode() + _RAW_RESPONSE_SUFFIX,
+                        media_type="application/json")
+    
+    # Хеш дописывается в исходные байты объекта: консьюмер получает его без повторной сериализации
+    message = body.rstrip()[:-1] + b',"_dedup_hash":"' + event_hash.encode() + b'"}'
+    if write_path_mode == "consumer":
+        if not await _store_unique_events(kafka, postgres, deduplicator, [message], [event], [event_hash]):
+            return _store_failed_response(event_hash)
+        return Response(_RAW_ACCEPTED_PREFIX + event_hash.encode() + _RAW_RESPONSE_SUFFIX,
+                        media_type="application/json")
+    return Response(_RAW_ACCEPTED_PREFIX + event_hash.encode() + _RAW_RESPONSE_SUFFIX,
+                    media_type="application/json",
+                    background=BackgroundTask(_publish_unique_event, kafka, postgres, message, event, event_hash))
+
+def _too_many_events() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Batch exceeds {batch_max_events} events"
+    )
+
+def _too_large_body() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Batch exceeds {batch_max_bytes} bytes"
+    )
+
+async def _limited_stream(request: Request):
+    """Тело запроса по частям; больше batch_max_bytes - 413 до чтения остатка."""
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > batch_max_bytes:
+        raise _too_large_body()
+    received = 0
+    async for chunk in request.stream():
+        # Content-Length может отсутствовать (chunked) или не совпадать с телом
+        received += len(chunk)
+        if received > batch_max_bytes:
+            raise _too_large_body()
+        yield chunk
+
+async def _read_event_batch(request: Request) -> List[Any]:
+    """Читает тело пакетного запроса: JSON-массив или NDJSON (по событию в строке).
+
+    Тело читается потоком и не может превысить batch_max_bytes, поэтому
+    большой пакет отклоняется до разбора. В NDJSON превышение числа событий
+    тоже обнаруживается до получения всего тела. Нераспознанная строка NDJSON
+    становится None и помечается как невалидное событие, не ломая остальной пакет.
+    """
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        items = []
+        tail = b""
+        async for chunk in _limited_stream(request):
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                if not line.strip():
+                    continue
+                if len(items) >= batch_max_events:
+                    raise _too_many_events()
+                try:
+                    items.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    items.append(None)
+        if tail.strip():
+            if len(items) >= batch_max_events:
+                raise _too_many_events()
+            try:
+                items.append(orjson.loads(tail))
+            except orjson.JSONDecodeError:
+                items.append(None)
+        return items
+    
+    body = b"".join([chunk async for chunk in _limited_stream(request)])
+    try:
+        items = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid JSON: {str(e)}")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Expected a JSON array of events")
+    if len(items) > batch_max_events:
+        raise _too_many_events()
+    return items
+
+@router.post("/events/batch", response_model=BatchProcessingResponse)
+async def process_event_batch(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    kafka: KafkaService = Depends(get_kafka_service),
+    deduplicator: Deduplicator = Depends(get_deduplicator),
+    postgres: PostgresService = Depends(get_postgres_service)
+):
+    """Пакетный прием событий.
+
+    Все валидные события проверяются одним вызовом is_duplicate_many (один
+    pipeline на шард Redis), уникальные уходят в Kafka одним пакетом продюсера.
+    В ответе statuses содержит по символу на событие в порядке запроса:
+    A - принято, D - дубликат, I - невалидно.
+    """
+    start_time = time.time()
+    items = await _read_event_batch(request)
+    
+    statuses = ["I"] * len(items)
+    hashes: List[Any] = [None] * len(items)
+    positions = []
+    models = []
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        try:
+            models.append(EventModel.model_validate(item))
+            positions.append(position)
+        except ValidationError:
+            continue
+    
+    if models:
+        try:
+            results = await deduplicator.is_duplicate_many([vars(event) for event in models])
+        except Exception as e:
+            logger.error(f"Error processing event batch: {str(e)}")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"Error processing event batch: {str(e)}"
+            )
+        
+        unique_messages = []
+        unique_events = []
+        unique_hashes = []
+        for position, event, dedup_result in zip(positions, models, results):
+            hashes[position] = dedup_result.event_hash
+            if dedup_result.is_duplicate:
+                statuses[position] = "D"
+                continue
+            statuses[position] = "A"
+            full_event_dict = event.model_dump(exclude_unset=True)
+            unique_messages.append({**full_event_dict, '_dedup_hash': dedup_result.event_hash})
+            unique_events.append(full_event_dict)
+            unique_hashes.append(dedup_result.event_hash)
+        
+        if unique_events and write_path_mode == "consumer":
+            if not await _store_unique_events(kafka, postgres, deduplicator, unique_messages, unique_events,
+                                              unique_hashes):
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Accepted events could not be stored, retry the request"
+                )
+        elif unique_events:
+            background_tasks.add_task(kafka.send_batch, "product-events", unique_messages, unique_hashes)
+            background_tasks.add_task(postgres.save_events_batch, unique_events, unique_hashes)
+    
+    accepted = statuses.count("A")
+    duplicates = statuses.count("D")
+    invalid = len(statuses) - accepted - duplicates
+    
+    if random.random() < 0.01:
+        processing_time = (time.time() - start_time) * 1000
+        logger.info(
+            f"Batch of {len(items)} events processed in {processing_time:.2f}ms: "
+            f"{accepted} accepted, {duplicates} duplicates, {invalid} invalid"
+        )
+    
+    return BatchProcessingResponse(
+        statuses="".join(statuses),
+        hashes=hashes,
+        accepted=accepted,
+        duplicates=duplicates,
+        invalid=invalid
+    )
+
 @router.get("/health")
 async def health_check(
     redis=Depends(get_redis_service),
@@ -242,18 +516,31 @@ async def get_stats(
     try:
         redis_info = {}
         if redis.redis:
-            prefix = "event_dedup:"
             keys_count = 0
             
-            for i in range(redis.shard_count if redis.shard_count else 1):
-                client = redis.redis_pool[i] if redis.redis_pool else redis.redis
-                # Получаем количество ключей с префиксом "event_dedup:"
-                keys = await client.keys(f"{prefix}*")
-                keys_count += len(keys)
+            if redis.cluster_mode:
+                # KEYS в кластере выполняется на одном узле, SCAN обходит все мастера
+                for pattern in redis.storage.key_patterns():
+                    async for _ in redis.redis.scan_iter(match=pattern, count=1000):
+                        keys_count += 1
+            else:
+                for i in range(redis.shard_count if redis.shard_count else 1):
+                    client = redis.redis_pool[i] if redis.redis_pool else redis.redis
+                    # Получаем количество ключей дедупликации во всех используемых форматах
+                    for pattern in redis.storage.key_patterns():
+                        keys = await client.keys(pattern)
+                        keys_count += len(keys)
             
             redis_info = {
                 "dedup_keys_count": keys_count,
                 "shard_count": redis.shard_count if redis.shard_count else 1,
+                "storage": redis.storage.name,
+                "key_encoding": redis.codec.encoding,
+                "hash_version": redis.codec.hash_version,
+                "shard_router": "cluster" if redis.cluster_mode else redis.router.name,
+                "reshard": redis.migrator.stats() if redis.migrator is not None else None,
+                "pools": redis.pool_stats(),
+                "legacy_read": redis.codec.legacy_read,
             }
         
         pg_stats = {}
@@ -272,12 +559,21 @@ async def get_stats(
         pg_stats = {
             "total_events": total_events,
             "shard_count": postgres.shard_count,
-            "shards": shard_stats
+            "shards": shard_stats,
+            "copy": postgres.copy_stats()
         }
         
         return {
             "service": "kion-deduplicator",
             "redis": redis_info,
+            "bloom_filter": bloom_filter.stats() if bloom_filter is not None else {"enabled": False},
+            "hot_cache": hot_cache.stats() if hot_cache is not None else {"enabled": False},
+            "single_flight": single_flight.stats() if single_flight is not None else {"enabled": False},
+            "micro_batching": dedup_batcher.stats() if dedup_batcher is not None else {"enabled": False},
+            "write_path_mode": write_path_mode,
+            "kafka_producer": kafka_service.producer_stats() if kafka_service is not None else {"enabled": False},
+            "kafka_consumer": kafka_service.consumer_stats() if kafka_service is not None else {"enabled": False},
+            "postgres_writer": batch_writer.stats() if batch_writer is not None else {"enabled": False},
             "postgres": pg_stats,
             "timestamp": datetime.utcnow().isoformat()
         }
@@ -18,13 +18,13 @@ templates_dir = Path(__file__).parent.parent / "templates"
 templates = Jinja2Templates(directory=str(templates_dir))
 templates_dir.mkdir(exist_ok=True)
 
-def get_postgres_service():
+async def get_postgres_service():
     from app.api.events import get_postgres_service as get_pg
-    return get_pg()
+    return await get_pg()
 
-def get_redis_service():
+async def get_redis_service():
     from app.api.events import get_redis_service as get_redis
-    return get_redis()
+    return await get_redis()
 
 @router.get("/database", response_class=HTMLResponse)
 async def database_ui(
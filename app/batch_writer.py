@@ -0,0 +1,309 @@
+import asyncio
+import time
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from loguru import logger
+
+from app.dead_letter import DeadLetterSink
+from app.services.postgres_service import BatchRejectedError
+
+
+def estimate_event_bytes(event: Dict[str, Any]) -> int:
+    """Приблизительный размер события в JSON без сериализации."""
+    size = 2
+    for key, value in event.items():
+        size += len(key) + (len(value) if isinstance(value, str) else 16) + 6
+    return size
+
+
+class _ShardBuffer:
+    __slots__ = ("events", "hashes", "bytes", "started_at")
+
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.hashes: List[str] = []
+        self.bytes = 0
+        self.started_at = 0.0
+
+
+class _ShardTuning:
+    __slots__ = ("size", "linger", "latency", "throughput", "increases", "decreases")
+
+    def __init__(self, size: float, linger: float):
+        self.size = size
+        self.linger = linger
+        self.latency: Optional[float] = None
+        self.throughput: Optional[float] = None
+        self.increases = 0
+        self.decreases = 0
+
+
+class AdaptiveBatchController:
+    """Подбирает размер пакета и время ожидания для каждого шарда по принципу AIMD.
+
+    После каждой записи пакета:
+    - запись дольше target_latency - размер уменьшается в decrease раз;
+    - буфер заполнился раньше срока или записи копятся в очереди шарда - размер
+      растет на size_step, время ожидания на linger_step, пока пропускная
+      способность записи (строк в секунду) не падает;
+    - буфер сброшен по возрасту заполненным меньше чем на четверть (нагрузки
+      почти нет) - размер и время ожидания уменьшаются в decrease раз, чтобы
+      одиночные события не ждали записи.
+    """
+
+    def __init__(self, initial_size: int = 250, min_size: int = 10, max_size: int = 5000,
+                 initial_linger: float = 1.0, min_linger: float = 0.05, max_linger: float = 1.0,
+                 target_latency: float = 0.1, decrease: float = 0.5, smoothing: float = 0.2):
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.initial_size = min(max(initial_size, self.min_size), self.max_size)
+        self.min_linger = min_linger
+        self.max_linger = max(min_linger, max_linger)
+        self.initial_linger = min(max(initial_linger, self.min_linger), self.max_linger)
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.smoothing = smoothing
+        self.size_step = max(1, self.initial_size // 10)
+        self.linger_step = (self.max_linger - self.min_linger) / 10
+        self._shards: Dict[int, _ShardTuning] = {}
+
+    def _tuning(self, shard: int) -> _ShardTuning:
+        tuning = self._shards.get(shard)
+        if tuning is None:
+            tuning = self._shards[shard] = _ShardTuning(self.initial_size, self.initial_linger)
+        return tuning
+
+    def batch_size(self, shard: int) -> int:
+        return int(self._tuning(shard).size)
+
+    def linger(self, shard: int) -> float:
+        return self._tuning(shard).linger
+
+    def observe(self, shard: int, rows: int, latency: float, reason: str, backlog: bool) -> None:
+        """Учитывает запись пакета из rows строк за latency секунд.
+
+        reason - причина сброса буфера, backlog - есть ли в очереди шарда пакеты,
+        ждущие свободного слота записи.
+        """
+        tuning = self._tuning(shard)
+        throughput = rows / latency if latency > 0 else 0.0
+        previous_throughput = tuning.throughput
+
+        if tuning.latency is None:
+            tuning.latency, tuning.throughput = latency, throughput
+        else:
+            tuning.latency += self.smoothing * (latency - tuning.latency)
+            tuning.throughput += self.smoothing * (throughput - tuning.throughput)
+
+        if latency > self.target_latency:
+            tuning.size = max(self.min_size, tuning.size * self.decrease)
+            tuning.decreases += 1
+        elif reason in ("size", "bytes") or backlog:
+            if previous_throughput is None or throughput >= 0.9 * previous_throughput:
+                tuning.size = min(self.max_size, tuning.size + self.size_step)
+                tuning.linger = min(self.max_linger, tuning.linger + self.linger_step)
+                tuning.increases += 1
+        elif reason == "age" and rows < tuning.size / 4:
+            tuning.size = max(self.min_size, tuning.size * self.decrease)
+            tuning.linger = max(self.min_linger, tuning.linger * self.decrease)
+            tuning.decreases += 1
+
+    def stats(self) -> Dict[int, Dict[str, Any]]:
+        return {
+            shard: {
+                "batch_size": int(tuning.size),
+                "linger_ms": round(tuning.linger * 1000, 1),
+                "avg_latency_ms": round(tuning.latency * 1000, 2) if tuning.latency is not None else None,
+                "avg_rows_per_second": round(tuning.throughput, 1) if tuning.throughput is not None else None,
+                "increases": tuning.increases,
+                "decreases": tuning.decreases,
+            }
+            for shard, tuning in self._shards.items()
+        }
+
+
+class BatchWriter:
+    """Пакетная запись уникальных событий в PostgreSQL с двойной буферизацией.
+
+    У каждого шарда PostgreSQL свой активный буфер. add() только дописывает в него
+    событие и никогда не ждет базу: буфер, набравший max_batch_size событий,
+    max_batch_bytes байт или старше max_batch_age секунд, за O(1) заменяется
+    пустым, а запись заполненного выполняет фоновая задача. Одновременно на шард
+    пишется не больше max_flushes_per_shard пакетов; если записи ждут больше
+    max_pending_batches пакетов одного шарда, saturated становится True и
+    источник событий может подождать wait_for_capacity().
+
+    Пакет, отклоненный PostgreSQL из-за данных, делится пополам, пока не
+    останутся отдельные плохие строки: они уходят в dead_letter, остальные
+    записываются пакетами. Пакет, не записанный из-за недоступности базы,
+    целиком уходит в dead_letter.
+
+    С controller размер пакета и время ожидания для каждого шарда берутся из
+    AdaptiveBatchController, а max_batch_size и max_batch_age не используются.
+    """
+
+    def __init__(self, postgres, max_batch_size: int = 250, max_batch_age: float = 1.0,
+                 max_batch_bytes: int = 1024 * 1024, max_flushes_per_shard: int = 2,
+                 max_pending_batches: int = 16, controller: Optional[AdaptiveBatchController] = None,
+                 dead_letter: Optional[DeadLetterSink] = None):
+        self.postgres = postgres
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_batch_age = max_batch_age
+        self.max_batch_bytes = max_batch_bytes
+        self.max_flushes_per_shard = max(1, max_flushes_per_shard)
+        self.max_pending_batches = max(1, max_pending_batches)
+        self.controller = controller
+        self.dead_letter = dead_letter if dead_letter is not None else DeadLetterSink()
+
+        self._buffers: Dict[int, _ShardBuffer] = {}
+        self._semaphores: Dict[int, asyncio.Semaphore] = {}
+        self._pending: Dict[int, int] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._capacity = asyncio.Event()
+        self._capacity.set()
+        self._age_task: Optional[asyncio.Task] = None
+
+        self.batches = 0
+        self.saved = 0
+        self.failed = 0
+        self.rejected = 0
+        self.bisections = 0
+        self.flush_reasons = {"size": 0, "bytes": 0, "age": 0, "close": 0}
+
+    def start(self) -> None:
+        self._age_task = asyncio.create_task(self._flush_aged())
+
+    def add(self, event: Dict[str, Any], event_hash: str) -> None:
+        """Добавляет событие в буфер его шарда."""
+        shard = self.postgres.router.shard(event_hash)
+        buffer = self._buffers.get(shard)
+        if buffer is None:
+            buffer = self._buffers[shard] = _ShardBuffer()
+        if not buffer.events:
+            buffer.started_at = time.monotonic()
+
+        buffer.events.append(event)
+        buffer.hashes.append(event_hash)
+        buffer.bytes += estimate_event_bytes(event)
+
+        max_size = self.controller.batch_size(shard) if self.controller is not None else self.max_batch_size
+        if len(buffer.events) >= max_size:
+            self._swap(shard, "size")
+        elif buffer.bytes >= self.max_batch_bytes:
+            self._swap(shard, "bytes")
+
+    @property
+    def saturated(self) -> bool:
+        return not self._capacity.is_set()
+
+    async def wait_for_capacity(self) -> None:
+        await self._capacity.wait()
+
+    def _swap(self, shard: int, reason: str) -> None:
+        buffer = self._buffers.get(shard)
+        if buffer is None or not buffer.events:
+            return
+        self._buffers[shard] = _ShardBuffer()
+        self.flush_reasons[reason] += 1
+
+        self._pending[shard] = self._pending.get(shard, 0) + 1
+        if self._pending[shard] > self.max_pending_batches:
+            self._capacity.clear()
+
+        task = asyncio.create_task(self._write(shard, buffer, reason))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, shard: int, buffer: _ShardBuffer, reason: str) -> None:
+        semaphore = self._semaphores.get(shard)
+        if semaphore is None:
+            semaphore = self._semaphores[shard] = asyncio.Semaphore(self.max_flushes_per_shard)
+        try:
+            async with semaphore:
+                started = time.perf_counter()
+                await self._save(buffer.events, buffer.hashes)
+                if self.controller is not None:
+                    backlog = self._pending[shard] > self.max_flushes_per_shard
+                    self.controller.observe(shard, len(buffer.events), time.perf_counter() - started,
+                                            reason, backlog)
+        finally:
+            self._pending[shard] -= 1
+            if all(count <= self.max_pending_batches for count in self._pending.values()):
+                self._capacity.set()
+
+    async def _save(self, events: List[Dict[str, Any]], event_hashes: List[str]) -> None:
+        self.batches += 1
+        dead: List[Tuple[Dict[str, Any], str, str]] = []
+        await self._save_isolating(events, event_hashes, dead)
+        if dead:
+            self.failed += len(dead)
+            await self.dead_letter.publish(dead)
+
+    async def _save_isolating(self, events: List[Dict[str, Any]], event_hashes: List[str],
+                              dead: List[Tuple[Dict[str, Any], str, str]]) -> None:
+        try:
+            success = await self.postgres.save_events_batch(events, event_hashes, raise_rejected=True)
+        except BatchRejectedError as e:
+            if len(events) == 1:
+                self.rejected += 1
+                dead.append((events[0], event_hashes[0], str(e)))
+                return
+            self.bisections += 1
+            middle = len(events) // 2
+            await self._save_isolating(events[:middle], event_hashes[:middle], dead)
+            await self._save_isolating(events[middle:], event_hashes[middle:], dead)
+            return
+        except Exception as e:
+            logger.error(f"Error batch saving events: {str(e)}")
+            success = False
+
+        if success:
+            self.saved += len(events)
+            logger.debug(f"Batch saved {len(events)} events to PostgreSQL")
+            return
+
+        logger.error(f"Batch of {len(events)} events was not saved to PostgreSQL")
+        dead.extend((event, event_hash, "batch write failed") for event, event_hash in zip(events, event_hashes))
+
+    async def _flush_aged(self) -> None:
+        controller = self.controller
+        interval = (controller.min_linger if controller is not None else self.max_batch_age) / 4
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for shard, buffer in list(self._buffers.items()):
+                max_age = controller.linger(shard) if controller is not None else self.max_batch_age
+                if buffer.events and now - buffer.started_at >= max_age:
+                    self._swap(shard, "age")
+
+    async def close(self) -> None:
+        """Записывает все накопленные события и дожидается завершения записей."""
+        if self._age_task is not None:
+            self._age_task.cancel()
+            await asyncio.gather(self._age_task, return_exceptions=True)
+            self._age_task = None
+        for shard in list(self._buffers):
+            self._swap(shard, "close")
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def buffered(self) -> int:
+        return sum(len(buffer.events) for buffer in self._buffers.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_batch_age": self.max_batch_age,
+            "max_batch_bytes": self.max_batch_bytes,
+            "buffered": self.buffered(),
+            "pending_batches": {shard: count for shard, count in self._pending.items() if count},
+            "saturated": self.saturated,
+            "batches": self.batches,
+            "saved": self.saved,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "bisections": self.bisections,
+            "dead_letter": self.dead_letter.stats(),
+            "flush_reasons": dict(self.flush_reasons),
+            "adaptive": self.controller.stats() if self.controller is not None else {"enabled": False},
+        }
@@ -0,0 +1,105 @@
+import asyncio
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from app.models import DedupResult
+
+
+class DedupBatcher:
+    """Прозрачная пакетная обработка одновременных проверок дедупликации.
+
+    Проверки из всех запросов воркера копятся не дольше max_delay секунд или до
+    max_batch_size событий и уходят в Redis одним вызовом is_duplicate_many
+    (один pipeline на шард). Каждый вызывающий по-прежнему ждет только свой
+    результат. max_delay=0 собирает проверки, пришедшие за одну итерацию цикла событий.
+    """
+
+    def __init__(self, deduplicator, max_batch_size: int = 256, max_delay: float = 0.001):
+        self.deduplicator = deduplicator
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_delay = max_delay
+        self._pending: List[Tuple[Dict[str, Any], str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.Handle] = None
+        # Сильные ссылки на задачи пакетов: цикл событий хранит только слабые
+        self._tasks: Set[asyncio.Task] = set()
+
+        self.batches = 0
+        self.events = 0
+        self.max_batch = 0
+
+    def calculate_hash(self, event: Dict[str, Any]) -> str:
+        return self.deduplicator.calculate_hash(event)
+
+    async def is_duplicate(self, event: Dict[str, Any], event_hash: Optional[str] = None) -> DedupResult:
+        if event_hash is None:
+            event_hash = self.deduplicator.calculate_hash(event)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((event, event_hash, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            if self.max_delay > 0:
+                self._timer = loop.call_later(self.max_delay, self._flush)
+            else:
+                self._timer = loop.call_soon(self._flush)
+        return await future
+
+    async def is_duplicate_many(self, events: List[Dict[str, Any]],
+                                event_hashes: Optional[List[str]] = None) -> List[DedupResult]:
+        return await self.deduplicator.is_duplicate_many(events, event_hashes)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        self.batches += 1
+        self.events += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Dict[str, Any], str, asyncio.Future]]) -> None:
+        try:
+            results = await self.deduplicator.is_duplicate_many(
+                [event for event, _, _ in batch],
+                [event_hash for _, event_hash, _ in batch]
+            )
+        except BaseException as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        for (_, _, future), result in zip(batch, results):
+            # Запрос мог быть отменен клиентом, пока пакет был в Redis
+            if not future.done():
+                future.set_result(result)
+
+    async def forget(self, events: List[Dict[str, Any]], event_hashes: List[str]) -> None:
+        await self.deduplicator.forget(events, event_hashes)
+
+    async def close(self) -> None:
+        """Отправляет накопленные проверки и дожидается всех пакетов."""
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_delay_ms": self.max_delay * 1000,
+            "batches": self.batches,
+            "events": self.events,
+            "avg_batch_size": self.events / self.batches if self.batches else 0.0,
+            "max_batch": self.max_batch,
+            "pending": len(self._pending),
+            "in_flight": len(self._tasks),
+        }
@@ -0,0 +1,268 @@
+import ctypes
+import ctypes.util
+import fcntl
+import math
+import mmap
+import os
+import struct
+import time
+from typing import Dict, Any, List, Tuple, Optional
+
+
+def _load_atomic_fetch_or():
+    """Ищет в libatomic функцию атомарного OR для одного байта."""
+    library_path = ctypes.util.find_library("atomic")
+    if not library_path:
+        return None
+    try:
+        fetch_or = getattr(ctypes.CDLL(library_path), "__atomic_fetch_or_1")
+    except (OSError, AttributeError):
+        return None
+    fetch_or.argtypes = (ctypes.c_void_p, ctypes.c_uint8, ctypes.c_int)
+    fetch_or.restype = ctypes.c_uint8
+    return fetch_or
+
+
+_atomic_fetch_or = _load_atomic_fetch_or()
+_ATOMIC_RELAXED = 0
+
+
+def bloom_parameters(expected_items: int, fp_rate: float) -> Tuple[int, int]:
+    """Рассчитывает размер битового массива и число хеш-функций для фильтра Блума."""
+    expected_items = max(1, expected_items)
+    fp_rate = min(max(fp_rate, 1e-9), 0.5)
+
+    size_bits = int(math.ceil(-expected_items * math.log(fp_rate) / (math.log(2) ** 2)))
+    hash_count = max(1, int(round(size_bits / expected_items * math.log(2))))
+    return size_bits, hash_count
+
+
+def bloom_positions(event_hash: str, size_bits: int, hash_count: int) -> List[int]:
+    """Позиции битов для хеша события.
+
+    Хеш события уже равномерно распределен: берем из него два 64-битных числа
+    и получаем k позиций двойным хешированием (Kirsch-Mitzenmacher).
+    """
+    h1 = int(event_hash[:16], 16)
+    h2 = int(event_hash[16:32], 16) | 1
+    return [(h1 + i * h2) % size_bits for i in range(hash_count)]
+
+
+class BloomFilter:
+    """Фильтр Блума поверх компактного битового массива."""
+
+    def __init__(self, size_bits: int, hash_count: int, bits=None):
+        self.size_bits = size_bits
+        self.hash_count = hash_count
+        self.bits = bits if bits is not None else bytearray((size_bits + 7) // 8)
+
+    def _positions(self, event_hash: str) -> List[int]:
+        return bloom_positions(event_hash, self.size_bits, self.hash_count)
+
+    def add(self, event_hash: str) -> None:
+        bits = self.bits
+        for position in self._positions(event_hash):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, event_hash: str) -> bool:
+        bits = self.bits
+        for position in self._positions(event_hash):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def clear(self) -> None:
+        self.bits[:] = bytes(len(self.bits))
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self.bits)
+
+
+class RotatingBloomFilter:
+    """Фильтр Блума с ротацией поколений по времени.
+
+    Держит два поколения: текущее и предыдущее. Поколение определяется номером
+    окна времени, поэтому хеш остается в фильтре не меньше window_seconds.
+    Промах в фильтре доказывает, что событие этим фильтром не встречалось.
+    """
+
+    generation_count = 2
+
+    def __init__(self, expected_items: int, fp_rate: float = 0.01, window_seconds: int = 7 * 24 * 60 * 60):
+        self.expected_items = expected_items
+        self.fp_rate = fp_rate
+        self.window_seconds = window_seconds
+        self.size_bits, self.hash_count = bloom_parameters(expected_items, fp_rate)
+
+        self.generation_epochs = [-1] * self.generation_count
+        self.generations = self._create_generations()
+
+        self.checks = 0
+        self.hits = 0
+        self.false_positives = 0
+        self.true_negatives = 0
+        self.foreign_misses = 0
+
+    def _create_generations(self) -> List[BloomFilter]:
+        return [BloomFilter(self.size_bits, self.hash_count) for _ in range(self.generation_count)]
+
+    def _current_epoch(self) -> int:
+        return int(time.time() // self.window_seconds)
+
+    def _get_generation_epoch(self, slot: int) -> int:
+        return self.generation_epochs[slot]
+
+    def _set_generation_epoch(self, slot: int, epoch: int) -> None:
+        self.generation_epochs[slot] = epoch
+
+    def _generation(self, epoch: int) -> Optional[BloomFilter]:
+        slot = epoch % self.generation_count
+        if self._get_generation_epoch(slot) != epoch:
+            return None
+        return self.generations[slot]
+
+    def add(self, event_hash: str) -> None:
+        epoch = self._current_epoch()
+        slot = epoch % self.generation_count
+        if self._get_generation_epoch(slot) != epoch:
+            self.generations[slot].clear()
+            self._set_generation_epoch(slot, epoch)
+        self.generations[slot].add(event_hash)
+
+    def might_contain(self, event_hash: str) -> bool:
+        epoch = self._current_epoch()
+        self.checks += 1
+
+        for generation_epoch in (epoch, epoch - 1):
+            generation = self._generation(generation_epoch)
+            if generation is not None and event_hash in generation:
+                self.hits += 1
+                return True
+        return False
+
+    def record_outcome(self, maybe_seen: bool, is_duplicate: bool) -> None:
+        """Учитывает ответ Redis для оценки фактической доли ложных срабатываний."""
+        if maybe_seen and not is_duplicate:
+            self.false_positives += 1
+        elif not maybe_seen and not is_duplicate:
+            self.true_negatives += 1
+        elif not maybe_seen and is_duplicate:
+            # Событие записано другим процессом или до перезапуска - фильтр его не видел
+            self.foreign_misses += 1
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(generation.memory_bytes for generation in self.generations)
+
+    def stats(self) -> Dict[str, Any]:
+        negatives = self.false_positives + self.true_negatives
+        return {
+            "expected_items": self.expected_items,
+            "target_fp_rate": self.fp_rate,
+            "size_bits": self.size_bits,
+            "hash_count": self.hash_count,
+            "window_seconds": self.window_seconds,
+            "memory_bytes": self.memory_bytes,
+            "checks": self.checks,
+            "hits": self.hits,
+            "false_positives": self.false_positives,
+            "foreign_misses": self.foreign_misses,
+            "measured_fp_rate": self.false_positives / negatives if negatives else 0.0,
+        }
+
+
+class AtomicBloomFilter(BloomFilter):
+    """Фильтр Блума поверх разделяемой памяти с атомарной установкой битов.
+
+    Биты выставляются атомарным OR (libatomic), поэтому процессы пишут в общий
+    сегмент без блокировок. Если libatomic недоступна, используется обычное
+    чтение-изменение-запись: при гонке за один байт может потеряться бит, что дает
+    только ложный промах, который затем исправляет SET NX в Redis.
+    """
+
+    def __init__(self, size_bits: int, hash_count: int, bits: memoryview, address: int):
+        super().__init__(size_bits, hash_count, bits)
+        self.address = address
+
+    def add(self, event_hash: str) -> None:
+        if _atomic_fetch_or is None:
+            super().add(event_hash)
+            return
+        for position in self._positions(event_hash):
+            _atomic_fetch_or(self.address + (position >> 3), 1 << (position & 7), _ATOMIC_RELAXED)
+
+
+class SharedRotatingBloomFilter(RotatingBloomFilter):
+    """Ротируемый фильтр Блума в mmap-сегменте, общем для всех воркеров uvicorn.
+
+    Сегмент создает первый запустившийся процесс, остальные подключаются к нему.
+    Имя файла включает параметры фильтра, поэтому воркеры с разными настройками
+    никогда не делят один сегмент. Номера эпох поколений хранятся в заголовке,
+    так что ротацию видят все процессы.
+    """
+
+    MAGIC = b"KIONBLM1"
+    HEADER = struct.Struct("<8sQQQ")
+    EPOCH = struct.Struct("<q")
+    DATA_OFFSET = 64
+
+    def __init__(self, expected_items: int, fp_rate: float = 0.01, window_seconds: int = 7 * 24 * 60 * 60,
+                 path: str = "/dev/shm/kion-dedup-bloom"):
+        self.base_path = path
+        super().__init__(expected_items, fp_rate, window_seconds)
+
+    def _create_generations(self) -> List[BloomFilter]:
+        self.path = f"{self.base_path}-{self.size_bits}-{self.hash_count}-{self.window_seconds}"
+
+        generation_bytes = (self.size_bits + 7) // 8
+        total_bytes = self.DATA_OFFSET + generation_bytes * self.generation_count
+        self.segment = self._open_segment(total_bytes)
+        view = memoryview(self.segment)
+        base_address = ctypes.addressof(ctypes.c_char.from_buffer(self.segment))
+
+        generations = []
+        for slot in range(self.generation_count):
+            offset = self.DATA_OFFSET + slot * generation_bytes
+            generations.append(AtomicBloomFilter(
+                self.size_bits,
+                self.hash_count,
+                view[offset:offset + generation_bytes],
+                base_address + offset
+            ))
+        return generations
+
+    def _open_segment(self, total_bytes: int) -> mmap.mmap:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Блокировка нужна только на время инициализации сегмента
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size != total_bytes:
+                    os.ftruncate(fd, total_bytes)
+                    header = self.HEADER.pack(self.MAGIC, self.size_bits, self.hash_count, self.window_seconds)
+                    os.pwrite(fd, header, 0)
+                    for slot in range(self.generation_count):
+                        os.pwrite(fd, self.EPOCH.pack(-1), self._epoch_offset(slot))
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            return mmap.mmap(fd, total_bytes, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+    def _epoch_offset(self, slot: int) -> int:
+        return self.HEADER.size + slot * self.EPOCH.size
+
+    def _get_generation_epoch(self, slot: int) -> int:
+        return self.EPOCH.unpack_from(self.segment, self._epoch_offset(slot))[0]
+
+    def _set_generation_epoch(self, slot: int, epoch: int) -> None:
+        # Ротацию может одновременно выполнить несколько воркеров: очистка
+        # идемпотентна, худший исход - потеря нескольких только что записанных битов
+        self.EPOCH.pack_into(self.segment, self._epoch_offset(slot), epoch)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["shared_path"] = self.path
+        stats["atomic_bit_set"] = _atomic_fetch_or is not None
+        return stats
@@ -11,66 +11,100 @@ from app.services.kafka_service import KafkaService
 from app.services.redis_service import RedisService
 from app.services.postgres_service import PostgresService
 from app.models import DedupResult
+from app.batch_writer import BatchWriter
 
 
 class EventConsumer:
     """Консьюмер для обработки событий из Kafka."""
     
-    def __init__(self, kafka_service: KafkaService, redis_service: RedisService, postgres_service: PostgresService):
-        """Инициализация консьюмера."""
+    def __init__(self, kafka_service: KafkaService, redis_service: RedisService, postgres_service: PostgresService,
+                 trust_dedup_hash: bool = False, writer_options: Optional[Dict[str, Any]] = None):
+        """Инициализация консьюмера.
+
+        trust_dedup_hash: события с _dedup_hash уже проверены API (ключ в Redis
+        записан), поэтому сохраняются без повторной проверки.
+        writer_options: параметры BatchWriter (размер, возраст и объем пакета).
+        """
         self.kafka = kafka_service
         self.redis = redis_service
         self.postgres = postgres_service
         self.deduplicator = None
+        self.trust_dedup_hash = trust_dedup_hash
         self.running = False
         self.processed_count = 0
         self.duplicate_count = 0
         self.error_count = 0
-        self.saved_count = 0
+        self.last_saved = 0
         self.last_stats_time = datetime.utcnow()
         
-        self.event_buffer = []
-        self.buffer_lock = asyncio.Lock()
-        self.buffer_size = 250
-        self.buffer_flush_interval = 1.0
+        self.writer = BatchWriter(postgres_service, **(writer_options or {}))
     
     async def start(self, 
                     topic: str = "product-events", 
                     group_id: str = "event-deduplicator",
                     bootstrap_servers: str = "localhost:9092",
-                    max_concurrency: int = 500):
-        """Запускает консьюмер для обработки событий."""
+                    max_concurrency: int = 500,
+                    consumer_mode: str = "stream",
+                    fetch_max_records: int = 500,
+                    fetch_timeout_ms: int = 100,
+                    queue_size: int = 0):
+        """Запускает консьюмер для обработки событий.
+
+        consumer_mode: stream - общий поток сообщений всех партиций,
+        partitions - независимый конвейер на каждую назначенную партицию,
+        batch - пакеты getmany, одна проверка дедупликации на пакет.
+        """
         if hasattr(self.redis, 'redis_pool') and self.redis.redis_pool:
             self.deduplicator = Deduplicator(
                 self.redis.redis, 
                 redis_pool=self.redis.redis_pool, 
-                shard_count=self.redis.shard_count
+                shard_count=self.redis.shard_count,
+                codec=self.redis.codec,
+                storage=self.redis.storage,
+                router=self.redis.router
             )
             logger.info(f"Using sharded deduplicator with {self.redis.shard_count} shards")
         else:
-            self.deduplicator = Deduplicator(self.redis.redis)
+            self.deduplicator = Deduplicator(self.redis.redis, codec=self.redis.codec, storage=self.redis.storage)
             logger.info("Using single-instance deduplicator")
         
-        await self.kafka.connect_consumer(topic, group_id, bootstrap_servers)
+        partitioned = consumer_mode == "partitions"
+        await self.kafka.connect_consumer(topic, group_id, bootstrap_servers, subscribe=not partitioned)
         
         self.running = True
         logger.info(f"Starting event consumer for topic {topic} with max concurrency {max_concurrency}")
         
         stats_task = asyncio.create_task(self._log_stats())
-        buffer_task = asyncio.create_task(self._flush_buffer_periodically())
+        self.writer.start()
         
         try:
-            await self.kafka.consume_messages(
-                topic,
-                self._process_event,
-                max_concurrency
-            )
+            if consumer_mode == "batch":
+                await self.kafka.consume_batches(
+                    topic,
+                    self._process_batch,
+                    fetch_max_records,
+                    fetch_timeout_ms
+                )
+            elif partitioned:
+                await self.kafka.consume_partitions(
+                    topic,
+                    self._process_event,
+                    max_concurrency,
+                    fetch_max_records
+                )
+            else:
+                await self.kafka.consume_messages(
+                    topic,
+                    self._process_event,
+                    max_concurrency,
+                    queue_size
+                )
         finally:
             self.running = False
-            await stats_task
-            await buffer_task
-            
-            await self._flush_buffer()
+            # Сначала дописываем буферы: ожидание статистики (до 10 с) могло не дождаться остановки сервиса
+            stats_task.cancel()
+            await self.writer.close()
+            await asyncio.gather(stats_task, return_exceptions=True)
     
     async def stop(self):
         """Останавливает консьюмер."""
@@ -83,60 +117,62 @@ class EventConsumer:
         try:
             self.processed_count += 1
             
-            if '_dedup_hash' in event:
-                event_hash = event.pop('_dedup_hash')
+            event_hash = event.pop('_dedup_hash', None)
+            if event_hash is not None and self.trust_dedup_hash:
+                # Повторная проверка нашла бы ключ, только что записанный API, и отбросила бы событие
+                is_duplicate = False
             else:
-                start_time = time.time()
-                event_hash = self.deduplicator.calculate_hash(event)
-            
-            dedup_result = await self.deduplicator.is_duplicate(event)
+                if event_hash is None:
+                    event_hash = self.deduplicator.calculate_hash(event)
+                dedup_result = await self.deduplicator.is_duplicate(event, event_hash)
+                is_duplicate = dedup_result.is_duplicate
             
-            if dedup_result.is_duplicate:
+            if is_duplicate:
                 self.duplicate_count += 1
                 if self.duplicate_count % 1000 == 0:
                     logger.debug(f"Duplicate event detected: {event_hash}")
             else:
-                async with self.buffer_lock:
-                    self.event_buffer.append((event, event_hash))
-                    
-                    if len(self.event_buffer) >= self.buffer_size:
-                        await self._flush_buffer()
+                self.writer.add(event, event_hash)
+                # Запись в PostgreSQL идет в фоне; ждем, только если она отстала больше допустимого
+                if self.writer.saturated:
+                    await self.writer.wait_for_capacity()
                         
         except Exception as e:
             self.error_count += 1
             logger.error(f"Error processing event: {str(e)}")
     
-    async def _flush_buffer(self):
-        """Сбрасывает буфер событий и сохраняет их в PostgreSQL."""
-        async with self.buffer_lock:
-            if not self.event_buffer:
-                return
-                
-            events_to_save = self.event_buffer.copy()
-            self.event_buffer.clear()
-        
+    async def _process_batch(self, events: List[Dict[str, Any]]):
+        """Обрабатывает пакет событий из Kafka: один pipeline на шард Redis, уникальные события - в буфер одним шагом."""
         try:
-            events = [event for event, _ in events_to_save]
-            event_hashes = [event_hash for _, event_hash in events_to_save]
+            self.processed_count += len(events)
             
-            success = await self.postgres.save_events_batch(events, event_hashes)
-            if success:
-                self.saved_count += len(events_to_save)
-                logger.debug(f"Batch saved {len(events_to_save)} events to PostgreSQL")
-            else:
-                logger.warning("Batch save failed, trying individual saves")
-                for event, event_hash in events_to_save:
-                    success = await self.postgres.save_event(event, event_hash)
-                    if success:
-                        self.saved_count += 1
+            unique = []
+            check_events = []
+            check_hashes = []
+            for event in events:
+                event_hash = event.pop('_dedup_hash', None)
+                if event_hash is not None and self.trust_dedup_hash:
+                    unique.append((event, event_hash))
+                    continue
+                check_events.append(event)
+                check_hashes.append(event_hash if event_hash is not None else self.deduplicator.calculate_hash(event))
+            
+            if check_events:
+                results = await self.deduplicator.is_duplicate_many(check_events, check_hashes)
+                for event, event_hash, dedup_result in zip(check_events, check_hashes, results):
+                    if dedup_result.is_duplicate:
+                        self.duplicate_count += 1
+                    else:
+                        unique.append((event, event_hash))
+            
+            for event, event_hash in unique:
+                self.writer.add(event, event_hash)
+            if self.writer.saturated:
+                await self.writer.wait_for_capacity()
+        
         except Exception as e:
-            logger.error(f"Error batch saving events: {str(e)}")
-    
-    async def _flush_buffer_periodically(self):
-        """Периодически сбрасывает буфер событий."""
-        while self.running:
-            await asyncio.sleep(self.buffer_flush_interval)
-            await self._flush_buffer()
+            self.error_count += len(events)
+            logger.error(f"Error processing event batch: {str(e)}")
     
     async def _log_stats(self, interval: int = 10):
         """Периодически выводит статистику обработки."""
@@ -150,17 +186,20 @@ class EventConsumer:
                 continue
             
             rps = self.processed_count / delta if delta > 0 else 0
+            saved = self.writer.saved - self.last_saved
+            writer_stats = self.writer.stats()
             
             logger.info(
                 f"Stats: Processed {self.processed_count} events ({rps:.1f} RPS), "
                 f"Duplicates {self.duplicate_count}, "
-                f"Saved to PostgreSQL {self.saved_count}, "
+                f"Saved to PostgreSQL {saved}, "
                 f"Errors {self.error_count}, "
-                f"Buffer size: {len(self.event_buffer)} in the last {delta:.1f} seconds"
+                f"Buffered {writer_stats['buffered']}, "
+                f"Pending batches {writer_stats['pending_batches']} in the last {delta:.1f} seconds"
             )
             
             self.processed_count = 0
             self.duplicate_count = 0
-            self.saved_count = 0
+            self.last_saved = self.writer.saved
             self.error_count = 0
             self.last_stats_time = now 
\ No newline at end of file
@@ -0,0 +1,67 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+import orjson
+from loguru import logger
+
+
+class DeadLetterSink:
+    """Хранилище событий, которые PostgreSQL не принял.
+
+    Записи отправляются в топик Kafka topic (ключ - хеш события) с ожиданием
+    подтверждения брокера и в режиме batched. Если топик не задан или отправка
+    не подтверждена, они дописываются в NDJSON-файл spool_path, откуда их можно
+    переиграть после исправления.
+    """
+
+    def __init__(self, kafka=None, topic: Optional[str] = None, spool_path: Optional[str] = "dead-letter.ndjson"):
+        self.kafka = kafka
+        self.topic = topic
+        self.spool_path = spool_path
+        self.published = 0
+        self.spooled = 0
+        self.lost = 0
+
+    async def publish(self, records: List[Tuple[Dict[str, Any], str, str]]) -> None:
+        """Сохраняет записи (событие, хеш, ошибка)."""
+        if not records:
+            return
+        failed_at = datetime.utcnow().isoformat()
+        messages = [
+            {"event": event, "event_hash": event_hash, "error": error, "failed_at": failed_at}
+            for event, event_hash, error in records
+        ]
+
+        if self.kafka is not None and self.topic:
+            if await self.kafka.send_batch(self.topic, messages, [event_hash for _, event_hash, _ in records],
+                                           confirm=True):
+                self.published += len(messages)
+                logger.warning(f"Sent {len(messages)} rejected events to Kafka topic {self.topic}")
+                return
+            logger.error(f"Failed to send {len(messages)} rejected events to {self.topic}, spooling to file")
+
+        if not self.spool_path:
+            self.lost += len(messages)
+            logger.error(f"Dropped {len(messages)} rejected events: no dead-letter destination")
+            return
+        try:
+            await asyncio.to_thread(self._append, messages)
+            self.spooled += len(messages)
+            logger.warning(f"Spooled {len(messages)} rejected events to {self.spool_path}")
+        except OSError as e:
+            self.lost += len(messages)
+            logger.error(f"Failed to spool {len(messages)} rejected events: {str(e)}")
+
+    def _append(self, messages: List[Dict[str, Any]]) -> None:
+        with open(self.spool_path, "ab") as spool:
+            spool.write(b"".join(orjson.dumps(message, default=str) + b"\n" for message in messages))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "topic": self.topic,
+            "spool_path": self.spool_path,
+            "published": self.published,
+            "spooled": self.spooled,
+            "lost": self.lost,
+        }
@@ -0,0 +1,125 @@
+import hashlib
+import json
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Union
+
+
+DEDUP_FIELDS = ('client_id', 'event_datetime', 'event_name', 'product_id', 'sid', 'r')
+
+
+def hash_v1(event: Dict[str, Any]) -> str:
+    """Схема v1: SHA-256 от JSON шести полей с сортировкой ключей (64 hex-символа)."""
+    dedup_fields = {field: event.get(field, '') for field in DEDUP_FIELDS}
+    json_str = json.dumps(dedup_fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(json_str.encode('utf-8')).hexdigest()
+
+
+def hash_v2(event: Dict[str, Any]) -> str:
+    """Схема v2: BLAKE2b-128 от шести полей в фиксированном порядке (32 hex-символа).
+
+    Каждое поле кодируется как 4-байтная длина и UTF-8 байты значения,
+    поэтому границы полей однозначны без сериализации в JSON.
+    """
+    parts = []
+    for field in DEDUP_FIELDS:
+        value = event.get(field)
+        if value is None:
+            value = ''
+        data = (value if isinstance(value, str) else str(value)).encode('utf-8')
+        parts.append(len(data).to_bytes(4, 'little'))
+        parts.append(data)
+    return hashlib.blake2b(b''.join(parts), digest_size=16).hexdigest()
+
+
+HASH_FUNCTIONS = {1: hash_v1, 2: hash_v2}
+
+
+class DedupKeyCodec:
+    """Кодирование ключей и значений дедупликации в Redis.
+
+    legacy:  "event_dedup:" + hex-хеш события, значение - ISO-строка времени.
+    compact: b"d:" + первые 16 байт дайджеста, значение - epoch в секундах.
+             Redis хранит целочисленные строки в int-кодировке без отдельного sds.
+
+    Ключи схем хеширования старше v1 помечаются версией ("event_dedup:v2:", b"d2:"),
+    чтобы пространства ключей v1 и v2 не пересекались во время раскатки.
+
+    В режиме legacy_read при проверке дополнительно читается ключ в старом формате
+    (legacy-кодировка, хеш v1), чтобы события, записанные до перехода на compact
+    или на новую схему хеширования, продолжали считаться дубликатами до истечения TTL.
+    """
+
+    LEGACY_PREFIX = "event_dedup:"
+    COMPACT_PREFIX = b"d:"
+    COMPACT_DIGEST_BYTES = 16
+
+    def __init__(self, encoding: str = "legacy", legacy_read: bool = False, hash_version: int = 1):
+        if encoding not in ("legacy", "compact"):
+            raise ValueError(f"Unknown dedup key encoding: {encoding}")
+        if hash_version not in HASH_FUNCTIONS:
+            raise ValueError(f"Unknown dedup hash version: {hash_version}")
+        self.encoding = encoding
+        self.hash_version = hash_version
+        self.calculate_hash = HASH_FUNCTIONS[hash_version]
+        self.legacy_read = legacy_read and (encoding != "legacy" or hash_version != 1)
+
+        self.version_tag = "" if hash_version == 1 else f"v{hash_version}:"
+        self.key_prefix = self.LEGACY_PREFIX + self.version_tag
+        self.compact_prefix = self.COMPACT_PREFIX if hash_version == 1 else f"d{hash_version}:".encode()
+
+    def key(self, event_hash: str) -> Union[str, bytes]:
+        if self.encoding == "compact":
+            return self.compact_prefix + bytes.fromhex(event_hash[:self.COMPACT_DIGEST_BYTES * 2])
+        return self.key_prefix + event_hash
+
+    def legacy_hash(self, event_hash: str, event: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Хеш события по схеме v1; для хеша v2 требуется само событие."""
+        if self.hash_version == 1:
+            return event_hash
+        if event is None:
+            return None
+        return hash_v1(event)
+
+    def legacy_key(self, event_hash: str, event: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Ключ события в исходном формате."""
+        legacy_hash = self.legacy_hash(event_hash, event)
+        return self.LEGACY_PREFIX + legacy_hash if legacy_hash is not None else None
+
+    def key_hash(self, key: bytes) -> Optional[str]:
+        """Хеш события (или его префикс) по ключу любого формата; None для чужих ключей."""
+        legacy_prefix = self.LEGACY_PREFIX.encode()
+        if key.startswith(legacy_prefix):
+            return key[len(legacy_prefix):].rsplit(b":", 1)[-1].decode()
+        for prefix in (self.COMPACT_PREFIX, self.compact_prefix):
+            if key.startswith(prefix):
+                return key[len(prefix):].hex()
+        return None
+
+    def encode_timestamp(self, timestamp: Optional[Union[str, datetime]] = None) -> Union[str, int]:
+        if timestamp is None:
+            timestamp = datetime.utcnow()
+        elif isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+
+        if self.encoding == "compact":
+            return int((timestamp - datetime(1970, 1, 1)).total_seconds())
+        return timestamp.isoformat()
+
+    @staticmethod
+    def decode_timestamp(raw: Optional[bytes]) -> Optional[str]:
+        """Возвращает ISO-время из значения любого формата."""
+        if raw is None:
+            return None
+        if raw.isdigit():
+            return datetime.utcfromtimestamp(int(raw)).isoformat()
+        return raw.decode('utf-8')
+
+    def key_patterns(self) -> List[Union[str, bytes]]:
+        """Шаблоны ключей для подсчета записей дедупликации."""
+        if self.encoding == "compact":
+            patterns = [self.compact_prefix + b"*"]
+        else:
+            patterns = [self.key_prefix + "*"]
+        if self.legacy_read and self.LEGACY_PREFIX + "*" not in patterns:
+            patterns.append(self.LEGACY_PREFIX + "*")
+        return patterns
@@ -0,0 +1,303 @@
+import re
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+from app.bloom import bloom_parameters, bloom_positions
+from app.dedup_codec import DedupKeyCodec
+
+
+CheckOutcome = Optional[Tuple[bool, Optional[bytes]]]
+
+
+class KeyStorage:
+    """Один ключ Redis с собственным TTL на каждое событие.
+
+    Проверка - SET NX GET (Redis >= 7.0): проверка и запись одной атомарной командой.
+    Возвращает None, если ключ создан нами, иначе - сохраненное ранее значение.
+    При промахе фильтра Блума ключ пишется без чтения старого значения.
+    """
+
+    name = "keys"
+
+    def __init__(self, codec: DedupKeyCodec, ttl_seconds: int):
+        self.codec = codec
+        self.ttl_seconds = ttl_seconds
+
+    def queue_check(self, pipe, event_hash: str, event: Dict[str, Any], value, maybe_seen: bool) -> int:
+        """Добавляет команды проверки в pipeline и возвращает их количество."""
+        pipe.set(self.codec.key(event_hash), value, ex=self.ttl_seconds, nx=True, get=maybe_seen)
+        if self.codec.legacy_read:
+            pipe.get(self.codec.legacy_key(event_hash, event))
+            return 2
+        return 1
+
+    def parse_check(self, replies: List[Any], event: Dict[str, Any], maybe_seen: bool) -> CheckOutcome:
+        """Возвращает (is_duplicate, исходное значение) или None, если нужно дочитать значение."""
+        reply = replies[0]
+        if self.codec.legacy_read and replies[1] is not None:
+            # Событие записано до перехода на новый формат ключей
+            return True, replies[1]
+        if maybe_seen:
+            return reply is not None, reply
+        if reply:
+            return False, None
+        # Ключ уже записан другим процессом: исходную метку нужно дочитать
+        return None
+
+    def queue_lookup(self, pipe, event_hash: str, event: Dict[str, Any]) -> int:
+        """Добавляет команды чтения без записи и возвращает их количество."""
+        pipe.get(self.codec.key(event_hash))
+        if self.codec.legacy_read:
+            pipe.get(self.codec.legacy_key(event_hash, event))
+            return 2
+        return 1
+
+    def parse_lookup(self, replies: List[Any], event: Dict[str, Any]) -> Tuple[bool, Optional[bytes]]:
+        """Возвращает (найдено, исходное значение) по ответам queue_lookup."""
+        for reply in replies:
+            if reply is not None:
+                return True, reply
+        return False, None
+
+    def queue_forget(self, pipe, event_hash: str, event: Dict[str, Any]) -> int:
+        """Удаляет запись о событии (событие не удалось сохранить); возвращает число команд."""
+        pipe.delete(self.codec.key(event_hash))
+        return 1
+
+    def key_patterns(self) -> List[Union[str, bytes]]:
+        return self.codec.key_patterns()
+
+
+class BucketStorage:
+    """Хеши событий в hash-бакетах Redis по (шард, день события).
+
+    Ключ бакета строится из даты event_datetime и первых символов хеша события,
+    поле - 16 байт дайджеста, значение - время первой записи. Бакет целиком
+    истекает через TTL после конца своего дня (но не раньше чем через TTL после
+    первой записи, иначе опоздавшие события не дедуплицировались бы), поэтому
+    Redis не хранит TTL на каждое событие. Несуществующая дата (например,
+    2026-13-45) и дата дальше MAX_FUTURE_SECONDS в будущем считаются отсутствующими:
+    дату задает клиент, и бакет 2999-12-31 иначе не истек бы никогда. Дата берется из event_datetime, а не из event_date: только
+    поля, входящие в хеш, гарантируют попадание одинаковых событий в один бакет.
+
+    Проверка за один round trip: HSETNX + HGET + EXPIREAT NX в одном pipeline.
+    """
+
+    name = "buckets"
+    PREFIX = "db:"
+    UNDATED = "undated"
+    DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}")
+    # Запас на часовые пояса и расхождение часов клиентов
+    MAX_FUTURE_SECONDS = 2 * 24 * 60 * 60
+
+    def __init__(self, codec: DedupKeyCodec, ttl_seconds: int, prefix_chars: int = 3, fallback_read: bool = False):
+        self.codec = codec
+        self.ttl_seconds = ttl_seconds
+        self.prefix_chars = prefix_chars
+        self.fallback_read = fallback_read
+        self.key_prefix = self.PREFIX + codec.version_tag
+        self._expire_at_cache: Dict[str, int] = {}
+
+    def _fallback_keys(self, event_hash: str, event: Dict[str, Any]) -> List[Union[str, bytes]]:
+        # Ключи по одному на событие, записанные до перехода на бакеты
+        if not self.fallback_read:
+            return []
+        keys = [self.codec.key(event_hash)]
+        if self.codec.legacy_read:
+            keys.append(self.codec.legacy_key(event_hash, event))
+        return keys
+
+    def _day_expire_at(self, event_date: str) -> Optional[int]:
+        """Конец дня события плюс TTL; None, если такой даты не существует."""
+        expire_at = self._expire_at_cache.get(event_date)
+        if expire_at is None:
+            try:
+                day_end = datetime.strptime(event_date, "%Y-%m-%d") + timedelta(days=1)
+            except ValueError:
+                return None
+            expire_at = int((day_end - datetime(1970, 1, 1)).total_seconds()) + self.ttl_seconds
+            if len(self._expire_at_cache) > 1024:
+                self._expire_at_cache.clear()
+            self._expire_at_cache[event_date] = expire_at
+        return expire_at
+
+    def bucket_key(self, event_hash: str, event: Dict[str, Any]) -> Tuple[str, int]:
+        event_datetime = str(event.get('event_datetime', ''))
+        event_date = self.UNDATED
+        expire_at = None
+        now = int(time.time())
+        if self.DATE_PATTERN.match(event_datetime):
+            expire_at = self._day_expire_at(event_datetime[:10])
+            if expire_at is not None and expire_at - self.ttl_seconds > now + self.MAX_FUTURE_SECONDS:
+                expire_at = None
+            if expire_at is not None:
+                event_date = event_datetime[:10]
+        # У события старше TTL конец дня уже в прошлом: EXPIREAT сразу удалил бы бакет
+        expire_at = min(max(expire_at or 0, now + self.ttl_seconds), now + 2 * self.ttl_seconds)
+        return f"{self.key_prefix}{event_date}:{event_hash[:self.prefix_chars]}", expire_at
+
+    def queue_check(self, pipe, event_hash: str, event: Dict[str, Any], value, maybe_seen: bool) -> int:
+        bucket, expire_at = self.bucket_key(event_hash, event)
+        field = bytes.fromhex(event_hash[:DedupKeyCodec.COMPACT_DIGEST_BYTES * 2])
+        pipe.hsetnx(bucket, field, value)
+        pipe.hget(bucket, field)
+        pipe.expireat(bucket, expire_at, nx=True)
+        fallback_keys = self._fallback_keys(event_hash, event)
+        for key in fallback_keys:
+            pipe.get(key)
+        return 3 + len(fallback_keys)
+
+    def parse_check(self, replies: List[Any], event: Dict[str, Any], maybe_seen: bool) -> CheckOutcome:
+        for fallback_value in replies[3:]:
+            if fallback_value is not None:
+                return True, fallback_value
+        if replies[0]:
+            return False, None
+        return True, replies[1]
+
+    def queue_lookup(self, pipe, event_hash: str, event: Dict[str, Any]) -> int:
+        bucket, _ = self.bucket_key(event_hash, event)
+        pipe.hget(bucket, bytes.fromhex(event_hash[:DedupKeyCodec.COMPACT_DIGEST_BYTES * 2]))
+        fallback_keys = self._fallback_keys(event_hash, event)
+        for key in fallback_keys:
+            pipe.get(key)
+        return 1 + len(fallback_keys)
+
+    def parse_lookup(self, replies: List[Any], event: Dict[str, Any]) -> Tuple[bool, Optional[bytes]]:
+        for reply in replies:
+            if reply is not None:
+                return True, reply
+        return False, None
+
+    def queue_forget(self, pipe, event_hash: str, event: Dict[str, Any]) -> int:
+        bucket, _ = self.bucket_key(event_hash, event)
+        pipe.hdel(bucket, bytes.fromhex(event_hash[:DedupKeyCodec.COMPACT_DIGEST_BYTES * 2]))
+        return 1
+
+    def key_patterns(self) -> List[Union[str, bytes]]:
+        patterns = [self.key_prefix + "*"]
+        if self.fallback_read:
+            patterns.extend(self.codec.key_patterns())
+        return patterns
+
+
+class BitmapStorage:
+    """Вероятностная дедупликация: фильтр Блума в строках Redis.
+
+    Для высокочастотных событий, где редкий ложный «дубликат» допустим
+    (например, heartbeat-событие app_list). Вместо ключа на событие хранится
+    несколько бит: фильтр разбит на partitions ключей на тип события и окно
+    времени, окна ротируются по времени и истекают целиком.
+
+    Проверка - одна атомарная команда BITFIELD SET u1 ... по всем k битам текущего
+    окна (возвращает прежние значения битов) плюс BITFIELD GET по предыдущему окну.
+    Все биты установлены - событие считается дубликатом. Исходное время
+    в этом режиме не хранится.
+    """
+
+    name = "bitmap"
+    PREFIX = "bf:"
+
+    def __init__(self, codec: DedupKeyCodec, ttl_seconds: int, expected_items: int = 10_000_000,
+                 fp_rate: float = 0.001, partitions: int = 16):
+        self.key_prefix = self.PREFIX + codec.version_tag
+        self.window_seconds = ttl_seconds
+        self.partitions = max(1, partitions)
+        self.size_bits, self.hash_count = bloom_parameters(expected_items // self.partitions, fp_rate)
+
+    def _keys(self, event_hash: str, event: Dict[str, Any]) -> Tuple[str, str, int]:
+        epoch = int(time.time() // self.window_seconds)
+        partition = int(event_hash[-8:], 16) % self.partitions
+        base = f"{self.key_prefix}{event.get('event_name', '')}:{partition}:"
+        expire_at = (epoch + 2) * self.window_seconds
+        return f"{base}{epoch}", f"{base}{epoch - 1}", expire_at
+
+    def queue_check(self, pipe, event_hash: str, event: Dict[str, Any], value, maybe_seen: bool) -> int:
+        current_key, previous_key, expire_at = self._keys(event_hash, event)
+        positions = bloom_positions(event_hash, self.size_bits, self.hash_count)
+
+        set_args = []
+        for position in positions:
+            set_args.extend(("SET", "u1", position, 1))
+
+        pipe.execute_command("BITFIELD", current_key, *set_args)
+        pipe.execute_command("BITFIELD", previous_key, *self._get_args(positions))
+        pipe.expireat(current_key, expire_at, nx=True)
+        return 3
+
+    @staticmethod
+    def _get_args(positions: List[int]) -> List[Any]:
+        args = []
+        for position in positions:
+            args.extend(("GET", "u1", position))
+        return args
+
+    def parse_check(self, replies: List[Any], event: Dict[str, Any], maybe_seen: bool) -> CheckOutcome:
+        current_bits, previous_bits = replies[0], replies[1]
+        is_duplicate = all(current_bits) or all(previous_bits)
+        return is_duplicate, None
+
+    def queue_lookup(self, pipe, event_hash: str, event: Dict[str, Any]) -> int:
+        current_key, previous_key, _ = self._keys(event_hash, event)
+        get_args = self._get_args(bloom_positions(event_hash, self.size_bits, self.hash_count))
+        pipe.execute_command("BITFIELD", current_key, *get_args)
+        pipe.execute_command("BITFIELD", previous_key, *get_args)
+        return 2
+
+    def parse_lookup(self, replies: List[Any], event: Dict[str, Any]) -> Tuple[bool, Optional[bytes]]:
+        return all(replies[0]) or all(replies[1]), None
+
+    def queue_forget(self, pipe, event_hash: str, event: Dict[str, Any]) -> int:
+        # Биты фильтра общие с другими событиями: сбросить их нельзя
+        return 0
+
+    def key_patterns(self) -> List[Union[str, bytes]]:
+        return [self.key_prefix + "*"]
+
+
+class EventTypeStorage:
+    """Выбирает движок хранения по типу события: точный или вероятностный."""
+
+    name = "by_event_type"
+
+    def __init__(self, default_storage, storages: Dict[str, Any]):
+        self.default_storage = default_storage
+        self.storages = storages
+
+    def _storage(self, event: Dict[str, Any]):
+        return self.storages.get(event.get('event_name'), self.default_storage)
+
+    def queue_check(self, pipe, event_hash: str, event: Dict[str, Any], value, maybe_seen: bool) -> int:
+        return self._storage(event).queue_check(pipe, event_hash, event, value, maybe_seen)
+
+    def parse_check(self, replies: List[Any], event: Dict[str, Any], maybe_seen: bool) -> CheckOutcome:
+        return self._storage(event).parse_check(replies, event, maybe_seen)
+
+    def queue_lookup(self, pipe, event_hash: str, event: Dict[str, Any]) -> int:
+        return self._storage(event).queue_lookup(pipe, event_hash, event)
+
+    def parse_lookup(self, replies: List[Any], event: Dict[str, Any]) -> Tuple[bool, Optional[bytes]]:
+        return self._storage(event).parse_lookup(replies, event)
+
+    def queue_forget(self, pipe, event_hash: str, event: Dict[str, Any]) -> int:
+        return self._storage(event).queue_forget(pipe, event_hash, event)
+
+    def key_patterns(self) -> List[Union[str, bytes]]:
+        patterns = list(self.default_storage.key_patterns())
+        for storage in self.storages.values():
+            for pattern in storage.key_patterns():
+                if pattern not in patterns:
+                    patterns.append(pattern)
+        return patterns
+
+
+def create_storage(name: str, codec: DedupKeyCodec, ttl_seconds: int, **options):
+    """Создает движок хранения состояния дедупликации по имени."""
+    if name == KeyStorage.name:
+        return KeyStorage(codec, ttl_seconds)
+    if name == BucketStorage.name:
+        return BucketStorage(codec, ttl_seconds, **options)
+    if name == BitmapStorage.name:
+        return BitmapStorage(codec, ttl_seconds, **options)
+    raise ValueError(f"Unknown dedup storage engine: {name}")
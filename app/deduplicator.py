@@ -1,48 +1,35 @@
-import hashlib
-import json
-from datetime import datetime
-from typing import Dict, Any
+import asyncio
+from typing import Dict, Any, List, Optional, Set, Tuple
 
-from loguru import logger
 from app.models import DedupResult
+from app.dedup_codec import DedupKeyCodec
+from app.dedup_storage import KeyStorage
+from app.hot_cache import HotDuplicateCache
+from app.sharding import ShardRouter, ModuloRouter
+from app.single_flight import LeaderCancelledError, SingleFlight
 
 
 class Deduplicator:
-    def __init__(self, redis_client, ttl_days: int = 7, shard_count: int = 1, redis_pool=None):
+    def __init__(self, redis_client, ttl_days: int = 7, shard_count: int = 1, redis_pool=None,
+                 bloom_filter=None, codec: Optional[DedupKeyCodec] = None, storage=None,
+                 router: Optional[ShardRouter] = None, hot_cache: Optional[HotDuplicateCache] = None,
+                 single_flight: Optional[SingleFlight] = None):
         self.redis = redis_client
         self.redis_pool = redis_pool
+        self.bloom_filter = bloom_filter
+        self.codec = codec or DedupKeyCodec()
         self.ttl_seconds = ttl_days * 24 * 60 * 60
-        self.key_prefix = "event_dedup:"
+        self.storage = storage or KeyStorage(self.codec, self.ttl_seconds)
         self.shard_count = shard_count
-
-    def _extract_dedup_fields(self, event: Dict[str, Any]) -> Dict[str, Any]:
-        dedup_fields = {
-            'client_id': event.get('client_id', ''),
-            'event_datetime': event.get('event_datetime', ''),
-            'event_name': event.get('event_name', ''),
-            'product_id': event.get('product_id', ''),
-            'sid': event.get('sid', ''),
-            'r': event.get('r', '')
-        }
-        
-        for field, value in dedup_fields.items():
-            if not value:
-                logger.warning(f"Поле {field} отсутствует или пустое в событии")
-        
-        return dedup_fields
+        self.router = router or ModuloRouter(shard_count)
+        self.hot_cache = hot_cache
+        self.single_flight = single_flight
 
     def calculate_hash(self, event: Dict[str, Any]) -> str:
-        dedup_fields = self._extract_dedup_fields(event)
-        sorted_fields = dict(sorted(dedup_fields.items()))
-        json_str = json.dumps(sorted_fields, sort_keys=True, ensure_ascii=False)
-        return hashlib.sha256(json_str.encode('utf-8')).hexdigest()
+        return self.codec.calculate_hash(event)
 
     def _get_shard_index(self, event_hash: str) -> int:
-        if self.shard_count <= 1:
-            return 0
-            
-        hash_int = int(event_hash[:8], 16)
-        return hash_int % self.shard_count
+        return self.router.shard(event_hash)
 
     def _get_redis_client(self, event_hash: str):
         if self.redis_pool is None:
@@ -51,35 +38,331 @@ class Deduplicator:
         shard = self._get_shard_index(event_hash)
         return self.redis_pool[shard]
 
-    async def is_duplicate(self, event: Dict[str, Any]) -> DedupResult:
-        event_hash = self.calculate_hash(event)
-        redis_key = f"{self.key_prefix}{event_hash}"
-        redis_client = self._get_redis_client(event_hash)
+    async def is_duplicate(self, event: Dict[str, Any], event_hash: Optional[str] = None) -> DedupResult:
+        """Проверяет одно событие; уже вычисленный хеш можно передать, чтобы не считать его повторно.
+
+        Отдельный путь для одного события: без списков позиций и раскладки по шардам
+        пакетного is_duplicate_many. Попадание в локальный кэш не обращается к Redis.
+        """
+        if event_hash is None:
+            event_hash = self.calculate_hash(event)
+        
+        if self.hot_cache is not None:
+            found, original_timestamp = self.hot_cache.lookup(event_hash)
+            if found:
+                return self._build_result(event_hash, True, original_timestamp)
         
-        pipe = redis_client.pipeline()
-        pipe.exists(redis_key)
-        pipe.get(redis_key)
+        if self.single_flight is not None:
+            is_leader, future = self.single_flight.join(event_hash)
+            if not is_leader:
+                try:
+                    return self._build_result(event_hash, True, await future)
+                except LeaderCancelledError:
+                    # Ведущего отменили до ответа Redis: проверяем заново
+                    return await self.is_duplicate(event, event_hash)
         
-        exists, original_timestamp = await pipe.execute()
+        value = self.codec.encode_timestamp()
+        try:
+            is_duplicate, original_timestamp = await self._check_one_in_redis(event_hash, event, value)
+        except BaseException as e:
+            if self.single_flight is not None:
+                self.single_flight.fail(event_hash, e)
+            raise
         
-        if exists:
-            return DedupResult(
-                is_duplicate=True,
-                event_hash=event_hash,
-                original_timestamp=original_timestamp.decode('utf-8') if original_timestamp else None
+        known_timestamp = original_timestamp if is_duplicate else str(value).encode()
+        if self.hot_cache is not None:
+            self.hot_cache.add(event_hash, known_timestamp)
+        if self.single_flight is not None:
+            self.single_flight.resolve(event_hash, known_timestamp)
+        return self._build_result(event_hash, is_duplicate, original_timestamp)
+
+    async def _check_one_in_redis(self, event_hash: str, event: Dict[str, Any],
+                                  value) -> Tuple[bool, Optional[bytes]]:
+        """Проверяет и записывает один хеш: один pipeline на шард события."""
+        maybe_seen = await self.check_bloom_filter(event_hash)
+        
+        if self.redis_pool:
+            shard = self._get_shard_index(event_hash)
+            redis_client = self.redis_pool[shard]
+            lookup_shards = self._lookup_shards(event_hash, event)
+            lookup_shards.discard(shard)
+        else:
+            redis_client = self.redis
+            lookup_shards = None
+        
+        storage = self.storage
+        pipe = redis_client.pipeline(transaction=False)
+        storage.queue_check(pipe, event_hash, event, value, maybe_seen)
+        if lookup_shards:
+            # Решардинг или чтение ключей v1: другие шарды читаются параллельно с проверкой
+            replies, *lookups = await asyncio.gather(
+                pipe.execute(),
+                *(self._lookup_on_shard(self.redis_pool[lookup_shard], [event_hash], [event])
+                  for lookup_shard in lookup_shards)
             )
         else:
-            now = datetime.utcnow().isoformat()
-            await redis_client.set(redis_key, now, ex=self.ttl_seconds)
+            replies, lookups = await pipe.execute(), ()
+        
+        outcome = storage.parse_check(replies, event, maybe_seen)
+        for (found, original_timestamp), in lookups:
+            if found:
+                outcome = (True, original_timestamp)
+        if outcome is None:
+            # Запись уже сделана другим процессом: дочитываем исходную метку
+            (_, original_timestamp), = await self._lookup_on_shard(redis_client, [event_hash], [event])
+            outcome = (True, original_timestamp)
+        
+        await self._remember(event_hash, maybe_seen, outcome[0])
+        return outcome
+
+    async def is_duplicate_many(self, events: List[Dict[str, Any]],
+                                event_hashes: Optional[List[str]] = None) -> List[DedupResult]:
+        """Проверяет пакет событий: один pipeline на шард, шарды опрашиваются параллельно."""
+        if not events:
+            return []
+        
+        if event_hashes is None:
+            event_hashes = [self.calculate_hash(event) for event in events]
+        outcomes: List[Tuple[bool, Optional[bytes]]] = [None] * len(events)
+        
+        pending = []
+        for position, event_hash in enumerate(event_hashes):
+            if self.hot_cache is not None:
+                # Недавний повтор: запись в Redis уже есть, обращение не нужно
+                found, original_timestamp = self.hot_cache.lookup(event_hash)
+                if found:
+                    outcomes[position] = (True, original_timestamp)
+                    continue
+            pending.append(position)
+        
+        leaders = pending
+        followers = []
+        if self.single_flight is not None:
+            # Одновременные проверки одного хеша (в том числе внутри пакета) ждут одну запись в Redis
+            leaders = []
+            for position in pending:
+                is_leader, future = self.single_flight.join(event_hashes[position])
+                if is_leader:
+                    leaders.append(position)
+                else:
+                    followers.append((position, future))
+        
+        if leaders:
+            value = self.codec.encode_timestamp()
+            try:
+                redis_outcomes = await self._check_in_redis(
+                    [event_hashes[position] for position in leaders],
+                    [events[position] for position in leaders],
+                    value
+                )
+            except BaseException as e:
+                # В том числе отмена запроса: ожидающие не должны зависнуть
+                if self.single_flight is not None:
+                    for position in leaders:
+                        self.single_flight.fail(event_hashes[position], e)
+                raise
             
-            return DedupResult(
-                is_duplicate=False,
-                event_hash=event_hash,
-                original_timestamp=None
+            stored_value = str(value).encode()
+            for position, (is_duplicate, original_timestamp) in zip(leaders, redis_outcomes):
+                outcomes[position] = (is_duplicate, original_timestamp)
+                # Значение, которое теперь лежит в Redis для этого хеша
+                known_timestamp = original_timestamp if is_duplicate else stored_value
+                if self.hot_cache is not None:
+                    self.hot_cache.add(event_hashes[position], known_timestamp)
+                if self.single_flight is not None:
+                    self.single_flight.resolve(event_hashes[position], known_timestamp)
+        
+        retry = []
+        for position, future in followers:
+            try:
+                outcomes[position] = (True, await future)
+            except LeaderCancelledError:
+                retry.append(position)
+        
+        results = [
+            self._build_result(event_hash, *outcome) if outcome is not None else None
+            for event_hash, outcome in zip(event_hashes, outcomes)
+        ]
+        if retry:
+            # Ведущего отменили до ответа Redis: проверяем заново, один из ожидающих станет ведущим
+            retried = await self.is_duplicate_many(
+                [events[position] for position in retry],
+                [event_hashes[position] for position in retry]
+            )
+            for position, result in zip(retry, retried):
+                results[position] = result
+        return results
+
+    async def _check_in_redis(self, event_hashes: List[str], events: List[Dict[str, Any]],
+                              value) -> List[Tuple[bool, Optional[bytes]]]:
+        """Проверяет и записывает хеши в Redis: один pipeline на шард, шарды параллельно."""
+        maybe_seen = [await self.check_bloom_filter(event_hash) for event_hash in event_hashes]
+        
+        shard_positions: Dict[int, List[int]] = {}
+        lookup_positions: Dict[int, List[int]] = {}
+        for position, (event_hash, event) in enumerate(zip(event_hashes, events)):
+            if not self.redis_pool:
+                shard_positions.setdefault(0, []).append(position)
+                continue
+            shard = self._get_shard_index(event_hash)
+            shard_positions.setdefault(shard, []).append(position)
+            for lookup_shard in self._lookup_shards(event_hash, event) - {shard}:
+                lookup_positions.setdefault(lookup_shard, []).append(position)
+        
+        async def check_shard(shard: int, positions: List[int]):
+            redis_client = self.redis_pool[shard] if self.redis_pool else self.redis
+            outcomes = await self._check_on_shard(
+                redis_client,
+                [event_hashes[position] for position in positions],
+                [events[position] for position in positions],
+                [maybe_seen[position] for position in positions],
+                value
             )
+            return positions, outcomes
+        
+        async def lookup_shard(shard: int, positions: List[int]):
+            outcomes = await self._lookup_on_shard(
+                self.redis_pool[shard],
+                [event_hashes[position] for position in positions],
+                [events[position] for position in positions]
+            )
+            return positions, outcomes
+        
+        # Другие шарды, где может лежать запись, читаются параллельно с проверкой
+        shard_outcomes, lookup_outcomes = await asyncio.gather(
+            asyncio.gather(*(check_shard(shard, positions) for shard, positions in shard_positions.items())),
+            asyncio.gather(*(lookup_shard(shard, positions) for shard, positions in lookup_positions.items()))
+        )
+        
+        outcomes: List[Tuple[bool, Optional[bytes]]] = [None] * len(event_hashes)
+        for positions, shard_results in shard_outcomes:
+            for position, outcome in zip(positions, shard_results):
+                outcomes[position] = outcome
+        for positions, shard_results in lookup_outcomes:
+            for position, (found, original_timestamp) in zip(positions, shard_results):
+                if found:
+                    outcomes[position] = (True, original_timestamp)
+        
+        for event_hash, seen, (is_duplicate, _) in zip(event_hashes, maybe_seen, outcomes):
+            await self._remember(event_hash, seen, is_duplicate)
+        
+        return outcomes
+
+    async def forget(self, events: List[Dict[str, Any]], event_hashes: List[str]) -> None:
+        """Снимает записи о событиях, которые не удалось сохранить, чтобы повтор клиента не стал дубликатом.
+
+        В движке bitmap записи не снимаются: биты фильтра общие с другими событиями.
+        Локальный кэш дубликатов очищается только в этом процессе: другие воркеры,
+        проверившие событие, пока запись была в Redis, считают его дубликатом до
+        истечения своей записи кэша.
+        """
+        shard_positions: Dict[int, List[int]] = {}
+        for position, event_hash in enumerate(event_hashes):
+            if self.hot_cache is not None:
+                self.hot_cache.discard(event_hash)
+            shard = self._get_shard_index(event_hash) if self.redis_pool else 0
+            shard_positions.setdefault(shard, []).append(position)
+        
+        async def forget_on_shard(shard: int, positions: List[int]):
+            pipe = (self.redis_pool[shard] if self.redis_pool else self.redis).pipeline(transaction=False)
+            command_count = sum(
+                self.storage.queue_forget(pipe, event_hashes[position], events[position]) for position in positions
+            )
+            if command_count:
+                await pipe.execute()
+        
+        await asyncio.gather(*(forget_on_shard(shard, positions) for shard, positions in shard_positions.items()))
+
+    def _lookup_shards(self, event_hash: str, event: Dict[str, Any]) -> Set[int]:
+        """Шарды, где запись о событии может лежать помимо шарда текущей раскладки.
+
+        Во время решардинга это шард старой раскладки, пока миграция не перенесла
+        ключ. При чтении ключей хеша v1 после перехода на v2 - шард, выбранный
+        по хешу v1: старые ключи маршрутизировались по нему.
+        """
+        shards = set()
+        previous_shard = self.router.previous_shard(event_hash)
+        if previous_shard is not None:
+            shards.add(previous_shard)
+        if self.codec.legacy_read and self.codec.hash_version != 1:
+            legacy_hash = self.codec.legacy_hash(event_hash, event)
+            shards.add(self.router.shard(legacy_hash))
+            previous_shard = self.router.previous_shard(legacy_hash)
+            if previous_shard is not None:
+                shards.add(previous_shard)
+        return shards
+
+    async def _check_on_shard(self, redis_client, event_hashes: List[str], events: List[Dict[str, Any]],
+                              maybe_seen: List[bool], value) -> List[Tuple[bool, Optional[bytes]]]:
+        """Проверяет и записывает хеши одного шарда за один round trip."""
+        storage = self.storage
+        pipe = redis_client.pipeline(transaction=False)
+        command_counts = [
+            storage.queue_check(pipe, event_hash, event, value, seen)
+            for event_hash, event, seen in zip(event_hashes, events, maybe_seen)
+        ]
+        replies = await pipe.execute()
+        
+        outcomes = []
+        foreign = []
+        offset = 0
+        for index, (event, seen, count) in enumerate(zip(events, maybe_seen, command_counts)):
+            outcome = storage.parse_check(replies[offset:offset + count], event, seen)
+            offset += count
+            if outcome is None:
+                # Запись уже сделана другим процессом: дочитываем исходную метку ниже
+                foreign.append(index)
+            outcomes.append(outcome)
+        
+        if foreign:
+            lookups = await self._lookup_on_shard(
+                redis_client,
+                [event_hashes[index] for index in foreign],
+                [events[index] for index in foreign]
+            )
+            for index, (_, original_timestamp) in zip(foreign, lookups):
+                outcomes[index] = (True, original_timestamp)
+        
+        return outcomes
+
+    async def _lookup_on_shard(self, redis_client, event_hashes: List[str],
+                               events: List[Dict[str, Any]]) -> List[Tuple[bool, Optional[bytes]]]:
+        """Читает записи о событиях без записи (found, исходное значение) за один round trip."""
+        storage = self.storage
+        pipe = redis_client.pipeline(transaction=False)
+        command_counts = [
+            storage.queue_lookup(pipe, event_hash, event)
+            for event_hash, event in zip(event_hashes, events)
+        ]
+        replies = await pipe.execute()
+        
+        lookups = []
+        offset = 0
+        for event, count in zip(events, command_counts):
+            lookups.append(storage.parse_lookup(replies[offset:offset + count], event))
+            offset += count
+        return lookups
+
+    def _build_result(self, event_hash: str, is_duplicate: bool, original_timestamp: Optional[bytes]) -> DedupResult:
+        return DedupResult(
+            is_duplicate=is_duplicate,
+            event_hash=event_hash,
+            original_timestamp=self.codec.decode_timestamp(original_timestamp)
+        )
+
+    async def _remember(self, event_hash: str, maybe_seen: bool, is_duplicate: bool) -> None:
+        if self.bloom_filter is None:
+            return
+        self.bloom_filter.record_outcome(maybe_seen, is_duplicate)
+        if not maybe_seen:
+            await self.store_bloom_filter(event_hash)
 
     async def store_bloom_filter(self, event_hash: str) -> None:
-        pass
+        if self.bloom_filter is not None:
+            self.bloom_filter.add(event_hash)
 
     async def check_bloom_filter(self, event_hash: str) -> bool:
-        return False
\ No newline at end of file
+        """Возвращает False, только если событие точно не встречалось фильтру."""
+        if self.bloom_filter is None:
+            return True
+        return self.bloom_filter.might_contain(event_hash)
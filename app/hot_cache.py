@@ -0,0 +1,95 @@
+import sys
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+
+class HotDuplicateCache:
+    """Локальный кэш недавно виденных хешей событий с вытеснением LRU + TTL.
+
+    Хеш попадает в кэш только после ответа Redis, поэтому попадание в кэш
+    означает, что запись о событии в Redis уже есть: повтор признается
+    дубликатом без обращения к Redis. Размер ограничен числом записей и
+    оценкой занимаемой памяти; TTL записи должен быть меньше TTL дедупликации.
+    """
+
+    # Оценка накладных расходов на запись: узел OrderedDict, кортеж значения, float
+    ENTRY_OVERHEAD_BYTES = 200
+
+    def __init__(self, max_entries: int = 100_000, max_memory_bytes: int = 64 * 1024 * 1024,
+                 ttl_seconds: float = 600):
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, Optional[bytes]]]" = OrderedDict()
+        self.memory_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _entry_size(self, event_hash: str, original_timestamp: Optional[bytes]) -> int:
+        size = sys.getsizeof(event_hash) + self.ENTRY_OVERHEAD_BYTES
+        if original_timestamp is not None:
+            size += sys.getsizeof(original_timestamp)
+        return size
+
+    def _remove(self, event_hash: str) -> None:
+        _, original_timestamp = self._entries.pop(event_hash)
+        self.memory_bytes -= self._entry_size(event_hash, original_timestamp)
+
+    def lookup(self, event_hash: str) -> Tuple[bool, Optional[bytes]]:
+        """Возвращает (найдено, исходное значение) и продлевает запись в порядке LRU."""
+        entry = self._entries.get(event_hash)
+        if entry is None:
+            self.misses += 1
+            return False, None
+
+        expires_at, original_timestamp = entry
+        if expires_at <= time.monotonic():
+            self._remove(event_hash)
+            self.expirations += 1
+            self.misses += 1
+            return False, None
+
+        self._entries.move_to_end(event_hash)
+        self.hits += 1
+        return True, original_timestamp
+
+    def add(self, event_hash: str, original_timestamp: Optional[bytes]) -> None:
+        if event_hash in self._entries:
+            self._remove(event_hash)
+        self._entries[event_hash] = (time.monotonic() + self.ttl_seconds, original_timestamp)
+        self.memory_bytes += self._entry_size(event_hash, original_timestamp)
+
+        while self._entries and (len(self._entries) > self.max_entries or self.memory_bytes > self.max_memory_bytes):
+            oldest_hash = next(iter(self._entries))
+            expires_at, _ = self._entries[oldest_hash]
+            self._remove(oldest_hash)
+            if expires_at <= time.monotonic():
+                self.expirations += 1
+            else:
+                self.evictions += 1
+
+    def discard(self, event_hash: str) -> None:
+        if event_hash in self._entries:
+            self._remove(event_hash)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "max_entries": self.max_entries,
+            "max_memory_bytes": self.max_memory_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "entries": len(self._entries),
+            "memory_bytes": self.memory_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -17,6 +17,13 @@ from app.services.redis_service import RedisService
 from app.services.kafka_service import KafkaService
 from app.services.postgres_service import PostgresService
 from app.consumers.event_consumer import EventConsumer
+from app.batch_writer import AdaptiveBatchController
+from app.dead_letter import DeadLetterSink
+from app.bloom import RotatingBloomFilter, SharedRotatingBloomFilter
+from app.hot_cache import HotDuplicateCache
+from app.single_flight import SingleFlight
+from app.batcher import DedupBatcher
+from app.sharding import ShardAffinityPartitioner
 
 
 logger.add("logs/app.log", rotation="10 MB", level="INFO", backtrace=True, diagnose=True)
@@ -56,6 +63,13 @@ redis_service = RedisService()
 kafka_service = KafkaService()
 postgres_service = PostgresService()
 event_consumer = None
+consumer_task = None
+migration_task = None
+# Фоновое создание топиков Kafka: ссылки держим, чтобы задачи не собрал сборщик мусора
+topic_tasks = []
+
+# Сколько ждать, пока консьюмер доработает взятые сообщения и допишет буферы в PostgreSQL
+CONSUMER_SHUTDOWN_TIMEOUT = 10
 
 
 @app.middleware("http")
@@ -89,9 +103,10 @@ else:
 
 async def create_kafka_topic(bootstrap_servers, topic_name, num_partitions=1, replication_factor=1):
     """Создает топик в Kafka, если он не существует."""
-    from kafka.admin import KafkaAdminClient, NewTopic
-    from kafka.errors import TopicAlreadyExistsError
+    from kafka.admin import KafkaAdminClient, NewTopic, NewPartitions
+    from kafka.errors import TopicAlreadyExistsError, InvalidPartitionsError
     
+    admin_client = None
     try:
         admin_client = KafkaAdminClient(
             bootstrap_servers=bootstrap_servers,
@@ -111,19 +126,29 @@ async def create_kafka_topic(bootstrap_servers, topic_name, num_partitions=1, re
         logger.info(f"Successfully created Kafka topic: {topic_name}")
     except TopicAlreadyExistsError:
         logger.info(f"Kafka topic {topic_name} already exists")
+        try:
+            # Число партиций можно только увеличить
+            admin_client.create_partitions({topic_name: NewPartitions(total_count=num_partitions)})
+            logger.info(f"Increased Kafka topic {topic_name} to {num_partitions} partitions")
+        except InvalidPartitionsError:
+            # Партиций уже не меньше запрошенного
+            pass
+        except Exception as e:
+            logger.warning(f"Error increasing partitions of Kafka topic {topic_name}: {str(e)}")
     except Exception as e:
         logger.warning(f"Error creating Kafka topic {topic_name}: {str(e)}")
     finally:
-        try:
-            admin_client.close()
-        except Exception:
-            pass
+        if admin_client is not None:
+            try:
+                admin_client.close()
+            except Exception:
+                pass
 
 
 @app.on_event("startup")
 async def startup_event():
     """Инициализация при запуске приложения."""
-    global event_consumer
+    global event_consumer, consumer_task, migration_task
     
     redis_host = os.getenv("REDIS_HOST", "localhost")
     redis_port = int(os.getenv("REDIS_PORT", "6379"))
@@ -131,10 +156,67 @@ async def startup_event():
     redis_password = os.getenv("REDIS_PASSWORD")
     redis_shard_count = int(os.getenv("REDIS_SHARD_COUNT", "4"))
     redis_hosts = os.getenv("REDIS_HOSTS", "")
+    redis_shard_router = os.getenv("REDIS_SHARD_ROUTER", "modulo")
+    redis_reshard_from = os.getenv("REDIS_RESHARD_FROM", "")
+    redis_cluster_nodes = os.getenv("REDIS_CLUSTER_NODES", "")
+    redis_cluster_retry_attempts = int(os.getenv("REDIS_CLUSTER_RETRY_ATTEMPTS", "10"))
+    redis_pool_options = {
+        "max_connections": int(os.getenv("REDIS_POOL_SIZE", "128")),
+        "timeout": float(os.getenv("REDIS_POOL_TIMEOUT", "5")),
+        "socket_timeout": float(os.getenv("REDIS_SOCKET_TIMEOUT", "5")),
+        "socket_connect_timeout": float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "2")),
+        "health_check_interval": int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30")),
+    }
+    redis_key_encoding = os.getenv("DEDUP_KEY_ENCODING", "legacy")
+    redis_legacy_read = os.getenv("DEDUP_LEGACY_READ", "true").lower() == "true"
+    redis_hash_version = int(os.getenv("DEDUP_HASH_VERSION", "1"))
+    redis_storage_engine = os.getenv("DEDUP_STORAGE", "keys")
+    redis_bucket_prefix_chars = int(os.getenv("DEDUP_BUCKET_PREFIX_CHARS", "3"))
+    probabilistic_events = [
+        e.strip() for e in os.getenv("DEDUP_PROBABILISTIC_EVENTS", "").split(",") if e.strip()
+    ]
+    bitmap_options = {
+        "expected_items": int(os.getenv("DEDUP_BITMAP_EXPECTED_EVENTS", "10000000")),
+        "fp_rate": float(os.getenv("DEDUP_BITMAP_FP_RATE", "0.001")),
+        "partitions": int(os.getenv("DEDUP_BITMAP_PARTITIONS", "16")),
+    }
+    
+    bloom_enabled = os.getenv("BLOOM_FILTER_ENABLED", "false").lower() == "true"
+    bloom_expected_events = int(os.getenv("BLOOM_EXPECTED_EVENTS", "10000000"))
+    bloom_fp_rate = float(os.getenv("BLOOM_FP_RATE", "0.01"))
+    bloom_shm_path = os.getenv("BLOOM_SHM_PATH", "")
+    
+    hot_cache_enabled = os.getenv("HOT_CACHE_ENABLED", "false").lower() == "true"
+    hot_cache_max_entries = int(os.getenv("HOT_CACHE_MAX_ENTRIES", "100000"))
+    hot_cache_max_memory_mb = int(os.getenv("HOT_CACHE_MAX_MEMORY_MB", "64"))
+    hot_cache_ttl = int(os.getenv("HOT_CACHE_TTL_SECONDS", "600"))
+    single_flight_enabled = os.getenv("DEDUP_SINGLE_FLIGHT", "true").lower() == "true"
+    micro_batch_enabled = os.getenv("DEDUP_MICRO_BATCH", "false").lower() == "true"
+    micro_batch_window_ms = float(os.getenv("DEDUP_BATCH_WINDOW_MS", "1"))
+    micro_batch_max_size = int(os.getenv("DEDUP_BATCH_MAX_SIZE", "256"))
+    events.batch_max_events = int(os.getenv("BATCH_MAX_EVENTS", "1000"))
+    events.batch_max_bytes = int(os.getenv("BATCH_MAX_BYTES", "4194304"))
+    write_path_mode = os.getenv("WRITE_PATH_MODE", "api").lower()
+    if write_path_mode not in ("api", "consumer"):
+        raise ValueError(f"Unknown write path mode: {write_path_mode}")
+    events.write_path_mode = write_path_mode
+    logger.info(f"Write path mode: {write_path_mode}")
     
     kafka_bootstrap_servers = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "localhost:9092")
     kafka_topic = os.getenv("KAFKA_TOPIC", "product-events")
     kafka_group_id = os.getenv("KAFKA_GROUP_ID", "event-deduplicator")
+    kafka_acks = os.getenv("KAFKA_ACKS", "all")
+    kafka_producer_batched = os.getenv("KAFKA_PRODUCER_MODE", "sync").lower() == "batched"
+    kafka_linger_ms = int(os.getenv("KAFKA_LINGER_MS", "5"))
+    kafka_max_batch_size = int(os.getenv("KAFKA_MAX_BATCH_SIZE", "131072"))
+    kafka_compression = os.getenv("KAFKA_COMPRESSION", "lz4").lower()
+    kafka_max_in_flight = int(os.getenv("KAFKA_MAX_IN_FLIGHT", "10000"))
+    kafka_topic_partitions = int(os.getenv("KAFKA_TOPIC_PARTITIONS", "1"))
+    kafka_partition_affinity = os.getenv("KAFKA_PARTITION_AFFINITY", "none").lower()
+    kafka_consumer_mode = os.getenv("KAFKA_CONSUMER_MODE", "stream").lower()
+    kafka_fetch_max_records = int(os.getenv("KAFKA_FETCH_MAX_RECORDS", "500"))
+    kafka_fetch_timeout_ms = int(os.getenv("KAFKA_FETCH_TIMEOUT_MS", "100"))
+    kafka_consumer_queue_size = int(os.getenv("KAFKA_CONSUMER_QUEUE_SIZE", "0"))
     
     pg_host = os.getenv("PG_HOST", "localhost")
     pg_port = int(os.getenv("PG_PORT", "5432"))
@@ -143,7 +225,21 @@ async def startup_event():
     pg_database = os.getenv("PG_DATABASE", "postgres")
     pg_hosts = os.getenv("PG_HOSTS", "")
     pg_shard_count = int(os.getenv("PG_SHARD_COUNT", "1"))
+    pg_shard_router = os.getenv("PG_SHARD_ROUTER", "modulo")
+    pg_batch_size = int(os.getenv("PG_BATCH_SIZE", "250"))
+    pg_batch_max_age_ms = int(os.getenv("PG_BATCH_MAX_AGE_MS", "1000"))
+    pg_batch_max_bytes = int(os.getenv("PG_BATCH_MAX_BYTES", "1048576"))
+    pg_max_flushes_per_shard = int(os.getenv("PG_MAX_FLUSHES_PER_SHARD", "2"))
+    pg_max_pending_batches = int(os.getenv("PG_MAX_PENDING_BATCHES", "16"))
+    pg_batch_adaptive = os.getenv("PG_BATCH_ADAPTIVE", "false").lower() == "true"
+    pg_batch_min_size = int(os.getenv("PG_BATCH_MIN_SIZE", "10"))
+    pg_batch_max_size = int(os.getenv("PG_BATCH_MAX_SIZE", "5000"))
+    pg_batch_min_age_ms = int(os.getenv("PG_BATCH_MIN_AGE_MS", "50"))
+    pg_batch_target_latency_ms = int(os.getenv("PG_BATCH_TARGET_LATENCY_MS", "100"))
+    pg_dead_letter_topic = os.getenv("PG_DEAD_LETTER_TOPIC", "product-events-dlq")
+    pg_dead_letter_spool = os.getenv("PG_DEAD_LETTER_SPOOL", "dead-letter.ndjson")
     
+    redis_cluster_node_list = [h.strip() for h in redis_cluster_nodes.split(",") if h.strip()]
     redis_host_list = None
     if redis_hosts:
         redis_host_list = [h.strip() for h in redis_hosts.split(",") if h.strip()]
@@ -157,11 +253,72 @@ async def startup_event():
             password=redis_password,
             ttl_days=7,
             shard_count=redis_shard_count,
-            hosts=redis_host_list
+            hosts=redis_host_list,
+            key_encoding=redis_key_encoding,
+            legacy_read=redis_legacy_read,
+            hash_version=redis_hash_version,
+            storage_engine=redis_storage_engine,
+            bucket_prefix_chars=redis_bucket_prefix_chars,
+            probabilistic_events=probabilistic_events,
+            bitmap_options=bitmap_options,
+            shard_router=redis_shard_router,
+            reshard_from=redis_reshard_from or None,
+            cluster_nodes=redis_cluster_node_list,
+            cluster_retry_attempts=redis_cluster_retry_attempts,
+            pool_options=redis_pool_options
         )
         
         events.redis_service = redis_service
+        if redis_service.migrator is not None:
+            migration_task = asyncio.create_task(redis_service.migrate_shards())
         logger.info(f"Redis service initialized with {redis_service.get_connection_count()} connections")
+        
+        if bloom_enabled and bloom_shm_path:
+            # Общий для всех воркеров сегмент: дубликат, увиденный одним воркером, виден остальным
+            events.bloom_filter = SharedRotatingBloomFilter(
+                expected_items=bloom_expected_events,
+                fp_rate=bloom_fp_rate,
+                window_seconds=redis_service.ttl_seconds,
+                path=bloom_shm_path
+            )
+        elif bloom_enabled:
+            events.bloom_filter = RotatingBloomFilter(
+                expected_items=bloom_expected_events,
+                fp_rate=bloom_fp_rate,
+                window_seconds=redis_service.ttl_seconds
+            )
+        
+        if events.bloom_filter is not None:
+            logger.info(
+                f"Bloom prefilter enabled: {events.bloom_filter.size_bits} bits, "
+                f"{events.bloom_filter.hash_count} hashes, {events.bloom_filter.memory_bytes / 1024 / 1024:.1f} MB"
+            )
+        
+        if hot_cache_enabled:
+            # TTL кэша не может превышать TTL записи в Redis
+            events.hot_cache = HotDuplicateCache(
+                max_entries=hot_cache_max_entries,
+                max_memory_bytes=hot_cache_max_memory_mb * 1024 * 1024,
+                ttl_seconds=min(hot_cache_ttl, redis_service.ttl_seconds)
+            )
+            logger.info(
+                f"Hot duplicate cache enabled: {hot_cache_max_entries} entries, "
+                f"{hot_cache_max_memory_mb} MB, TTL {events.hot_cache.ttl_seconds}s"
+            )
+        
+        if single_flight_enabled:
+            events.single_flight = SingleFlight()
+        
+        # Один дедупликатор на процесс: запросы не создают его заново
+        events.deduplicator = events.create_deduplicator(redis_service)
+        
+        if micro_batch_enabled:
+            events.dedup_batcher = DedupBatcher(
+                events.deduplicator,
+                max_batch_size=micro_batch_max_size,
+                max_delay=micro_batch_window_ms / 1000
+            )
+            logger.info(f"Micro-batching enabled: window {micro_batch_window_ms} ms, max {micro_batch_max_size} events")
     except Exception as e:
         logger.error(f"Failed to connect to Redis: {str(e)}")
         raise
@@ -179,7 +336,8 @@ async def startup_event():
             password=pg_password,
             database=pg_database,
             hosts=pg_host_list,
-            shard_count=pg_shard_count
+            shard_count=pg_shard_count,
+            shard_router=pg_shard_router
         )
         
         events.postgres_service = postgres_service
@@ -189,16 +347,34 @@ async def startup_event():
         raise
     
     try:
-        asyncio.create_task(create_kafka_topic(
+        topic_tasks.append(asyncio.create_task(create_kafka_topic(
             kafka_bootstrap_servers,
-            kafka_topic
-        ))
+            kafka_topic,
+            num_partitions=kafka_topic_partitions
+        )))
+        if pg_dead_letter_topic:
+            topic_tasks.append(asyncio.create_task(create_kafka_topic(kafka_bootstrap_servers, pg_dead_letter_topic)))
     except Exception as e:
         logger.warning(f"Could not create Kafka topic: {str(e)}")
     
+    partitioner = None
+    if kafka_partition_affinity == "redis" and not redis_service.cluster_mode:
+        partitioner = ShardAffinityPartitioner(redis_service.router)
+    elif kafka_partition_affinity == "postgres":
+        partitioner = ShardAffinityPartitioner(postgres_service.router)
+    elif kafka_partition_affinity != "none":
+        logger.warning(f"Kafka partition affinity {kafka_partition_affinity} is not available, using default partitioner")
+    
     try:
         await kafka_service.connect_producer(
-            bootstrap_servers=kafka_bootstrap_servers
+            bootstrap_servers=kafka_bootstrap_servers,
+            acks=int(kafka_acks) if kafka_acks.isdigit() else kafka_acks,
+            batched=kafka_producer_batched,
+            linger_ms=kafka_linger_ms,
+            max_batch_size=kafka_max_batch_size,
+            compression_type=None if kafka_compression == "none" else kafka_compression,
+            max_in_flight=kafka_max_in_flight,
+            partitioner=partitioner
         )
         
         events.kafka_service = kafka_service
@@ -207,16 +383,47 @@ async def startup_event():
         return
     
     try:
-        event_consumer = EventConsumer(kafka_service, redis_service, postgres_service)
+        batch_controller = None
+        if pg_batch_adaptive:
+            batch_controller = AdaptiveBatchController(
+                initial_size=pg_batch_size,
+                min_size=pg_batch_min_size,
+                max_size=pg_batch_max_size,
+                initial_linger=pg_batch_max_age_ms / 1000,
+                min_linger=pg_batch_min_age_ms / 1000,
+                max_linger=pg_batch_max_age_ms / 1000,
+                target_latency=pg_batch_target_latency_ms / 1000
+            )
+            logger.info(f"Adaptive PostgreSQL batching enabled: {pg_batch_min_size}-{pg_batch_max_size} events, "
+                        f"{pg_batch_min_age_ms}-{pg_batch_max_age_ms} ms, target latency {pg_batch_target_latency_ms} ms")
+        
+        event_consumer = EventConsumer(
+            kafka_service, redis_service, postgres_service,
+            trust_dedup_hash=write_path_mode == "consumer",
+            writer_options={
+                "max_batch_size": pg_batch_size,
+                "max_batch_age": pg_batch_max_age_ms / 1000,
+                "max_batch_bytes": pg_batch_max_bytes,
+                "max_flushes_per_shard": pg_max_flushes_per_shard,
+                "max_pending_batches": pg_max_pending_batches,
+                "controller": batch_controller,
+                "dead_letter": DeadLetterSink(kafka_service, pg_dead_letter_topic or None, pg_dead_letter_spool or None),
+            }
+        )
+        events.batch_writer = event_consumer.writer
         
         max_concurrency = int(os.getenv("MAX_CONCURRENCY", "500"))
         
-        asyncio.create_task(
+        consumer_task = asyncio.create_task(
             event_consumer.start(
                 topic=kafka_topic,
                 group_id=kafka_group_id,
                 bootstrap_servers=kafka_bootstrap_servers,
-                max_concurrency=max_concurrency
+                max_concurrency=max_concurrency,
+                consumer_mode=kafka_consumer_mode,
+                fetch_max_records=kafka_fetch_max_records,
+                fetch_timeout_ms=kafka_fetch_timeout_ms,
+                queue_size=kafka_consumer_queue_size
             )
         )
     except Exception as e:
@@ -228,6 +435,22 @@ async def shutdown_event():
     """Очистка ресурсов при завершении приложения."""
     if event_consumer:
         await event_consumer.stop()
+    if consumer_task is not None:
+        # Консьюмер закрывает BatchWriter в своем finally: сервисы отключаются только после записи буферов.
+        # Цикл чтения ждет следующего сообщения, поэтому на простаивающем топике задача отменяется по таймауту
+        done, _ = await asyncio.wait({consumer_task}, timeout=CONSUMER_SHUTDOWN_TIMEOUT)
+        if not done:
+            consumer_task.cancel()
+        await asyncio.gather(consumer_task, return_exceptions=True)
+    if events.dedup_batcher is not None:
+        await events.dedup_batcher.close()
+    for task in topic_tasks:
+        task.cancel()
+    await asyncio.gather(*topic_tasks, return_exceptions=True)
+    if migration_task is not None and not migration_task.done():
+        # После перезапуска миграция начнется заново: копии, оставшиеся на источнике, перенесутся повторно
+        migration_task.cancel()
+        await asyncio.gather(migration_task, return_exceptions=True)
     
     await kafka_service.disconnect_producer()
     await redis_service.disconnect()
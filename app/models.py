@@ -46,4 +46,13 @@ class EventProcessingResponse(BaseModel):
     status: str = Field(description="Статус обработки: accepted, rejected, error")
     is_duplicate: bool = Field(description="Является ли событие дубликатом")
     message: str = Field(description="Описательное сообщение")
-    event_hash: Optional[str] = Field(default=None, description="Хеш события (если был вычислен)") 
\ No newline at end of file
+    event_hash: Optional[str] = Field(default=None, description="Хеш события (если был вычислен)")
+
+
+class BatchProcessingResponse(BaseModel):
+    """Ответ API на обработку пакета событий."""
+    statuses: str = Field(description="Статус каждого события по порядку: A - принято, D - дубликат, I - невалидно")
+    hashes: List[Optional[str]] = Field(description="Хеши событий по порядку (null для невалидных)")
+    accepted: int = Field(description="Количество принятых событий")
+    duplicates: int = Field(description="Количество дубликатов")
+    invalid: int = Field(description="Количество невалидных событий")
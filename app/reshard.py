@@ -0,0 +1,220 @@
+import asyncio
+import os
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, Any, List, Optional, Tuple
+
+from loguru import logger
+
+from app.dedup_codec import DedupKeyCodec
+from app.dedup_storage import BucketStorage, BitmapStorage
+from app.sharding import ReshardRouter
+
+
+class ShardMigrator:
+    """Фоновый перенос записей дедупликации из старой раскладки шардов в новую.
+
+    Ключи старых шардов обходятся через SCAN. Строковые ключи переносятся через
+    DUMP + PTTL на источнике и RESTORE ... REPLACE на новом шарде (значение и
+    оставшийся TTL сохраняются), затем удаляются на источнике. Записи в бакетах
+    маршрутизируются по отдельности: поле бакета - это дайджест события.
+    Битовые фильтры (bf:) не переносятся - они истекают вместе с окном.
+
+    Все команды идут пакетами через pipeline. Пока миграция идет, Deduplicator
+    читает обе раскладки, поэтому гарантия дедупликации не теряется.
+    Блокировка в Redis не дает нескольким воркерам переносить ключи одновременно;
+    продлевает и снимает ее только владелец (сравнение в Lua-скрипте).
+
+    Источник удаляется не сразу после RESTORE, а через delete_grace секунд.
+    Проверка пишет SET NX в новый шард и читает старый параллельно: если бы ключ
+    удалялся сразу, проверка, успевшая записать в новый шард до RESTORE, но
+    прочитавшая старый уже после DEL, приняла бы дубликат. Пока копия на источнике
+    жива, такую проверку находит чтение старого шарда; проверки, начатые позже
+    чем через delete_grace после RESTORE, видят ключ уже в новом шарде.
+    """
+
+    LOCK_KEY = "reshard:lock"
+    LOCK_TTL = 60
+    RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+    EXTEND_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+    def __init__(self, clients: List[Any], router: ReshardRouter, codec: DedupKeyCodec,
+                 key_patterns: List[Any], batch_size: int = 500, delete_grace: float = 10.0):
+        self.clients = clients
+        self.router = router
+        self.codec = codec
+        patterns = [pattern.encode() if isinstance(pattern, str) else pattern for pattern in key_patterns]
+        self.key_patterns = [pattern for pattern in patterns if not pattern.startswith(BitmapStorage.PREFIX.encode())]
+        self.batch_size = batch_size
+        self.delete_grace = delete_grace
+        self.lock_owner = f"{os.getpid()}-{time.time()}"
+        self._release_lock = clients[0].register_script(self.RELEASE_LOCK_SCRIPT)
+        self._extend_lock = clients[0].register_script(self.EXTEND_LOCK_SCRIPT)
+        # (когда удалять, шард-источник, бакет или None, ключи или поля бакета)
+        self._deferred: Deque[Tuple[float, int, Optional[bytes], List[bytes]]] = deque()
+
+        self.running = False
+        self.finished = False
+        self.scanned = 0
+        self.moved = 0
+        self.errors = 0
+
+    def _endpoint(self, client) -> tuple:
+        kwargs = client.connection_pool.connection_kwargs
+        return kwargs.get("host"), kwargs.get("port"), kwargs.get("db", 0)
+
+    async def run(self) -> None:
+        """Переносит все записи; безопасно запускать из каждого воркера."""
+        lock_client = self.clients[0]
+        if not await lock_client.set(self.LOCK_KEY, self.lock_owner, nx=True, ex=self.LOCK_TTL):
+            logger.info("Reshard migration is already running in another process")
+            return
+
+        self.running = True
+        started = time.time()
+        logger.info(f"Starting reshard migration {self.router.name}")
+        try:
+            for shard in range(self.router.previous_router.shard_count):
+                await self._migrate_shard(shard)
+            await self._delete_moved(wait=True)
+            self.finished = True
+            logger.info(
+                f"Reshard migration finished in {time.time() - started:.1f}s: "
+                f"scanned {self.scanned}, moved {self.moved}, errors {self.errors}"
+            )
+        except Exception as e:
+            logger.error(f"Reshard migration failed: {str(e)}")
+            raise
+        finally:
+            self.running = False
+            # Блокировка могла истечь и достаться другому воркеру: его блокировку не трогаем
+            await self._release_lock(keys=[self.LOCK_KEY], args=[self.lock_owner])
+
+    async def _migrate_shard(self, shard: int) -> None:
+        source = self.clients[shard]
+        for pattern in self.key_patterns:
+            batch = []
+            async for key in source.scan_iter(match=pattern, count=self.batch_size):
+                batch.append(key)
+                if len(batch) >= self.batch_size:
+                    await self._migrate_batch(shard, batch)
+                    batch = []
+            if batch:
+                await self._migrate_batch(shard, batch)
+
+    async def _migrate_batch(self, shard: int, keys: List[bytes]) -> None:
+        self.scanned += len(keys)
+        if not await self._extend_lock(keys=[self.LOCK_KEY], args=[self.lock_owner, self.LOCK_TTL]):
+            raise RuntimeError("Reshard lock was lost, another process may be migrating")
+        await self._delete_moved()
+
+        string_moves: Dict[int, List[bytes]] = defaultdict(list)
+        for key in keys:
+            if key.startswith(BucketStorage.PREFIX.encode()):
+                await self._migrate_bucket(shard, key)
+                continue
+            event_hash = self.codec.key_hash(key)
+            if event_hash is None:
+                continue
+            target = self.router.shard(event_hash)
+            if target != shard:
+                string_moves[target].append(key)
+
+        for target, target_keys in string_moves.items():
+            await self._move_keys(shard, target, target_keys)
+
+    async def _move_keys(self, shard: int, target: int, keys: List[bytes]) -> None:
+        source = self.clients[shard]
+        destination = self.clients[target]
+        if self._endpoint(source) == self._endpoint(destination):
+            # Шарды на одном и том же Redis: переносить нечего
+            return
+
+        pipe = source.pipeline(transaction=False)
+        for key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        replies = await pipe.execute()
+
+        restored = []
+        pipe = destination.pipeline(transaction=False)
+        for index, key in enumerate(keys):
+            payload, ttl = replies[2 * index], replies[2 * index + 1]
+            if payload is None or ttl == -2:
+                # Ключ истек между SCAN и DUMP
+                continue
+            # Исходная запись старше, поэтому заменяет запись, сделанную после начала решардинга
+            pipe.restore(key, max(ttl, 0), payload, replace=True)
+            restored.append(key)
+        if not restored:
+            return
+
+        results = await pipe.execute(raise_on_error=False)
+        moved = [key for key, result in zip(restored, results) if not isinstance(result, Exception)]
+        self.errors += len(restored) - len(moved)
+        if moved:
+            self._deferred.append((time.monotonic() + self.delete_grace, shard, None, moved))
+            self.moved += len(moved)
+
+    async def _migrate_bucket(self, shard: int, bucket: bytes) -> None:
+        source = self.clients[shard]
+        ttl = await source.pttl(bucket)
+        if ttl == -2:
+            return
+
+        fields_by_target: Dict[int, Dict[bytes, bytes]] = defaultdict(dict)
+        async for field, value in source.hscan_iter(bucket, count=self.batch_size):
+            target = self.router.shard(field.hex())
+            if target != shard:
+                fields_by_target[target][field] = value
+
+        for target, fields in fields_by_target.items():
+            destination = self.clients[target]
+            if self._endpoint(source) == self._endpoint(destination):
+                continue
+            pipe = destination.pipeline(transaction=False)
+            pipe.hset(bucket, mapping=fields)
+            if ttl > 0:
+                pipe.pexpire(bucket, ttl, nx=True)
+            await pipe.execute()
+            self._deferred.append((time.monotonic() + self.delete_grace, shard, bucket, list(fields)))
+            self.moved += len(fields)
+
+    async def _delete_moved(self, wait: bool = False) -> None:
+        """Удаляет на источниках перенесенные записи, чей delete_grace истек.
+
+        wait=True дожидается всех отложенных удалений (конец миграции).
+        """
+        while self._deferred:
+            delete_at, shard, bucket, items = self._deferred[0]
+            delay = delete_at - time.monotonic()
+            if delay > 0:
+                if not wait:
+                    return
+                await asyncio.sleep(delay)
+            self._deferred.popleft()
+            if bucket is None:
+                await self.clients[shard].delete(*items)
+            else:
+                await self.clients[shard].hdel(bucket, *items)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "layout": self.router.name,
+            "running": self.running,
+            "finished": self.finished,
+            "scanned": self.scanned,
+            "moved": self.moved,
+            "errors": self.errors,
+            "pending_deletes": sum(len(items) for _, _, _, items in self._deferred),
+        }
@@ -1,13 +1,96 @@
 import os
-import json
-from typing import Dict, Any, List, Optional, Callable
+import functools
+from typing import Dict, Any, List, Optional, Callable, Union, Set, Tuple
 import asyncio
 import time
 
-from aiokafka import AIOKafkaProducer, AIOKafkaConsumer
+import orjson
+from aiokafka import AIOKafkaProducer, AIOKafkaConsumer, TopicPartition
+from aiokafka.abc import ConsumerRebalanceListener
 from aiokafka.errors import KafkaError
 from loguru import logger
 
+try:
+    from aiokafka.codec import has_gzip, has_lz4, has_snappy, has_zstd
+except ImportError:  # aiokafka < 0.8 использует кодеки kafka-python
+    from kafka.codec import has_gzip, has_lz4, has_snappy, has_zstd
+
+COMPRESSION_CODECS = {"gzip": has_gzip, "lz4": has_lz4, "snappy": has_snappy, "zstd": has_zstd}
+
+
+def _serialize_value(value: Union[Dict[str, Any], bytes]) -> bytes:
+    # Готовые байты (быстрый маршрут /event/raw) отправляются без повторной сериализации
+    return value if isinstance(value, bytes) else orjson.dumps(value)
+
+
+def _serialize_key(key: Optional[str]) -> Optional[bytes]:
+    return key.encode() if isinstance(key, str) else key
+
+
+class PartitionPipelines(ConsumerRebalanceListener):
+    """Независимый конвейер обработки на каждую назначенную консьюмеру партицию.
+
+    Конвейер партиции забирает сообщения только своей партиции (getmany) и
+    обрабатывает их с ограниченной конкурентностью, не дожидаясь остальных
+    партиций. При отзыве партиции ее конвейер дорабатывает текущую порцию.
+    """
+
+    def __init__(self, service: "KafkaService", consumer: AIOKafkaConsumer, callback: Callable,
+                 max_concurrency: int, max_records: int):
+        self.service = service
+        self.consumer = consumer
+        self.callback = callback
+        self.max_concurrency = max_concurrency
+        self.max_records = max_records
+        self.tasks: Dict[TopicPartition, asyncio.Task] = {}
+        self.processed: Dict[TopicPartition, int] = {}
+
+    async def on_partitions_revoked(self, revoked) -> None:
+        tasks = [self.tasks.pop(tp) for tp in revoked if tp in self.tasks]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def on_partitions_assigned(self, assigned) -> None:
+        for tp in assigned:
+            if tp not in self.tasks:
+                self.processed.setdefault(tp, 0)
+                self.tasks[tp] = asyncio.create_task(self._run_partition(tp))
+        logger.info(f"Kafka partitions assigned: {sorted(tp.partition for tp in self.tasks)}")
+
+    async def _run_partition(self, tp: TopicPartition) -> None:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        async def process_message(message):
+            async with semaphore:
+                try:
+                    await self.callback(message.value)
+                except Exception as e:
+                    logger.error(f"Error processing message: {str(e)}")
+        
+        while self.service.running and tp in self.tasks:
+            try:
+                records = await self.consumer.getmany(tp, timeout_ms=1000, max_records=self.max_records)
+            except Exception as e:
+                logger.error(f"Error fetching Kafka partition {tp.partition}: {str(e)}")
+                await asyncio.sleep(1.0)
+                continue
+            messages = records.get(tp)
+            if messages:
+                await asyncio.gather(*(process_message(message) for message in messages))
+                self.processed[tp] += len(messages)
+
+    async def stop(self) -> None:
+        tasks = list(self.tasks.values())
+        self.tasks.clear()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "assigned": sorted(tp.partition for tp in self.tasks),
+            "processed": {tp.partition: count for tp, count in self.processed.items()},
+        }
+
 
 class KafkaService:
     """Сервис для работы с Kafka."""
@@ -15,27 +98,89 @@ class KafkaService:
     def __init__(self):
         self.producer = None
         self.consumers = {}
+        self.partition_pipelines: Dict[str, PartitionPipelines] = {}
         self.running = False
+        
+        # Очередь между чтением и обработкой сообщений и пауза партиций при ее заполнении
+        self._work_queue: Optional[asyncio.Queue] = None
+        self._paused_since: Optional[float] = None
+        self.consumer_pauses = 0
+        self.consumer_paused_seconds = 0.0
+        
+        # Пакетный режим продюсера: отправка без ожидания подтверждения, подтверждения собираются колбэками
+        self.batched = False
+        self.max_in_flight = 0
+        self._in_flight: Optional[asyncio.Semaphore] = None
+        self._pending: Set[asyncio.Future] = set()
+        self._deliveries: List[Tuple[float, asyncio.Future]] = []
+        self._deliveries_scheduled = False
+        
+        self.delivered = 0
+        self.failed = 0
+        self.batches = 0
+        self.batch_latency_ms_total = 0.0
+        self.batch_latency_ms_max = 0.0
+        self.last_error: Optional[str] = None
     
     async def connect_producer(self, 
                               bootstrap_servers: str = "localhost:9092",
-                              acks: str = "all",
+                              acks: Union[str, int] = "all",
                               max_retries: int = 5,
-                              retry_backoff: float = 1.5) -> None:
-        """Устанавливает соединение для Producer Kafka."""
+                              retry_backoff: float = 1.5,
+                              batched: bool = False,
+                              linger_ms: int = 5,
+                              max_batch_size: int = 131072,
+                              compression_type: Optional[str] = "lz4",
+                              max_in_flight: int = 10000,
+                              partitioner: Optional[Callable] = None) -> None:
+        """Устанавливает соединение для Producer Kafka.
+
+        В пакетном режиме (batched) send_message не ждет подтверждения брокера:
+        сообщения копятся до linger_ms или max_batch_size байт на партицию и
+        сжимаются, подтверждения собираются в фоне. Неподтвержденных сообщений
+        не больше max_in_flight, при достижении лимита отправка ждет.
+        Без batched каждое сообщение ждет подтверждения (send_and_wait).
+        partitioner заменяет стандартный выбор партиции по ключу (см. ShardAffinityPartitioner).
+        """
         retry_count = 0
         retry_delay = 1.0
         
+        producer_options = {}
+        if partitioner is not None:
+            producer_options["partitioner"] = partitioner
+        if batched:
+            if compression_type and compression_type not in COMPRESSION_CODECS:
+                raise ValueError(f"Unknown Kafka compression: {compression_type}")
+            if compression_type and not COMPRESSION_CODECS[compression_type]():
+                logger.warning(f"Kafka compression {compression_type} is unavailable (codec library not installed), using gzip")
+                compression_type = "gzip"
+            producer_options.update(
+                linger_ms=linger_ms,
+                max_batch_size=max_batch_size,
+                compression_type=compression_type or None
+            )
+            self.batched = True
+            self.max_in_flight = max_in_flight
+            self._in_flight = asyncio.Semaphore(max_in_flight)
+        
         while retry_count < max_retries:
             try:
                 self.producer = AIOKafkaProducer(
                     bootstrap_servers=bootstrap_servers,
-                    value_serializer=lambda v: json.dumps(v).encode('utf-8'),
-                    acks=acks
+                    value_serializer=_serialize_value,
+                    # Ключ - хеш события: одно и то же событие всегда попадает в одну партицию
+                    key_serializer=_serialize_key,
+                    acks=acks,
+                    **producer_options
                 )
                 
                 await self.producer.start()
                 logger.info(f"Successfully connected Kafka producer to {bootstrap_servers}")
+                if batched:
+                    logger.info(
+                        f"Kafka producer in batched mode: linger {linger_ms} ms, batch {max_batch_size} bytes, "
+                        f"compression {compression_type}, max in flight {max_in_flight}"
+                    )
                 return
             except Exception as e:
                 retry_count += 1
@@ -47,9 +192,16 @@ class KafkaService:
                 await asyncio.sleep(retry_delay)
                 retry_delay *= retry_backoff
     
-    async def disconnect_producer(self) -> None:
-        """Закрывает соединение Producer с Kafka."""
+    async def disconnect_producer(self, timeout: float = 30.0) -> None:
+        """Закрывает соединение Producer с Kafka, дождавшись отправки накопленных сообщений."""
         if self.producer:
+            if self._pending:
+                logger.info(f"Flushing {len(self._pending)} Kafka messages before shutdown")
+                await self.producer.flush()
+                await asyncio.wait(list(self._pending), timeout=timeout)
+                self._record_deliveries()
+                if self._pending:
+                    logger.error(f"{len(self._pending)} Kafka messages were not acknowledged before shutdown")
             await self.producer.stop()
             logger.info("Kafka producer disconnected")
     
@@ -59,19 +211,24 @@ class KafkaService:
                                bootstrap_servers: str = "localhost:9092",
                                auto_offset_reset: str = "earliest",
                                max_retries: int = 5,
-                               retry_backoff: float = 1.5) -> None:
-        """Устанавливает соединение для Consumer Kafka."""
+                               retry_backoff: float = 1.5,
+                               subscribe: bool = True) -> None:
+        """Устанавливает соединение для Consumer Kafka.
+
+        subscribe=False откладывает подписку на топик: ее выполнит consume_partitions
+        вместе с обработчиком перераспределения партиций.
+        """
         retry_count = 0
         retry_delay = 1.0
         
         while retry_count < max_retries:
             try:
                 consumer = AIOKafkaConsumer(
-                    topic,
+                    *([topic] if subscribe else []),
                     bootstrap_servers=bootstrap_servers,
                     group_id=group_id,
                     auto_offset_reset=auto_offset_reset,
-                    value_deserializer=lambda m: json.loads(m.decode('utf-8'))
+                    value_deserializer=orjson.loads
                 )
                 
                 await consumer.start()
@@ -98,14 +255,89 @@ class KafkaService:
             del self.consumers[topic]
             logger.info(f"Kafka consumer for topic {topic} disconnected")
     
-    async def send_message(self, topic: str, message: Dict[str, Any]) -> bool:
-        """Отправляет сообщение в топик Kafka."""
+    async def _send_collected(self, topic: str, message: Union[Dict[str, Any], bytes], key: Optional[str]) -> asyncio.Future:
+        """Ставит сообщение в пакет продюсера; подтверждение обработает _on_delivery."""
+        await self._in_flight.acquire()
+        try:
+            future = await self.producer.send(topic, message, key=key)
+        except BaseException:
+            self._in_flight.release()
+            raise
+        self._pending.add(future)
+        future.add_done_callback(functools.partial(self._on_delivery, time.monotonic()))
+        return future
+    
+    def _on_delivery(self, started: float, future: asyncio.Future) -> None:
+        self._pending.discard(future)
+        self._in_flight.release()
+        self._deliveries.append((started, future))
+        # Подтверждения одного ответа брокера приходят в одной итерации цикла событий:
+        # учитываем их вместе на следующей итерации
+        if not self._deliveries_scheduled:
+            self._deliveries_scheduled = True
+            future.get_loop().call_soon(self._record_deliveries)
+    
+    def _record_deliveries(self) -> None:
+        deliveries, self._deliveries = self._deliveries, []
+        self._deliveries_scheduled = False
+        if not deliveries:
+            return
+        
+        now = time.monotonic()
+        batch_started: Dict[int, float] = {}
+        failed = 0
+        error = None
+        for started, future in deliveries:
+            if future.cancelled() or future.exception() is not None:
+                failed += 1
+                error = "cancelled" if future.cancelled() else str(future.exception())
+                continue
+            partition = future.result().partition
+            batch_started[partition] = min(started, batch_started.get(partition, started))
+        
+        self.delivered += len(deliveries) - failed
+        self.failed += failed
+        for started in batch_started.values():
+            latency_ms = (now - started) * 1000
+            self.batches += 1
+            self.batch_latency_ms_total += latency_ms
+            self.batch_latency_ms_max = max(self.batch_latency_ms_max, latency_ms)
+        if failed:
+            self.last_error = error
+            logger.error(f"Kafka did not acknowledge {failed} messages: {error}")
+    
+    def producer_stats(self) -> Dict[str, Any]:
+        return {
+            "mode": "batched" if self.batched else "sync",
+            "in_flight": len(self._pending),
+            "max_in_flight": self.max_in_flight,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "batches": self.batches,
+            "avg_batch_messages": self.delivered / self.batches if self.batches else 0.0,
+            "avg_batch_latency_ms": self.batch_latency_ms_total / self.batches if self.batches else 0.0,
+            "max_batch_latency_ms": self.batch_latency_ms_max,
+            "last_error": self.last_error,
+        }
+    
+    async def send_message(self, topic: str, message: Union[Dict[str, Any], bytes], key: Optional[str] = None,
+                           confirm: bool = False) -> bool:
+        """Отправляет сообщение в топик Kafka; key - хеш события.
+
+        В режиме batched без confirm возвращает True после постановки в пакет;
+        с confirm ждет подтверждения брокера в обоих режимах.
+        """
         if not self.producer:
             logger.error("Kafka producer not connected")
             return False
         
         try:
-            await self.producer.send_and_wait(topic, message)
+            if self.batched:
+                future = await self._send_collected(topic, message, key)
+                if confirm:
+                    await future
+            else:
+                await self.producer.send_and_wait(topic, message, key=key)
             return True
         except KafkaError as e:
             logger.error(f"Failed to send message to Kafka: {str(e)}")
@@ -114,11 +346,47 @@ class KafkaService:
             logger.error(f"Unexpected error when sending to Kafka: {str(e)}")
             return False
     
+    async def send_batch(self, topic: str, messages: List[Union[Dict[str, Any], bytes]],
+                         keys: Optional[List[str]] = None, confirm: bool = False) -> bool:
+        """Отправляет пакет сообщений: producer собирает их в общие record batch.
+
+        confirm - как в send_message: ждать подтверждения брокера и в режиме batched.
+        """
+        if not self.producer:
+            logger.error("Kafka producer not connected")
+            return False
+        
+        if keys is None:
+            keys = [None] * len(messages)
+        try:
+            if self.batched:
+                futures = [await self._send_collected(topic, message, key) for message, key in zip(messages, keys)]
+                if confirm:
+                    await asyncio.gather(*futures)
+                return True
+            futures = [await self.producer.send(topic, message, key=key) for message, key in zip(messages, keys)]
+            await asyncio.gather(*futures)
+            return True
+        except KafkaError as e:
+            logger.error(f"Failed to send batch of {len(messages)} messages to Kafka: {str(e)}")
+            return False
+        except Exception as e:
+            logger.error(f"Unexpected error when sending batch to Kafka: {str(e)}")
+            return False
+    
     async def consume_messages(self, 
                                topic: str, 
                                callback: Callable[[Dict[str, Any]], None],
-                               max_concurrency: int = 10) -> None:
-        """Запускает асинхронное потребление сообщений из топика."""
+                               max_concurrency: int = 10,
+                               queue_size: int = 0) -> None:
+        """Запускает асинхронное потребление сообщений из топика.
+
+        Между чтением и обработкой стоит очередь фиксированного размера
+        (по умолчанию 2 * max_concurrency), сообщения обрабатывают
+        max_concurrency воркеров. Когда очередь заполнена, партиции ставятся
+        на паузу (pause) и возобновляются, когда очередь освободится наполовину:
+        при любом отставании в памяти не больше queue_size сообщений.
+        """
         if topic not in self.consumers:
             logger.error(f"Consumer for topic {topic} not connected")
             return
@@ -126,32 +394,133 @@ class KafkaService:
         consumer = self.consumers[topic]
         self.running = True
         
-        semaphore = asyncio.Semaphore(max_concurrency)
-        tasks = set()
+        queue = asyncio.Queue(maxsize=queue_size or max_concurrency * 2)
+        self._work_queue = queue
+        low_watermark = queue.maxsize // 2
+        drained = asyncio.Event()
         
-        async def process_message(message):
-            async with semaphore:
+        async def worker():
+            while True:
+                message = await queue.get()
                 try:
                     await callback(message.value)
                 except Exception as e:
                     logger.error(f"Error processing message: {str(e)}")
+                finally:
+                    queue.task_done()
+                    if queue.qsize() <= low_watermark:
+                        drained.set()
         
+        workers = [asyncio.create_task(worker()) for _ in range(max_concurrency)]
         try:
             async for message in consumer:
                 if not self.running:
                     break
                 
-                task = asyncio.create_task(process_message(message))
-                tasks.add(task)
-                task.add_done_callback(tasks.discard)
+                if queue.full():
+                    await self._pause_until_drained(consumer, queue, drained, low_watermark)
+                queue.put_nowait(message)
         except Exception as e:
             logger.error(f"Error in Kafka consumer loop: {str(e)}")
         finally:
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=True)
+            # Сообщения, уже взятые из Kafka, дорабатываются до остановки
+            await queue.join()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
             
             self.running = False
     
+    async def _pause_until_drained(self, consumer: AIOKafkaConsumer, queue: asyncio.Queue,
+                                   drained: asyncio.Event, low_watermark: int) -> None:
+        """Приостанавливает чтение всех партиций, пока очередь не опустится до low_watermark."""
+        consumer.pause(*consumer.assignment())
+        self.consumer_pauses += 1
+        self._paused_since = time.monotonic()
+        try:
+            drained.clear()
+            while queue.qsize() > low_watermark:
+                await drained.wait()
+                drained.clear()
+        finally:
+            consumer.resume(*consumer.paused())
+            self.consumer_paused_seconds += time.monotonic() - self._paused_since
+            self._paused_since = None
+    
+    def consumer_stats(self) -> Dict[str, Any]:
+        paused_seconds = self.consumer_paused_seconds
+        if self._paused_since is not None:
+            paused_seconds += time.monotonic() - self._paused_since
+        stats = {
+            "queue_depth": self._work_queue.qsize() if self._work_queue is not None else 0,
+            "queue_size": self._work_queue.maxsize if self._work_queue is not None else 0,
+            "paused": self._paused_since is not None,
+            "pauses": self.consumer_pauses,
+            "paused_seconds": paused_seconds,
+        }
+        if self.partition_pipelines:
+            stats["partitions"] = {topic: pipelines.stats() for topic, pipelines in self.partition_pipelines.items()}
+        return stats
+    
+    async def consume_partitions(self,
+                                 topic: str,
+                                 callback: Callable[[Dict[str, Any]], None],
+                                 max_concurrency: int = 10,
+                                 max_records: int = 500) -> None:
+        """Потребление с отдельным конвейером на каждую назначенную партицию.
+
+        max_concurrency ограничивает число одновременно обрабатываемых сообщений
+        в одной партиции. Консьюмер должен быть подключен с subscribe=False.
+        """
+        if topic not in self.consumers:
+            logger.error(f"Consumer for topic {topic} not connected")
+            return
+        
+        consumer = self.consumers[topic]
+        pipelines = PartitionPipelines(self, consumer, callback, max_concurrency, max_records)
+        self.partition_pipelines[topic] = pipelines
+        self.running = True
+        consumer.subscribe([topic], listener=pipelines)
+        
+        try:
+            while self.running:
+                await asyncio.sleep(0.5)
+        finally:
+            self.running = False
+            await pipelines.stop()
+    
+    async def consume_batches(self,
+                              topic: str,
+                              callback: Callable[[List[Dict[str, Any]]], None],
+                              max_records: int = 500,
+                              timeout_ms: int = 100) -> None:
+        """Пакетное потребление: getmany по всем назначенным партициям, один вызов callback на пакет.
+
+        Задачи на отдельные сообщения не создаются; следующий пакет забирается
+        после обработки предыдущего.
+        """
+        if topic not in self.consumers:
+            logger.error(f"Consumer for topic {topic} not connected")
+            return
+        
+        consumer = self.consumers[topic]
+        self.running = True
+        
+        try:
+            while self.running:
+                records = await consumer.getmany(timeout_ms=timeout_ms, max_records=max_records)
+                messages = [message.value for partition_messages in records.values() for message in partition_messages]
+                if not messages:
+                    continue
+                try:
+                    await callback(messages)
+                except Exception as e:
+                    logger.error(f"Error processing batch of {len(messages)} messages: {str(e)}")
+        except Exception as e:
+            logger.error(f"Error in Kafka consumer loop: {str(e)}")
+        finally:
+            self.running = False
+    
     def stop_consuming(self) -> None:
         """Останавливает потребление сообщений."""
         self.running = False
@@ -5,6 +5,69 @@ import json
 from loguru import logger
 from datetime import datetime
 import asyncio
+import time
+
+from app.sharding import ModuloRouter, create_router
+
+
+class BatchRejectedError(Exception):
+    """PostgreSQL отклонил пакет из-за данных строк: повтор той же вставки не поможет."""
+
+
+# Ошибки данных (класс 22), нарушения ограничений (класс 23) и ошибки кодирования параметров
+_REJECTED_ERRORS = (asyncpg.exceptions.DataError, asyncpg.exceptions.IntegrityConstraintViolationError,
+                    ValueError, TypeError)
+
+_EVENT_COLUMNS = ['client_id', 'event_datetime', 'event_name', 'product_id', 'sid', 'r', 'event_hash', 'full_event']
+
+
+class CopyThreshold:
+    """Порог перехода с INSERT на COPY для одного шарда.
+
+    Сравнивает сглаженную стоимость строки для обоих способов и сдвигает порог
+    в сторону более дешевого. Каждый probe_every-й пакет пишется другим способом,
+    чтобы оценка второго способа не устаревала.
+    """
+
+    def __init__(self, initial: int = 100, min_rows: int = 20, max_rows: int = 5000,
+                 smoothing: float = 0.2, probe_every: int = 50):
+        self.threshold = initial
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.smoothing = smoothing
+        self.probe_every = probe_every
+        self.row_cost: Dict[str, Optional[float]] = {"insert": None, "copy": None}
+        self.batches = 0
+
+    def use_copy(self, rows: int) -> bool:
+        if rows < self.min_rows:
+            return False
+        self.batches += 1
+        use_copy = rows >= self.threshold
+        if self.batches % self.probe_every == 0:
+            return not use_copy
+        return use_copy
+
+    def observe(self, method: str, rows: int, seconds: float) -> None:
+        cost = seconds / rows
+        previous = self.row_cost[method]
+        self.row_cost[method] = cost if previous is None else previous + self.smoothing * (cost - previous)
+
+        insert_cost, copy_cost = self.row_cost["insert"], self.row_cost["copy"]
+        if insert_cost is None or copy_cost is None:
+            return
+        if copy_cost < insert_cost:
+            self.threshold = max(self.min_rows, int(self.threshold * 0.8))
+        else:
+            self.threshold = min(self.max_rows, int(self.threshold * 1.25) + 1)
+
+    def stats(self) -> Dict[str, Any]:
+        insert_cost, copy_cost = self.row_cost["insert"], self.row_cost["copy"]
+        return {
+            "threshold": self.threshold,
+            "insert_row_us": round(insert_cost * 1e6, 1) if insert_cost is not None else None,
+            "copy_row_us": round(copy_cost * 1e6, 1) if copy_cost is not None else None,
+        }
 
 
 class PostgresService:
@@ -14,13 +77,16 @@ class PostgresService:
         self.pool = None
         self.pools = None
         self.shard_count = 1
+        self.router = ModuloRouter(1)
         self.schema_created = False
+        self.copy_thresholds: Dict[int, CopyThreshold] = {}
     
     async def connect(self, host: str = "localhost", port: int = 5432, user: str = "postgres",
                      password: str = "postgres", database: str = "postgres",
-                     hosts: List[str] = None, shard_count: int = 1) -> None:
+                     hosts: List[str] = None, shard_count: int = 1, shard_router: str = "modulo") -> None:
         """Устанавливает соединение с PostgreSQL."""
         self.shard_count = shard_count
+        self.router = create_router(shard_router, shard_count)
         self.pools = []
         
         try:
@@ -149,10 +215,7 @@ class PostgresService:
     
     def _get_shard_index(self, event_hash: str) -> int:
         """Определяет индекс шарда на основе хеша события."""
-        if self.shard_count <= 1:
-            return 0
-        hash_int = int(event_hash[:8], 16)
-        return hash_int % self.shard_count
+        return self.router.shard(event_hash)
     
     def _get_pool(self, event_hash: str = None):
         """Возвращает пул соединений для указанного хеша события или первый пул."""
@@ -192,8 +255,13 @@ class PostgresService:
             logger.error(f"Error saving event to PostgreSQL: {str(e)}")
             return False
     
-    async def save_events_batch(self, events: List[Dict[str, Any]], event_hashes: List[str]) -> bool:
-        """Сохраняет пакет уникальных событий в PostgreSQL."""
+    async def save_events_batch(self, events: List[Dict[str, Any]], event_hashes: List[str],
+                                raise_rejected: bool = False) -> bool:
+        """Сохраняет пакет уникальных событий в PostgreSQL.
+
+        raise_rejected: если пакет отклонен из-за данных строк, выбросить
+        BatchRejectedError вместо возврата False.
+        """
         if not self.pools or not events:
             return False
         if len(events) != len(event_hashes):
@@ -210,11 +278,13 @@ class PostgresService:
         tasks = []
         for shard_index, shard_events in sharded_events.items():
             pool_index = min(shard_index, len(self.pools) - 1)
-            tasks.append(self._save_batch_to_shard(self.pools[pool_index], shard_events))
+            tasks.append(self._save_batch_to_shard(self.pools[pool_index], shard_events, pool_index))
             
         results = await asyncio.gather(*tasks, return_exceptions=True)
         
         for result in results:
+            if isinstance(result, BatchRejectedError) and raise_rejected:
+                raise result
             if isinstance(result, Exception):
                 logger.error(f"Error in batch save: {str(result)}")
                 return False
@@ -223,11 +293,21 @@ class PostgresService:
                 
         return True
             
-    async def _save_batch_to_shard(self, pool, events_with_hashes: List[Tuple[Dict[str, Any], str]]) -> bool:
-        """Сохраняет пакет событий на конкретном шарде."""
+    async def _save_batch_to_shard(self, pool, events_with_hashes: List[Tuple[Dict[str, Any], str]],
+                                   shard_index: int = 0) -> bool:
+        """Сохраняет пакет событий на конкретном шарде.
+
+        Большие пакеты загружаются COPY во временную таблицу и переносятся в events
+        одним INSERT ... ON CONFLICT DO NOTHING, поэтому повторы не ломают пакет.
+        """
         if not events_with_hashes:
             return True
-            
+
+        copy_threshold = self.copy_thresholds.get(shard_index)
+        if copy_threshold is None:
+            copy_threshold = self.copy_thresholds[shard_index] = CopyThreshold()
+        use_copy = copy_threshold.use_copy(len(events_with_hashes))
+
         max_retries = 3
         retry_count = 0
             
@@ -248,24 +328,33 @@ class PostgresService:
                             full_event_json = json.dumps(event)
                             values.append((client_id, event_datetime, event_name, product_id, sid, r, event_hash, full_event_json))
                         
-                        if len(values) > 100:
-                            copy_data = '\n'.join('\t'.join(str(field) if field is not None else '\\N' 
-                                                           for field in row) for row in values)
-                            
-                            await conn.copy_to_table(
-                                'events', 
-                                columns=['client_id', 'event_datetime', 'event_name', 'product_id', 'sid', 'r', 'event_hash', 'full_event'],
-                                data=copy_data,
-                                format='csv'
-                            )
+                        started = time.perf_counter()
+                        if use_copy:
+                            await conn.execute('''
+                                CREATE TEMP TABLE IF NOT EXISTS events_staging (
+                                    client_id TEXT, event_datetime TEXT, event_name TEXT, product_id TEXT,
+                                    sid TEXT, r TEXT, event_hash TEXT, full_event JSONB
+                                ) ON COMMIT DELETE ROWS
+                            ''')
+                            await conn.copy_records_to_table('events_staging', records=values, columns=_EVENT_COLUMNS)
+                            await conn.execute('''
+                                INSERT INTO events (client_id, event_datetime, event_name, product_id, sid, r, event_hash, full_event)
+                                SELECT client_id, event_datetime, event_name, product_id, sid, r, event_hash, full_event
+                                FROM events_staging
+                                ON CONFLICT (event_hash) DO NOTHING
+                            ''')
                         else:
                             await conn.executemany('''
                                 INSERT INTO events (client_id, event_datetime, event_name, product_id, sid, r, event_hash, full_event)
                                 VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
                                 ON CONFLICT (event_hash) DO NOTHING
                             ''', values)
-                        
-                        return True
+
+                copy_threshold.observe("copy" if use_copy else "insert", len(values),
+                                       time.perf_counter() - started)
+                return True
+            except _REJECTED_ERRORS as e:
+                raise BatchRejectedError(str(e)) from e
             except Exception as e:
                 retry_count += 1
                 logger.warning(f"Error batch saving events to shard (attempt {retry_count}/{max_retries}): {str(e)}")
@@ -278,7 +367,11 @@ class PostgresService:
                     return False
         
         return False
-        
+
+    def copy_stats(self) -> Dict[int, Dict[str, Any]]:
+        """Текущие пороги COPY и стоимость строки по шардам."""
+        return {shard: threshold.stats() for shard, threshold in self.copy_thresholds.items()}
+
     async def get_event_by_hash(self, event_hash: str) -> Optional[Dict[str, Any]]:
         """Получает событие по его хешу."""
         pool = self._get_pool(event_hash)
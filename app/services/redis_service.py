@@ -1,8 +1,93 @@
+import asyncio
 import os
-from typing import Optional, Any, Dict, List
+import time
+from typing import Optional, Any, Dict, List, Tuple
 import redis.asyncio as redis
+from redis.asyncio.cluster import RedisCluster, ClusterNode
+from redis.asyncio.connection import DefaultParser
+from redis.utils import HIREDIS_AVAILABLE
 from loguru import logger
 
+from app.dedup_codec import DedupKeyCodec
+from app.dedup_storage import KeyStorage, EventTypeStorage, create_storage
+from app.reshard import ShardMigrator
+from app.sharding import ModuloRouter, ReshardRouter, create_router, parse_layout
+
+
+DEFAULT_POOL_OPTIONS = {
+    "max_connections": 128,
+    "timeout": 5.0,
+    "socket_timeout": 5.0,
+    "socket_connect_timeout": 2.0,
+    "health_check_interval": 30,
+}
+
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    """Ограниченный пул соединений, который измеряет ожидание свободного соединения."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.acquired = 0
+        self.waited = 0
+        self.timeouts = 0
+        self.connection_errors = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def get_connection(self, *args, **kwargs):
+        saturated = not self._available_connections and len(self._in_use_connections) >= self.max_connections
+        started = time.perf_counter()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except redis.ConnectionError as e:
+            # Пул оборачивает истечение ожидания в ConnectionError; остальное - отказ самого Redis
+            if isinstance(e.__cause__, asyncio.TimeoutError):
+                self.timeouts += 1
+            else:
+                self.connection_errors += 1
+            raise
+        wait = time.perf_counter() - started
+        self.acquired += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if saturated:
+            self.waited += 1
+        return connection
+
+    def stats(self) -> Dict[str, Any]:
+        kwargs = self.connection_kwargs
+        return {
+            "endpoint": f"{kwargs.get('host')}:{kwargs.get('port')}/{kwargs.get('db', 0)}",
+            "max_connections": self.max_connections,
+            "in_use": len(self._in_use_connections),
+            "idle": len(self._available_connections),
+            "acquired": self.acquired,
+            "saturated_acquires": self.waited,
+            "timeouts": self.timeouts,
+            "connection_errors": self.connection_errors,
+            "avg_wait_ms": self.total_wait / self.acquired * 1000 if self.acquired else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+def cluster_node_stats(node: ClusterNode) -> Dict[str, Any]:
+    """Загрузка пула соединений узла Redis Cluster.
+
+    Пул узла не ждет свободного соединения: при исчерпании redis-py сразу
+    выбрасывает MaxConnectionsError, поэтому времени ожидания здесь нет.
+    """
+    opened = len(node._connections)
+    idle = len(node._free)
+    return {
+        "endpoint": node.name,
+        "server_type": node.server_type,
+        "max_connections": node.max_connections,
+        "in_use": opened - idle,
+        "idle": idle,
+        "exhausted": opened - idle >= node.max_connections,
+    }
+
 
 class RedisService:
     """Сервис для работы с Redis."""
@@ -12,7 +97,31 @@ class RedisService:
         self.redis_pool = []
         self.ttl_seconds = 7 * 24 * 60 * 60
         self.key_prefix = "event_dedup:"
+        self.codec = DedupKeyCodec()
+        self.storage = KeyStorage(self.codec, self.ttl_seconds)
         self.shard_count = 1
+        self.router = ModuloRouter(1)
+        self.migrator = None
+        self.cluster_mode = False
+        self.connection_pools: Dict[Tuple[str, int, int], MeteredConnectionPool] = {}
+        self.pool_options = dict(DEFAULT_POOL_OPTIONS)
+    
+    def _get_client(self, host: str, port: int, db: int, password: Optional[str]) -> redis.Redis:
+        """Клиент поверх общего пула соединений своего физического адреса."""
+        endpoint = (host, port, db)
+        pool = self.connection_pools.get(endpoint)
+        if pool is None:
+            pool = MeteredConnectionPool(
+                host=host,
+                port=port,
+                db=db,
+                password=password,
+                decode_responses=False,
+                socket_keepalive=True,
+                **self.pool_options
+            )
+            self.connection_pools[endpoint] = pool
+        return redis.Redis(connection_pool=pool)
     
     async def connect(self, 
                      host: str = "localhost", 
@@ -21,25 +130,64 @@ class RedisService:
                      password: Optional[str] = None,
                      ttl_days: int = 7,
                      shard_count: int = 1,
-                     hosts: Optional[List[str]] = None) -> None:
+                     hosts: Optional[List[str]] = None,
+                     key_encoding: str = "legacy",
+                     legacy_read: bool = True,
+                     hash_version: int = 1,
+                     storage_engine: str = "keys",
+                     bucket_prefix_chars: int = 3,
+                     probabilistic_events: Optional[List[str]] = None,
+                     bitmap_options: Optional[Dict[str, Any]] = None,
+                     shard_router: str = "modulo",
+                     reshard_from: Optional[str] = None,
+                     cluster_nodes: Optional[List[str]] = None,
+                     cluster_retry_attempts: int = 10,
+                     pool_options: Optional[Dict[str, Any]] = None) -> None:
         """Устанавливает соединение с Redis."""
         self.shard_count = shard_count
+        self.codec = DedupKeyCodec(key_encoding, legacy_read=legacy_read, hash_version=hash_version)
+        self.pool_options = {**DEFAULT_POOL_OPTIONS, **(pool_options or {})}
+        
+        if HIREDIS_AVAILABLE:
+            logger.info(f"Redis reply parser: {DefaultParser.__name__}")
+        else:
+            logger.warning("hiredis is not installed, Redis replies are parsed in pure Python")
 
         try:
-            if hosts and len(hosts) > 0:
+            if cluster_nodes:
+                if reshard_from:
+                    raise ValueError("REDIS_RESHARD_FROM is not supported in Redis Cluster mode")
+                # Шардированием занимается сам кластер: pipeline раскладывается по слотам
+                # и узлам клиентом redis-py, MOVED/ASK и смена мастера обрабатываются им же
+                startup_nodes = []
+                for node_info in cluster_nodes:
+                    parts = node_info.split(":")
+                    startup_nodes.append(ClusterNode(parts[0], int(parts[1]) if len(parts) > 1 else port))
+                
+                self.redis = RedisCluster(
+                    startup_nodes=startup_nodes,
+                    password=password,
+                    decode_responses=False,
+                    cluster_error_retry_attempts=cluster_retry_attempts,
+                    max_connections=self.pool_options["max_connections"],
+                    socket_timeout=self.pool_options["socket_timeout"],
+                    socket_connect_timeout=self.pool_options["socket_connect_timeout"],
+                    socket_keepalive=True,
+                    health_check_interval=self.pool_options["health_check_interval"]
+                )
+                await self.redis.initialize()
+                self.redis_pool = [self.redis]
+                self.shard_count = 1
+                self.cluster_mode = True
+                logger.info(f"Connected to Redis Cluster with {len(self.redis.get_primaries())} primaries")
+            elif hosts and len(hosts) > 0:
                 logger.info(f"Connecting to {len(hosts)} Redis instances for sharding")
                 for host_info in hosts:
                     parts = host_info.split(":")
                     shard_host = parts[0]
                     shard_port = int(parts[1]) if len(parts) > 1 else port
                     
-                    client = redis.Redis(
-                        host=shard_host,
-                        port=shard_port,
-                        db=db,
-                        password=password,
-                        decode_responses=False
-                    )
+                    client = self._get_client(shard_host, shard_port, db, password)
                     await client.ping()
                     self.redis_pool.append(client)
                     logger.info(f"Connected to Redis shard at {shard_host}:{shard_port}/{db}")
@@ -47,42 +195,77 @@ class RedisService:
                 self.redis = self.redis_pool[0]
                 self.shard_count = len(self.redis_pool)
             else:
-                self.redis = redis.Redis(
-                    host=host,
-                    port=port,
-                    db=db,
-                    password=password,
-                    decode_responses=False
-                )
-                
+                self.redis = self._get_client(host, port, db, password)
                 await self.redis.ping()
                 logger.info(f"Connected to Redis at {host}:{port}/{db}")
                 
                 if shard_count > 1:
-                    logger.info(f"Initializing {shard_count} Redis connections for sharding on same host")
-                    self.redis_pool = [self.redis]
-                    
-                    for i in range(1, shard_count):
-                        client = redis.Redis(
-                            host=host,
-                            port=port,
-                            db=db,
-                            password=password,
-                            decode_responses=False
-                        )
-                        await client.ping()
-                        self.redis_pool.append(client)
-                else:
-                    self.redis_pool = [self.redis]
-                    self.shard_count = 1
+                    # Несколько клиентов к одному Redis не дают шардирования: все ключи в одной БД
+                    logger.warning(
+                        f"REDIS_SHARD_COUNT={shard_count} without REDIS_HOSTS: "
+                        f"using a single connection pool to {host}:{port}/{db}"
+                    )
+                self.redis_pool = [self.redis]
+                self.shard_count = 1
+            
+            logger.info(
+                f"Redis connection pools: {len(self.connection_pools)} endpoints, "
+                f"max {self.pool_options['max_connections']} connections each, "
+                f"wait timeout {self.pool_options['timeout']}s"
+            )
             
             self.ttl_seconds = ttl_days * 24 * 60 * 60
-            logger.info(f"Redis service initialized with {self.shard_count} shards")
+            if storage_engine == "buckets":
+                self.storage = create_storage(
+                    storage_engine, self.codec, self.ttl_seconds,
+                    prefix_chars=bucket_prefix_chars, fallback_read=legacy_read
+                )
+            else:
+                self.storage = create_storage(storage_engine, self.codec, self.ttl_seconds)
+            
+            if probabilistic_events:
+                # Для перечисленных типов событий - вероятностный режим с битами вместо ключей
+                bitmap_storage = create_storage("bitmap", self.codec, self.ttl_seconds, **(bitmap_options or {}))
+                self.storage = EventTypeStorage(
+                    self.storage,
+                    {event_name: bitmap_storage for event_name in probabilistic_events}
+                )
+                logger.info(f"Probabilistic dedup enabled for events: {probabilistic_events}")
+            
+            self.router = create_router(shard_router, self.shard_count)
+            if reshard_from:
+                # Старая раскладка должна быть префиксом списка шардов: новые узлы добавляются в конец
+                previous_router = parse_layout(reshard_from)
+                if previous_router.shard_count > len(self.redis_pool):
+                    raise ValueError(
+                        f"Reshard source layout {reshard_from} has more shards than configured ({len(self.redis_pool)})"
+                    )
+                self.router = ReshardRouter(self.router, previous_router)
+                # Проверка не длится дольше ожидания соединения и таймаута ответа: после этого
+                # любая проверка, начатая до RESTORE, уже завершилась, и источник можно удалять
+                self.migrator = ShardMigrator(
+                    self.redis_pool, self.router, self.codec, self.storage.key_patterns(),
+                    delete_grace=self.pool_options["timeout"] + self.pool_options["socket_timeout"]
+                )
+                logger.info(f"Reshard mode: reading both layouts {self.router.name}")
+            logger.info(
+                f"Redis service initialized with {self.shard_count} shards ({self.router.name} routing), "
+                f"dedup storage: {self.storage.name}"
+            )
             
         except Exception as e:
             logger.error(f"Failed to connect to Redis: {str(e)}")
             raise
     
+    async def migrate_shards(self) -> None:
+        """Переносит ключи дедупликации в новую раскладку шардов (фоновая задача)."""
+        if self.migrator is None:
+            return
+        try:
+            await self.migrator.run()
+        except Exception as e:
+            logger.error(f"Reshard migration stopped: {str(e)}")
+    
     async def disconnect(self) -> None:
         """Закрывает соединение с Redis."""
         for client in self.redis_pool:
@@ -90,6 +273,9 @@ class RedisService:
         
         if self.redis and self.redis not in self.redis_pool:
             await self.redis.close()
+        
+        for pool in self.connection_pools.values():
+            await pool.disconnect()
             
         logger.info("All Redis connections closed")
     
@@ -147,13 +333,16 @@ class RedisService:
     
     async def store_event_hash(self, event_hash: str, timestamp: str) -> bool:
         """Сохраняет хеш события в Redis с указанной временной меткой."""
-        key = f"{self.key_prefix}{event_hash}"
-        return await self.set(key, timestamp, ex=self.ttl_seconds)
+        key = self.codec.key(event_hash)
+        return await self.set(key, self.codec.encode_timestamp(timestamp), ex=self.ttl_seconds)
     
     async def check_event_hash(self, event_hash: str) -> Optional[bytes]:
         """Проверяет наличие хеша события в Redis."""
-        key = f"{self.key_prefix}{event_hash}"
-        return await self.get(key)
+        value = await self.get(self.codec.key(event_hash))
+        legacy_key = self.codec.legacy_key(event_hash) if self.codec.legacy_read else None
+        if value is None and legacy_key is not None:
+            value = await self.get(legacy_key)
+        return value
     
     def pipeline(self):
         """Возвращает объект pipeline Redis для выполнения нескольких операций за один запрос."""
@@ -163,6 +352,15 @@ class RedisService:
             
         return self.redis.pipeline()
         
+    def pool_stats(self) -> List[Dict[str, Any]]:
+        """Загрузка пулов соединений: занятые соединения и время ожидания."""
+        if self.cluster_mode:
+            # У кластерного клиента свой пул на каждый узел, общих пулов по адресам нет
+            return [cluster_node_stats(node) for node in self.redis.get_nodes()]
+        return [pool.stats() for pool in self.connection_pools.values()]
+        
     def get_connection_count(self) -> int:
         """Возвращает количество доступных соединений Redis."""
+        if self.cluster_mode:
+            return len(self.redis.get_primaries())
         return len(self.redis_pool) if self.redis_pool else 1 
\ No newline at end of file
@@ -0,0 +1,151 @@
+import bisect
+import hashlib
+import random
+from typing import List, Optional
+
+
+class ShardRouter:
+    """Базовый маршрутизатор: хеш события -> номер шарда."""
+
+    name = ""
+
+    def __init__(self, shard_count: int):
+        self.shard_count = max(1, shard_count)
+
+    def shard(self, event_hash: str) -> int:
+        raise NotImplementedError
+
+    def previous_shard(self, event_hash: str) -> Optional[int]:
+        """Шард прежней раскладки, если запись может лежать там; вне решардинга - None."""
+        return None
+
+
+class ModuloRouter(ShardRouter):
+    """Исходная схема: остаток от деления первых 32 бит хеша на число шардов.
+
+    При изменении числа шардов с N на N+1 переезжает около N/(N+1) ключей.
+    """
+
+    name = "modulo"
+
+    def shard(self, event_hash: str) -> int:
+        if self.shard_count <= 1:
+            return 0
+        return int(event_hash[:8], 16) % self.shard_count
+
+
+class JumpHashRouter(ShardRouter):
+    """Jump consistent hash (Lamping, Veach): при добавлении шарда переезжает 1/(N+1) ключей.
+
+    Шарды нумеруются по порядку, поэтому новые узлы добавляются в конец списка.
+    """
+
+    name = "jump"
+
+    def shard(self, event_hash: str) -> int:
+        key = int(event_hash[:16], 16)
+        bucket, candidate = -1, 0
+        while candidate < self.shard_count:
+            bucket = candidate
+            key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+            candidate = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+        return bucket
+
+
+class RingRouter(ShardRouter):
+    """Кольцо с виртуальными узлами: каждый шард занимает vnodes точек на кольце."""
+
+    name = "ring"
+
+    def __init__(self, shard_count: int, vnodes: int = 160):
+        super().__init__(shard_count)
+        self.vnodes = vnodes
+
+        points = []
+        for shard in range(self.shard_count):
+            for vnode in range(vnodes):
+                digest = hashlib.blake2b(f"shard-{shard}-{vnode}".encode(), digest_size=8).digest()
+                points.append((int.from_bytes(digest, 'big'), shard))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard(self, event_hash: str) -> int:
+        if self.shard_count <= 1:
+            return 0
+        index = bisect.bisect(self._points, int(event_hash[:16], 16))
+        return self._shards[index % len(self._shards)]
+
+
+ROUTERS = {router.name: router for router in (ModuloRouter, JumpHashRouter, RingRouter)}
+
+
+def create_router(name: str, shard_count: int) -> ShardRouter:
+    """Создает маршрутизатор шардов по имени."""
+    if name not in ROUTERS:
+        raise ValueError(f"Unknown shard router: {name}")
+    return ROUTERS[name](shard_count)
+
+
+def parse_layout(layout: str) -> ShardRouter:
+    """Разбирает раскладку вида "modulo:4" в маршрутизатор."""
+    name, _, count = layout.partition(":")
+    return create_router(name.strip(), int(count) if count else 1)
+
+
+class ReshardRouter(ShardRouter):
+    """Раскладка на время решардинга: пишем по новой схеме, читаем обе.
+
+    previous_shard возвращает шард старой раскладки, если он отличается от нового:
+    там может лежать запись, еще не перенесенная фоновой миграцией.
+    """
+
+    def __init__(self, router: ShardRouter, previous_router: ShardRouter):
+        super().__init__(router.shard_count)
+        self.router = router
+        self.previous_router = previous_router
+        self.name = f"{previous_router.name}:{previous_router.shard_count}->{router.name}:{router.shard_count}"
+
+    def shard(self, event_hash: str) -> int:
+        return self.router.shard(event_hash)
+
+    def previous_shard(self, event_hash: str) -> Optional[int]:
+        previous = self.previous_router.shard(event_hash)
+        return previous if previous != self.router.shard(event_hash) else None
+
+
+def moved_fraction(router: ShardRouter, previous_router: ShardRouter, samples: List[str]) -> float:
+    """Доля хешей, которые при смене раскладки попадают на другой шард."""
+    if not samples:
+        return 0.0
+    moved = sum(1 for event_hash in samples if router.shard(event_hash) != previous_router.shard(event_hash))
+    return moved / len(samples)
+
+
+class ShardAffinityPartitioner:
+    """Партиционер продюсера Kafka: события одного шарда попадают в «его» партиции.
+
+    Партиция p обслуживает шард p % shard_count, поэтому конвейер консьюмера,
+    получивший партицию, обращается в основном к одному шарду. Ключ сообщения -
+    хеш события; внутри шарда партиция выбирается по другим битам хеша.
+    Число партиций стоит делать кратным числу шардов.
+    """
+
+    def __init__(self, router: ShardRouter):
+        self.router = router
+
+    def __call__(self, key: Optional[bytes], all_partitions: List[int], available_partitions: List[int]) -> int:
+        if key is None:
+            return random.choice(available_partitions or all_partitions)
+
+        event_hash = key.decode()
+        partition_count = len(all_partitions)
+        shard = self.router.shard(event_hash)
+        shard_count = self.router.shard_count
+        if partition_count <= shard_count:
+            return shard % partition_count
+
+        # Партиции шарда: shard, shard + shard_count, shard + 2 * shard_count, ...
+        shard_partitions = (partition_count - shard + shard_count - 1) // shard_count
+        return shard + (int(event_hash[16:24], 16) % shard_partitions) * shard_count
+
@@ -0,0 +1,64 @@
+import asyncio
+from typing import Dict, Any, Optional, Tuple
+
+
+class LeaderCancelledError(Exception):
+    """Ведущая проверка отменена (например, клиент отключился); ожидающие повторяют проверку сами."""
+
+
+class SingleFlight:
+    """Объединение одновременных проверок одного и того же хеша события.
+
+    Первый вызов с данным хешем становится ведущим и обращается к Redis,
+    остальные ждут его результата. Ведущий получает ответ Redis как есть,
+    ожидающие всегда получают «дубликат» с исходным временем ведущей записи.
+    Объединение действует в пределах одного процесса (воркера).
+
+    Отмена ведущего не передается ожидающим: они получают LeaderCancelledError
+    и повторяют проверку, один из них становится новым ведущим.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def join(self, event_hash: str) -> Tuple[bool, asyncio.Future]:
+        """Возвращает (ведущий ли вызов, future с исходным значением записи)."""
+        future = self._in_flight.get(event_hash)
+        if future is not None:
+            self.coalesced += 1
+            return False, future
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[event_hash] = future
+        self.leaders += 1
+        return True, future
+
+    def resolve(self, event_hash: str, original_timestamp: Optional[bytes]) -> None:
+        future = self._in_flight.pop(event_hash, None)
+        if future is not None and not future.done():
+            future.set_result(original_timestamp)
+
+    def fail(self, event_hash: str, error: BaseException) -> None:
+        future = self._in_flight.pop(event_hash, None)
+        if future is not None and not future.done():
+            if not isinstance(error, Exception):
+                # CancelledError ведущего прошел бы мимо обработчиков except Exception у чужих запросов
+                self.abandoned += 1
+                error = LeaderCancelledError(f"Dedup check for {event_hash} was cancelled")
+            future.set_exception(error)
+            # Ожидающих может не быть: помечаем исключение как полученное
+            future.exception()
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._in_flight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
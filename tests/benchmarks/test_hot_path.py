@@ -0,0 +1,127 @@
+"""Бенчмарки CPU-стоимости горячего пути /api/event (pytest-benchmark).
+
+Все проверки попадают в локальный кэш дубликатов, поэтому Redis, Kafka и
+PostgreSQL не нужны: измеряется только обработка запроса в процессе.
+Регрессии ловятся сравнением с сохраненным прогоном, см. docs/README.md.
+"""
+import asyncio
+
+import orjson
+import pytest
+import redis.asyncio as redis
+from fastapi import FastAPI
+
+from app.api import events as events_api
+from app.dedup_codec import DedupKeyCodec
+from app.hot_cache import HotDuplicateCache
+from app.services.kafka_service import KafkaService
+from app.services.postgres_service import PostgresService
+from app.services.redis_service import RedisService
+
+REQUESTS_PER_ROUND = 200
+
+EVENT = {
+    "client_id": "7c0e4a9b1d2f3e",
+    "event_datetime": "2024-05-01T12:00:00.000Z",
+    "event_name": "play",
+    "product_id": "4f1c2a6e-9b0d-4e57-8a3c-2d1b0f9e7a65",
+    "sid": "1234567890123456789",
+    "r": "9f8e7d6c5b4a39281706f5e4d3c2b1a0",
+    "platform": "android",
+    "user_agent": "KION/5.1 (Android 13)",
+    "screen": "main",
+    "profile_age": 12,
+}
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def app(loop):
+    redis_service = RedisService()
+    # Клиент не подключается: все проверки обслуживает локальный кэш
+    redis_service.redis = redis.Redis()
+    events_api.redis_service = redis_service
+    events_api.kafka_service = KafkaService()
+    events_api.postgres_service = PostgresService()
+    events_api.hot_cache = HotDuplicateCache()
+    events_api.deduplicator = events_api.create_deduplicator(redis_service)
+
+    event_hash = events_api.deduplicator.calculate_hash(EVENT)
+    events_api.hot_cache.add(event_hash, b"2024-05-01T12:00:01")
+
+    app = FastAPI()
+    app.include_router(events_api.router, prefix="/api")
+    yield app
+
+    events_api.redis_service = None
+    events_api.kafka_service = None
+    events_api.postgres_service = None
+    events_api.hot_cache = None
+    events_api.deduplicator = None
+
+
+async def post(app, path, body):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": b"", "root_path": "", "client": ("127.0.0.1", 0), "server": ("bench", 80),
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    response = {}
+
+    async def receive():
+        return messages.pop() if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        else:
+            response["body"] = response.get("body", b"") + message.get("body", b"")
+
+    await app(scope, receive, send)
+    return response
+
+
+@pytest.mark.parametrize("hash_version", [1, 2])
+def test_calculate_hash(benchmark, hash_version):
+    codec = DedupKeyCodec(hash_version=hash_version)
+    benchmark(codec.calculate_hash, EVENT)
+
+
+def test_is_duplicate_hot_hit(benchmark, app, loop):
+    deduplicator = events_api.deduplicator
+    event_hash = deduplicator.calculate_hash(EVENT)
+
+    async def check_round():
+        for _ in range(REQUESTS_PER_ROUND):
+            await deduplicator.is_duplicate(EVENT, event_hash)
+
+    benchmark(lambda: loop.run_until_complete(check_round()))
+    assert events_api.hot_cache.stats()["misses"] == 0
+
+
+@pytest.mark.parametrize("path", ["/api/event", "/api/event/raw"])
+def test_event_route_duplicate(benchmark, app, loop, path):
+    body = orjson.dumps(EVENT)
+
+    async def request_round():
+        for _ in range(REQUESTS_PER_ROUND):
+            response = await post(app, path, body)
+        return response
+
+    response = benchmark(lambda: loop.run_until_complete(request_round()))
+    assert response["status"] == 200
+    assert orjson.loads(response["body"])["is_duplicate"] is True
+
+
+def test_deduplicator_is_long_lived(app, loop):
+    first = loop.run_until_complete(events_api.get_deduplicator())
+    second = loop.run_until_complete(events_api.get_deduplicator())
+    assert first is second is events_api.deduplicator
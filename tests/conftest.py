@@ -0,0 +1,46 @@
+"""Общие фикстуры тестов: путь к пакету app, события и Redis на fakeredis."""
+import sys
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+@pytest.fixture
+def make_event() -> Callable[..., Dict[str, Any]]:
+    """Фабрика событий: index различает хеши, остальные поля можно переопределить."""
+    def factory(index: int = 1, **fields) -> Dict[str, Any]:
+        event = {
+            "client_id": f"client-{index}",
+            "event_datetime": "2024-05-01T12:00:00",
+            "event_name": "play",
+            "product_id": "product-1",
+            "sid": f"sid-{index}",
+            "r": "r-1",
+        }
+        event.update(fields)
+        return event
+    return factory
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.aioredis.FakeRedis()
+
+
+@pytest.fixture
+def make_shards() -> Callable[[int], List[Any]]:
+    """Фабрика шардов Redis; у каждого свой адрес, как у отдельных серверов.
+
+    fakeredis кэширует сервер по адресу, поэтому каждому шарду передается новый FakeServer.
+    """
+    def factory(count: int) -> List[Any]:
+        return [
+            fakeredis.aioredis.FakeRedis(host=f"shard{index}", server=fakeredis.FakeServer())
+            for index in range(count)
+        ]
+    return factory
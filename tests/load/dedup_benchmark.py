@@ -0,0 +1,392 @@
+import argparse
+import asyncio
+import inspect
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import redis.asyncio as redis
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from app.deduplicator import Deduplicator  # noqa: E402
+from app.hot_cache import HotDuplicateCache  # noqa: E402
+from app.batcher import DedupBatcher  # noqa: E402
+from app.dedup_codec import DedupKeyCodec, HASH_FUNCTIONS  # noqa: E402
+from app.dedup_storage import BucketStorage, BitmapStorage  # noqa: E402
+from app.sharding import ROUTERS, create_router, moved_fraction  # noqa: E402
+
+
+class CountingRedis:
+    """Обертка над клиентом Redis, считающая сетевые обращения (round trips)."""
+
+    def __init__(self, client):
+        self._client = client
+        self.round_trips = 0
+
+    def pipeline(self, *args, **kwargs):
+        return _CountingPipeline(self, self._client.pipeline(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if inspect.isawaitable(result):
+                self.round_trips += 1
+            return result
+
+        return wrapper
+
+
+class _CountingPipeline:
+    def __init__(self, owner, pipe):
+        self._owner = owner
+        self._pipe = pipe
+
+    async def execute(self, *args, **kwargs):
+        self._owner.round_trips += 1
+        return await self._pipe.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+
+class LegacyDeduplicator(Deduplicator):
+    """Протокол до перехода на SET NX GET: EXISTS+GET, затем отдельный SET."""
+
+    async def is_duplicate(self, event):
+        event_hash = self.calculate_hash(event)
+        redis_key = self.codec.legacy_key(event_hash, event)
+        redis_client = self._get_redis_client(event_hash)
+
+        pipe = redis_client.pipeline()
+        pipe.exists(redis_key)
+        pipe.get(redis_key)
+        exists, _ = await pipe.execute()
+
+        if exists:
+            return True
+        await redis_client.set(redis_key, datetime.utcnow().isoformat(), ex=self.ttl_seconds)
+        return False
+
+
+def generate_events(count, duplicate_ratio):
+    """Генерирует поток событий с заданной долей повторов."""
+    events = []
+    for _ in range(count):
+        if events and random.random() < duplicate_ratio:
+            events.append(random.choice(events))
+            continue
+        events.append({
+            'client_id': uuid.uuid4().hex[:14],
+            'event_datetime': datetime.utcnow().isoformat() + 'Z',
+            'event_name': random.choice(["app_list", "play", "pause", "stop"]),
+            'product_id': str(uuid.uuid4()),
+            'sid': uuid.uuid4().hex,
+            'r': uuid.uuid4().hex,
+        })
+    return events
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+async def run_protocol(name, deduplicator, client, events, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(event):
+        async with semaphore:
+            start = time.perf_counter()
+            await deduplicator.is_duplicate(event)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(check(event) for event in events))
+    elapsed = time.perf_counter() - started
+
+    print(
+        f"{name:>8}: {client.round_trips / len(events):.2f} calls/event, "
+        f"p50 {percentile(latencies, 50):.3f} ms, p99 {percentile(latencies, 99):.3f} ms, "
+        f"{len(events) / elapsed:.0f} events/s"
+    )
+
+
+async def connect_redis(args):
+    """Клиент Redis для бенчмарка; движки дедупликации используют SET NX GET и EXPIREAT NX из Redis 7.0."""
+    client = redis.Redis(host=args.host, port=args.port, db=args.db, decode_responses=False)
+    version = (await client.info("server"))["redis_version"]
+    if tuple(int(part) for part in version.split(".")[:2]) < (7, 0):
+        await client.aclose()
+        raise SystemExit(f"Redis {version} is not supported: 7.0 or newer is required (SET NX GET, EXPIREAT NX)")
+    return client
+
+
+async def bench_protocol(args):
+    raw_client = await connect_redis(args)
+
+    events = generate_events(args.count, args.duplicate_ratio)
+    print(f"{len(events)} событий, доля повторов {args.duplicate_ratio:.0%}, конкурентность {args.concurrency}")
+
+    variants = (
+        ("legacy", lambda client: LegacyDeduplicator(client)),
+        ("set_nx", lambda client: Deduplicator(client)),
+        ("hot", lambda client: Deduplicator(client, hot_cache=HotDuplicateCache(max_entries=args.hot_cache_entries))),
+    )
+    for name, create_deduplicator in variants:
+        await raw_client.flushdb()
+        client = CountingRedis(raw_client)
+        deduplicator = create_deduplicator(client)
+        await run_protocol(name, deduplicator, client, events, args.concurrency)
+        if deduplicator.hot_cache is not None:
+            print(f"{'':>8}  hot cache hit rate {deduplicator.hot_cache.stats()['hit_rate']:.1%}")
+
+    await raw_client.flushdb()
+    await raw_client.aclose()
+
+
+async def bench_batching(args):
+    raw_client = await connect_redis(args)
+
+    events = generate_events(args.count, args.duplicate_ratio)
+    print(f"{len(events)} событий, конкурентность {args.concurrency}, максимум {args.batch_size} событий в пакете")
+
+    await raw_client.flushdb()
+    client = CountingRedis(raw_client)
+    await run_protocol("no batch", Deduplicator(client), client, events, args.concurrency)
+
+    for window_ms in (float(window) for window in args.windows.split(",")):
+        await raw_client.flushdb()
+        client = CountingRedis(raw_client)
+        batcher = DedupBatcher(Deduplicator(client), max_batch_size=args.batch_size, max_delay=window_ms / 1000)
+        await run_protocol(f"{window_ms:g} ms", batcher, client, events, args.concurrency)
+        print(f"{'':>8}  средний пакет {batcher.stats()['avg_batch_size']:.1f} событий")
+
+    await raw_client.flushdb()
+    await raw_client.aclose()
+
+
+class NullKafka:
+    """Kafka без сети: бенчмарк маршрутов меряет только стоимость обработки запроса."""
+
+    producer = True
+
+    async def send_message(self, topic, message, key=None, confirm=False):
+        return True
+
+    async def send_batch(self, topic, messages, keys=None, confirm=False):
+        return True
+
+
+class NullPostgres:
+    pool = True
+
+    async def save_event(self, event, event_hash):
+        return True
+
+    async def save_events_batch(self, events, event_hashes, raise_rejected=False):
+        return True
+
+
+async def asgi_post(app, path, body):
+    """Один POST-запрос напрямую через ASGI, без HTTP-сервера и клиента."""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": b"", "root_path": "", "client": ("127.0.0.1", 0), "server": ("bench", 80),
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    status = []
+
+    async def receive():
+        return messages.pop() if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await app(scope, receive, send)
+    return status[0]
+
+
+async def bench_routes(args):
+    import orjson
+    from fastapi import FastAPI
+    from app.api import events as events_api
+    from app.services.redis_service import RedisService
+
+    raw_client = await connect_redis(args)
+
+    redis_service = RedisService()
+    redis_service.redis = raw_client
+    events_api.redis_service = redis_service
+    events_api.deduplicator = events_api.create_deduplicator(redis_service)
+    events_api.kafka_service = NullKafka()
+    events_api.postgres_service = NullPostgres()
+    app = FastAPI()
+    app.include_router(events_api.router, prefix="/api")
+
+    bodies = [
+        orjson.dumps(dict(event, platform="android", user_agent="KION/5.1 (Android 13)", screen="main",
+                          profile_age=12, experiments="[]"))
+        for event in generate_events(args.count, args.duplicate_ratio)
+    ]
+    print(f"{len(bodies)} запросов, доля повторов {args.duplicate_ratio:.0%}, конкурентность {args.concurrency}")
+
+    for name, path in (("model", "/api/event"), ("raw", "/api/event/raw")):
+        await raw_client.flushdb()
+        semaphore = asyncio.Semaphore(args.concurrency)
+        statuses = []
+
+        async def post(body):
+            async with semaphore:
+                statuses.append(await asgi_post(app, path, body))
+
+        cpu_started = time.process_time()
+        started = time.perf_counter()
+        await asyncio.gather(*(post(body) for body in bodies))
+        elapsed = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+
+        errors = sum(1 for code in statuses if code != 200)
+        print(
+            f"{name:>8}: {len(bodies) / cpu:.0f} req/s на ядро (CPU процесса), "
+            f"{len(bodies) / elapsed:.0f} req/s, ошибок {errors}"
+        )
+
+    await raw_client.flushdb()
+    await raw_client.aclose()
+
+
+async def used_memory(client):
+    info = await client.info("memory")
+    return info["used_memory"]
+
+
+async def bench_memory(args):
+    client = await connect_redis(args)
+
+    events = generate_events(args.count, 0)
+    compact = DedupKeyCodec("compact")
+    variants = (
+        ("legacy", DedupKeyCodec("legacy"), None),
+        ("compact", compact, None),
+        ("buckets", compact, BucketStorage(compact, 7 * 24 * 60 * 60, prefix_chars=args.bucket_prefix_chars)),
+        ("bitmap", compact, BitmapStorage(compact, 7 * 24 * 60 * 60, expected_items=len(events), fp_rate=args.bitmap_fp_rate)),
+    )
+
+    print(f"{len(events)} уникальных событий на вариант")
+    for name, codec, storage in variants:
+        await client.flushdb()
+        before = await used_memory(client)
+
+        variant_events = events
+        if isinstance(storage, BitmapStorage):
+            # Фильтр рассчитан на один тип события
+            variant_events = [{**event, 'event_name': 'app_list'} for event in events]
+
+        deduplicator = Deduplicator(client, codec=codec, storage=storage)
+        for start in range(0, len(variant_events), args.batch_size):
+            await deduplicator.is_duplicate_many(variant_events[start:start + args.batch_size])
+
+        after = await used_memory(client)
+        sample_keys = [key async for key in client.scan_iter(count=1000)][:200]
+        sample = [await client.memory_usage(key) or 0 for key in sample_keys]
+
+        print(
+            f"{name:>8}: {len(sample_keys)} ключей в выборке, MEMORY USAGE {sum(sample) / max(1, len(sample)):.1f} B/key, "
+            f"used_memory {(after - before) / len(events):.1f} B/event"
+        )
+
+    await client.flushdb()
+    await client.aclose()
+
+
+def bench_hash(args):
+    """Хешей в секунду на одно ядро для каждой схемы хеширования."""
+    events = generate_events(min(args.count, 10000), 0)
+    print(f"{args.hash_rounds} проходов по {len(events)} событиям, одно ядро")
+
+    for version, calculate_hash in sorted(HASH_FUNCTIONS.items()):
+        started = time.perf_counter()
+        for _ in range(args.hash_rounds):
+            for event in events:
+                calculate_hash(event)
+        elapsed = time.perf_counter() - started
+        total = args.hash_rounds * len(events)
+        print(f"      v{version}: {total / elapsed:,.0f} hashes/s, {elapsed / total * 1e6:.2f} us/hash")
+
+
+def bench_shards(args):
+    """Доля ключей, меняющих шард при добавлении узла, и равномерность раскладки."""
+    calculate_hash = HASH_FUNCTIONS[1]
+    samples = [calculate_hash(event) for event in generate_events(args.count, 0)]
+    print(f"{len(samples)} хешей, {args.from_shards} -> {args.to_shards} шардов")
+
+    for name in ROUTERS:
+        previous_router = create_router(name, args.from_shards)
+        router = create_router(name, args.to_shards)
+        counts = [0] * router.shard_count
+        for event_hash in samples:
+            counts[router.shard(event_hash)] += 1
+        print(
+            f"{name:>8}: переезжает {moved_fraction(router, previous_router, samples):.1%} ключей, "
+            f"самый загруженный шард {max(counts) / len(samples):.1%} (идеал {1 / router.shard_count:.1%})"
+        )
+
+
+def main():
+    """Основная функция."""
+    parser = argparse.ArgumentParser(description='Бенчмарки дедупликатора KION Event Deduplicator')
+    parser.add_argument('--host', default=os.getenv('REDIS_HOST', 'localhost'), help='Хост Redis')
+    parser.add_argument('--port', type=int, default=int(os.getenv('REDIS_PORT', '6379')), help='Порт Redis')
+    parser.add_argument('--db', type=int, default=15, help='Номер БД Redis (будет очищена!)')
+    parser.add_argument('--count', type=int, default=20000, help='Количество событий')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.7, help='Доля дубликатов (от 0 до 1)')
+    parser.add_argument('--concurrency', type=int, default=100, help='Количество одновременных проверок')
+    parser.add_argument('--batch-size', type=int, default=500, help='Размер пакета для is_duplicate_many')
+    parser.add_argument('--bucket-prefix-chars', type=int, default=3, help='Длина префикса хеша в ключе бакета')
+    parser.add_argument('--bitmap-fp-rate', type=float, default=0.001, help='Доля ложных дубликатов для bitmap-режима')
+    parser.add_argument('--windows', default='0,0.5,1,2', help='Окна микробатчинга в мс через запятую')
+    parser.add_argument('--hot-cache-entries', type=int, default=100000, help='Размер локального кэша дубликатов')
+    parser.add_argument('--from-shards', type=int, default=4, help='Число шардов до решардинга')
+    parser.add_argument('--to-shards', type=int, default=5, help='Число шардов после решардинга')
+    parser.add_argument('--hash-rounds', type=int, default=20, help='Количество проходов в бенчмарке хеширования')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('protocol', help='Сравнение протоколов проверки: обращения к Redis на событие и p99')
+    subparsers.add_parser('memory', help='Память Redis на одно событие для разных форматов хранения')
+    subparsers.add_parser('batching', help='Микробатчинг одиночных проверок: задержка против пропускной способности')
+    subparsers.add_parser('routes', help='Запросов в секунду на ядро: /api/event против /api/event/raw (Kafka и PostgreSQL не нужны)')
+    subparsers.add_parser('hash', help='Скорость схем хеширования событий (Redis не нужен)')
+    subparsers.add_parser('shards', help='Перенос ключей при решардинге для разных маршрутизаторов (Redis не нужен)')
+
+    args = parser.parse_args()
+
+    if args.command == 'protocol':
+        asyncio.run(bench_protocol(args))
+    elif args.command == 'memory':
+        asyncio.run(bench_memory(args))
+    elif args.command == 'batching':
+        asyncio.run(bench_batching(args))
+    elif args.command == 'routes':
+        asyncio.run(bench_routes(args))
+    elif args.command == 'hash':
+        bench_hash(args)
+    elif args.command == 'shards':
+        bench_shards(args)
+
+
+if __name__ == "__main__":
+    main()
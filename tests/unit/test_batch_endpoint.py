@@ -0,0 +1,124 @@
+"""POST /api/events/batch: разбор JSON-массива и NDJSON, лимиты пакета (fakeredis)."""
+from typing import List, Optional
+
+import orjson
+import pytest
+from fastapi import BackgroundTasks, HTTPException
+from starlette.requests import Request
+
+from app.api import events as events_api
+from app.deduplicator import Deduplicator
+
+
+class RecordingKafka:
+    def __init__(self):
+        self.sent = []
+
+    async def send_batch(self, topic, messages, keys=None, confirm=False):
+        self.sent.extend(messages)
+        return True
+
+
+class RecordingPostgres:
+    def __init__(self):
+        self.saved = []
+
+    async def save_events_batch(self, events, event_hashes, raise_rejected=False):
+        self.saved.extend(event_hashes)
+        return True
+
+
+class StreamedBody:
+    """Тело запроса, отдаваемое ASGI-сообщениями по частям; считает прочитанные части."""
+
+    def __init__(self, chunks: List[bytes]):
+        self.chunks = list(chunks)
+        self.reads = 0
+
+    async def receive(self):
+        self.reads += 1
+        chunk = self.chunks[self.reads - 1] if self.reads <= len(self.chunks) else b""
+        return {"type": "http.request", "body": chunk, "more_body": self.reads < len(self.chunks)}
+
+
+def make_request(body: StreamedBody, content_type: str = "application/json",
+                 content_length: Optional[int] = None) -> Request:
+    headers = [(b"content-type", content_type.encode())]
+    if content_length is not None:
+        headers.append((b"content-length", str(content_length).encode()))
+    scope = {"type": "http", "method": "POST", "path": "/api/events/batch", "headers": headers}
+    return Request(scope, body.receive)
+
+
+@pytest.fixture
+def deduplicator(redis_client):
+    return Deduplicator(redis_client)
+
+
+@pytest.fixture
+def post_batch(deduplicator):
+    async def post(request: Request):
+        background_tasks = BackgroundTasks()
+        response = await events_api.process_event_batch(
+            request, background_tasks, RecordingKafka(), deduplicator, RecordingPostgres()
+        )
+        return response, background_tasks
+    return post
+
+
+@pytest.mark.asyncio
+async def test_json_array_reports_status_per_event(post_batch, make_event):
+    body = orjson.dumps([make_event(1), make_event(2), make_event(1), {"client_id": "x"}, "garbage"])
+
+    response, background_tasks = await post_batch(make_request(StreamedBody([body])))
+
+    assert response.statuses == "AADII"
+    assert (response.accepted, response.duplicates, response.invalid) == (2, 1, 2)
+    assert response.hashes[0] == response.hashes[2] and response.hashes[3] is None
+    assert len(background_tasks.tasks) == 2
+
+
+@pytest.mark.asyncio
+async def test_ndjson_bad_line_is_marked_invalid(post_batch, make_event):
+    lines = [orjson.dumps(make_event(1)), b"{not json", orjson.dumps(make_event(2))]
+
+    response, _ = await post_batch(make_request(StreamedBody([b"\n".join(lines)]), "application/x-ndjson"))
+
+    assert response.statuses == "AIA"
+
+
+@pytest.mark.asyncio
+async def test_declared_oversized_body_is_rejected_before_reading(post_batch, monkeypatch):
+    monkeypatch.setattr(events_api, "batch_max_bytes", 1024)
+    body = StreamedBody([b"[" + b" " * 4096 + b"]"])
+
+    with pytest.raises(HTTPException) as error:
+        await post_batch(make_request(body, content_length=4098))
+
+    assert error.value.status_code == 413
+    assert body.reads == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("content_type", ["application/json", "application/x-ndjson"])
+async def test_streamed_body_is_cut_off_at_byte_limit(post_batch, make_event, monkeypatch, content_type):
+    monkeypatch.setattr(events_api, "batch_max_bytes", 1024)
+    # Без Content-Length (chunked): лимит проверяется по мере чтения
+    body = StreamedBody([orjson.dumps(make_event(index)) + b"\n" for index in range(100)])
+
+    with pytest.raises(HTTPException) as error:
+        await post_batch(make_request(body, content_type))
+
+    assert error.value.status_code == 413
+    assert body.reads < len(body.chunks)
+
+
+@pytest.mark.asyncio
+async def test_ndjson_over_event_limit_is_rejected(post_batch, make_event, monkeypatch):
+    monkeypatch.setattr(events_api, "batch_max_events", 3)
+    lines = b"\n".join(orjson.dumps(make_event(index)) for index in range(5))
+
+    with pytest.raises(HTTPException) as error:
+        await post_batch(make_request(StreamedBody([lines]), "application/x-ndjson"))
+
+    assert error.value.status_code == 413
@@ -0,0 +1,216 @@
+"""BatchWriter и EventConsumer: запись буферов в PostgreSQL (без внешних сервисов)."""
+import asyncio
+
+import orjson
+import pytest
+
+from app.batch_writer import AdaptiveBatchController, BatchWriter
+from app.consumers.event_consumer import EventConsumer
+from app.dead_letter import DeadLetterSink
+from app.dedup_codec import DedupKeyCodec
+from app.dedup_storage import KeyStorage
+from app.deduplicator import Deduplicator
+from app.services.postgres_service import BatchRejectedError
+from app.sharding import ModuloRouter
+
+
+class FakePostgres:
+    def __init__(self, shard_count: int = 1):
+        self.router = ModuloRouter(shard_count)
+        self.saved = []
+        self.batch_calls = 0
+
+    async def save_events_batch(self, events, event_hashes, raise_rejected=False):
+        self.batch_calls += 1
+        await asyncio.sleep(0)
+        self.saved.extend(event_hashes)
+        return True
+
+
+class IdleKafka:
+    """Топик без сообщений: цикл чтения ждет, пока задачу не отменят."""
+
+    async def connect_consumer(self, *args, **kwargs):
+        pass
+
+    async def consume_messages(self, topic, callback, max_concurrency, queue_size):
+        await asyncio.Event().wait()
+
+    def stop_consuming(self):
+        pass
+
+
+class FakeRedisService:
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.redis_pool = None
+        self.codec = DedupKeyCodec()
+        self.storage = KeyStorage(self.codec, 3600)
+
+
+@pytest.mark.asyncio
+async def test_consumer_writes_buffered_events_when_cancelled(redis_client, make_event):
+    postgres = FakePostgres()
+    consumer = EventConsumer(IdleKafka(), FakeRedisService(redis_client), postgres,
+                             writer_options={"max_batch_size": 1000, "max_batch_age": 60})
+    task = asyncio.create_task(consumer.start())
+    await asyncio.sleep(0)
+
+    for index in range(5):
+        await consumer._process_event(make_event(index))
+    assert postgres.saved == []
+
+    await consumer.stop()
+    task.cancel()
+    await asyncio.wait_for(asyncio.gather(task, return_exceptions=True), timeout=1)
+
+    assert len(postgres.saved) == 5
+
+
+@pytest.mark.asyncio
+async def test_batch_consumer_checks_batch_once_and_trusts_api_hashes(redis_client, make_event, monkeypatch):
+    postgres = FakePostgres()
+    consumer = EventConsumer(IdleKafka(), FakeRedisService(redis_client), postgres, trust_dedup_hash=True,
+                             writer_options={"max_batch_size": 1000, "max_batch_age": 60})
+    consumer.deduplicator = deduplicator = Deduplicator(redis_client)
+    checked = []
+    check_many = deduplicator.is_duplicate_many
+
+    async def counting_check_many(events, event_hashes=None):
+        checked.append(len(events))
+        return await check_many(events, event_hashes)
+
+    monkeypatch.setattr(deduplicator, "is_duplicate_many", counting_check_many)
+    trusted = {**make_event(9), "_dedup_hash": "a" * 64}
+
+    await consumer._process_batch([make_event(1), make_event(2), make_event(1), trusted])
+    await consumer.writer.close()
+
+    # Одна проверка на пакет; событие с хешем от API в нее не входит
+    assert checked == [3]
+    assert "_dedup_hash" not in trusted
+    assert sorted(postgres.saved) == sorted([deduplicator.calculate_hash(make_event(1)),
+                                             deduplicator.calculate_hash(make_event(2)), "a" * 64])
+    assert (consumer.processed_count, consumer.duplicate_count, consumer.error_count) == (4, 1, 0)
+
+
+@pytest.mark.asyncio
+async def test_writer_flushes_by_size_without_blocking_add(make_event):
+    postgres = FakePostgres(shard_count=2)
+    writer = BatchWriter(postgres, max_batch_size=10, max_batch_age=60)
+    writer.start()
+
+    hashes = [f"{index:08x}" + "0" * 56 for index in range(40)]
+    for index, event_hash in enumerate(hashes):
+        writer.add(make_event(index), event_hash)
+    await writer.close()
+
+    assert sorted(postgres.saved) == sorted(hashes)
+    assert writer.flush_reasons["size"] == 4
+
+
+class PoisonPostgres(FakePostgres):
+    """Отклоняет пакет целиком, если в нем есть событие с полем bad."""
+
+    async def save_events_batch(self, events, event_hashes, raise_rejected=False):
+        self.batch_calls += 1
+        if any(event.get("bad") for event in events):
+            if raise_rejected:
+                raise BatchRejectedError("invalid byte sequence for encoding \"UTF8\"")
+            return False
+        self.saved.extend(event_hashes)
+        return True
+
+
+class UndeliverableKafka:
+    """Ставит сообщения в пакет, но брокер их не подтверждает."""
+
+    def __init__(self):
+        self.confirm_requested = False
+
+    async def send_batch(self, topic, messages, keys=None, confirm=False):
+        self.confirm_requested = confirm
+        return not confirm
+
+
+@pytest.mark.asyncio
+async def test_bisection_writes_good_rows_in_bulk_and_dead_letters_bad_ones(tmp_path, make_event):
+    postgres = PoisonPostgres()
+    spool = tmp_path / "dead-letter.ndjson"
+    kafka = UndeliverableKafka()
+    writer = BatchWriter(postgres, max_batch_size=256, max_batch_age=60,
+                         dead_letter=DeadLetterSink(kafka, "product-events-dlq", str(spool)))
+
+    bad_positions = {7, 100, 101}
+    hashes = [f"{index:064x}" for index in range(256)]
+    for index, event_hash in enumerate(hashes):
+        writer.add(make_event(index, bad=index in bad_positions), event_hash)
+    await writer.close()
+
+    assert len(postgres.saved) == 256 - len(bad_positions)
+    assert postgres.batch_calls < 40
+    assert writer.rejected == len(bad_positions)
+
+    # Отправка в Kafka не подтверждена: записи не теряются, а попадают в файл
+    assert kafka.confirm_requested
+    spooled = [orjson.loads(line) for line in spool.read_bytes().splitlines()]
+    assert sorted(record["event_hash"] for record in spooled) == sorted(hashes[i] for i in bad_positions)
+    assert all("invalid byte sequence" in record["error"] for record in spooled)
+
+
+def test_controller_grows_additively_and_backs_off_multiplicatively():
+    controller = AdaptiveBatchController(initial_size=100, min_size=10, max_size=130,
+                                         initial_linger=0.1, min_linger=0.05, max_linger=1.0,
+                                         target_latency=0.1)
+
+    # Буфер заполняется раньше срока, запись быстрая: размер растет на шаг
+    for _ in range(5):
+        controller.observe(0, controller.batch_size(0), 0.01, "size", backlog=False)
+    assert controller.batch_size(0) == 130
+    assert controller.linger(0) > 0.1
+
+    # Запись дольше целевой: размер падает вдвое, но не ниже min_size
+    controller.observe(0, 130, 0.5, "size", backlog=False)
+    assert controller.batch_size(0) == 65
+    for _ in range(10):
+        controller.observe(0, 10, 0.5, "size", backlog=False)
+    assert controller.batch_size(0) == 10
+
+    # Шарды подстраиваются независимо
+    assert controller.batch_size(1) == 100
+    assert controller.stats()[0]["decreases"] == 11
+
+
+def test_controller_does_not_grow_when_throughput_drops():
+    controller = AdaptiveBatchController(initial_size=100, target_latency=1.0)
+    controller.observe(0, 100, 0.01, "size", backlog=False)
+    size = controller.batch_size(0)
+
+    controller.observe(0, size, 0.5, "size", backlog=False)
+    assert controller.batch_size(0) == size
+
+
+def test_controller_shrinks_size_and_linger_when_idle():
+    controller = AdaptiveBatchController(initial_size=100, min_size=10, initial_linger=1.0, min_linger=0.05)
+
+    controller.observe(0, 3, 0.001, "age", backlog=False)
+
+    assert controller.batch_size(0) == 50
+    assert controller.linger(0) == 0.5
+
+
+@pytest.mark.asyncio
+async def test_adaptive_writer_flushes_by_tuned_size(make_event):
+    postgres = FakePostgres()
+    controller = AdaptiveBatchController(initial_size=10, min_size=10, max_size=40, initial_linger=60,
+                                         min_linger=60, max_linger=60, target_latency=10)
+    writer = BatchWriter(postgres, max_batch_size=10, max_batch_age=60, controller=controller)
+
+    for index in range(200):
+        writer.add(make_event(index), f"{index:064x}")
+        await asyncio.sleep(0)
+    await writer.close()
+
+    assert len(postgres.saved) == 200
+    assert controller.batch_size(0) > 10
+    assert postgres.batch_calls < 20
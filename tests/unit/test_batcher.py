@@ -0,0 +1,40 @@
+"""Микробатчинг проверок дедупликации: пакеты и их задачи (fakeredis)."""
+import asyncio
+
+import pytest
+
+from app.batcher import DedupBatcher
+from app.deduplicator import Deduplicator
+
+
+@pytest.fixture
+def deduplicator(redis_client):
+    return Deduplicator(redis_client)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_checks_share_batches(deduplicator, make_event):
+    batcher = DedupBatcher(deduplicator, max_batch_size=16, max_delay=0)
+    events = [make_event(index % 20) for index in range(40)]
+
+    results = await asyncio.gather(*(batcher.is_duplicate(event) for event in events))
+
+    assert [result.is_duplicate for result in results] == [False] * 20 + [True] * 20
+    assert batcher.batches == 3
+    assert batcher.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_close_waits_for_batches_in_flight(deduplicator, make_event):
+    batcher = DedupBatcher(deduplicator, max_batch_size=4, max_delay=60)
+    checks = [asyncio.create_task(batcher.is_duplicate(make_event(index))) for index in range(6)]
+    await asyncio.sleep(0)
+
+    # Первый пакет ушел по размеру, два события ждут таймера
+    assert batcher.stats()["pending"] == 2
+    await batcher.close()
+
+    assert batcher.stats()["in_flight"] == 0
+    assert batcher.stats()["pending"] == 0
+    assert all(check.done() for check in checks)
+    assert not any(check.result().is_duplicate for check in checks)
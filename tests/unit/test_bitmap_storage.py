@@ -0,0 +1,95 @@
+"""Движок bitmap: фильтр Блума в строках Redis и выбор движка по типу события (fakeredis)."""
+import pytest
+
+from app.dedup_codec import DedupKeyCodec
+from app.dedup_storage import BitmapStorage, EventTypeStorage, KeyStorage
+from app.deduplicator import Deduplicator
+
+WINDOW_SECONDS = 60 * 60
+
+
+@pytest.fixture
+def codec():
+    return DedupKeyCodec()
+
+
+@pytest.fixture
+def bitmap(codec):
+    return BitmapStorage(codec, WINDOW_SECONDS, expected_items=10_000, fp_rate=0.001, partitions=4)
+
+
+@pytest.fixture
+def deduplicator(redis_client, codec, bitmap):
+    return Deduplicator(redis_client, codec=codec, storage=bitmap)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000 * WINDOW_SECONDS]
+    monkeypatch.setattr("app.dedup_storage.time.time", lambda: now[0])
+    return now
+
+
+@pytest.mark.asyncio
+async def test_repeat_is_duplicate_without_timestamp(deduplicator, redis_client, make_event, clock):
+    event = make_event()
+
+    first = await deduplicator.is_duplicate(event)
+    second = await deduplicator.is_duplicate(event)
+
+    assert not first.is_duplicate
+    assert second.is_duplicate and second.original_timestamp is None
+    keys = await redis_client.keys("*")
+    # Одна строка фильтра на окно и партицию, без ключа на событие
+    assert len(keys) == 1 and keys[0].startswith(BitmapStorage.PREFIX.encode())
+    assert await redis_client.expiretime(keys[0]) == (clock[0] // WINDOW_SECONDS + 2) * WINDOW_SECONDS
+
+
+@pytest.mark.asyncio
+async def test_previous_window_is_read_until_it_rotates_out(deduplicator, make_event, clock):
+    event = make_event()
+    await deduplicator.is_duplicate(event)
+
+    clock[0] += WINDOW_SECONDS
+    assert (await deduplicator.is_duplicate(event)).is_duplicate
+
+    # Через два окна ни текущее, ни предыдущее окно событие не видели
+    clock[0] += 2 * WINDOW_SECONDS
+    assert not (await deduplicator.is_duplicate(event)).is_duplicate
+
+
+@pytest.mark.asyncio
+async def test_batch_has_no_false_negatives(deduplicator, make_event, clock):
+    events = [make_event(index) for index in range(200)]
+
+    first = await deduplicator.is_duplicate_many(events)
+    second = await deduplicator.is_duplicate_many(events)
+
+    assert sum(result.is_duplicate for result in first) <= 2
+    assert all(result.is_duplicate for result in second)
+
+
+@pytest.mark.asyncio
+async def test_forget_leaves_shared_bits(deduplicator, make_event, clock):
+    event = make_event()
+    result = await deduplicator.is_duplicate(event)
+
+    await deduplicator.forget([event], [result.event_hash])
+
+    assert (await deduplicator.is_duplicate(event)).is_duplicate
+
+
+@pytest.mark.asyncio
+async def test_event_type_storage_uses_bitmap_only_for_listed_events(redis_client, codec, bitmap, make_event, clock):
+    storage = EventTypeStorage(KeyStorage(codec, WINDOW_SECONDS), {"app_list": bitmap})
+    deduplicator = Deduplicator(redis_client, codec=codec, storage=storage)
+    heartbeat, play = make_event(1, event_name="app_list"), make_event(2)
+
+    await deduplicator.is_duplicate_many([heartbeat, play])
+    results = await deduplicator.is_duplicate_many([heartbeat, play])
+
+    assert [result.is_duplicate for result in results] == [True, True]
+    assert results[0].original_timestamp is None
+    assert results[1].original_timestamp is not None
+    assert await redis_client.exists(codec.key(results[1].event_hash))
+    assert not await redis_client.exists(codec.key(results[0].event_hash))
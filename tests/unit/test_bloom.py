@@ -0,0 +1,110 @@
+"""Фильтр Блума: в процессе и общий для воркеров в mmap-сегменте."""
+import hashlib
+import multiprocessing
+
+import pytest
+
+from app.bloom import RotatingBloomFilter, SharedRotatingBloomFilter, bloom_parameters
+from app.deduplicator import Deduplicator
+
+# Позиции битов берутся из самого хеша, поэтому нужны настоящие дайджесты
+HASHES = [hashlib.sha256(str(index).encode()).hexdigest() for index in range(1000)]
+
+
+def test_filter_has_no_false_negatives_and_keeps_target_rate():
+    assert bloom_parameters(1000, 0.01) == (9586, 7)
+    bloom = RotatingBloomFilter(500, 0.01)
+    for event_hash in HASHES[:500]:
+        bloom.add(event_hash)
+
+    assert all(bloom.might_contain(event_hash) for event_hash in HASHES[:500])
+    false_positives = sum(bloom.might_contain(event_hash) for event_hash in HASHES[500:])
+    assert false_positives <= 15
+
+
+def test_in_process_filter_forgets_after_two_windows(monkeypatch):
+    bloom = RotatingBloomFilter(1000, 0.01, window_seconds=60)
+    now = 1_000_000 * 60
+    monkeypatch.setattr("app.bloom.time.time", lambda: now)
+    bloom.add(HASHES[0])
+
+    now += 60
+    assert bloom.might_contain(HASHES[0])
+    now += 60
+    assert not bloom.might_contain(HASHES[0])
+
+
+@pytest.mark.asyncio
+async def test_filter_miss_reads_timestamp_written_by_another_process(redis_client, make_event):
+    first = Deduplicator(redis_client, bloom_filter=RotatingBloomFilter(1000, 0.01))
+    other = Deduplicator(redis_client, bloom_filter=RotatingBloomFilter(1000, 0.01))
+    event = make_event()
+
+    assert not (await first.is_duplicate(event)).is_duplicate
+    result = await other.is_duplicate(event)
+    repeat = await first.is_duplicate(event)
+
+    # Фильтр второго процесса событие не видел: SET NX без GET и дочитывание метки
+    assert result.is_duplicate and result.original_timestamp == repeat.original_timestamp
+    assert first.bloom_filter.hits == 1
+    assert other.bloom_filter.foreign_misses == 1
+    assert first.bloom_filter.true_negatives == 1
+
+
+def add_hashes(path: str, hashes) -> None:
+    bloom = SharedRotatingBloomFilter(10000, 0.01, path=path)
+    for event_hash in hashes:
+        bloom.add(event_hash)
+
+
+def test_hashes_added_by_another_process_are_visible(tmp_path):
+    path = str(tmp_path / "bloom")
+    bloom = SharedRotatingBloomFilter(10000, 0.01, path=path)
+
+    worker = multiprocessing.get_context("fork").Process(target=add_hashes, args=(path, HASHES))
+    worker.start()
+    worker.join(timeout=30)
+
+    assert worker.exitcode == 0
+    assert all(bloom.might_contain(event_hash) for event_hash in HASHES)
+
+
+def test_segment_is_not_shared_between_different_parameters(tmp_path):
+    path = str(tmp_path / "bloom")
+    bloom = SharedRotatingBloomFilter(10000, 0.01, path=path)
+    other = SharedRotatingBloomFilter(20000, 0.01, path=path)
+    bloom.add(HASHES[0])
+
+    assert other.path != bloom.path
+    assert not other.might_contain(HASHES[0])
+
+
+def test_rotation_is_seen_by_all_workers(tmp_path, monkeypatch):
+    path = str(tmp_path / "bloom")
+    first = SharedRotatingBloomFilter(10000, 0.01, window_seconds=60, path=path)
+    second = SharedRotatingBloomFilter(10000, 0.01, window_seconds=60, path=path)
+
+    now = 1_000_000 * 60
+    monkeypatch.setattr("app.bloom.time.time", lambda: now)
+    first.add(HASHES[0])
+
+    # Следующее окно: предыдущее поколение еще читается
+    now += 60
+    second.add(HASHES[1])
+    assert first.might_contain(HASHES[0]) and first.might_contain(HASHES[1])
+
+    # Через два окна второй воркер очищает слот, и это видит первый
+    now += 60
+    second.add(HASHES[2])
+    assert not first.might_contain(HASHES[0])
+    assert first.might_contain(HASHES[1]) and first.might_contain(HASHES[2])
+
+
+def test_shared_filter_matches_in_process_filter(tmp_path):
+    shared = SharedRotatingBloomFilter(1000, 0.01, path=str(tmp_path / "bloom"))
+    local = RotatingBloomFilter(1000, 0.01)
+    for event_hash in HASHES[:500]:
+        shared.add(event_hash)
+        local.add(event_hash)
+
+    assert [shared.might_contain(h) for h in HASHES] == [local.might_contain(h) for h in HASHES]
@@ -0,0 +1,77 @@
+"""Движок buckets: срок жизни бакета и разбор даты события (fakeredis)."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.dedup_codec import DedupKeyCodec
+from app.dedup_storage import BucketStorage
+from app.deduplicator import Deduplicator
+
+TTL_DAYS = 7
+
+
+@pytest.fixture
+def deduplicator(redis_client):
+    codec = DedupKeyCodec()
+    storage = BucketStorage(codec, TTL_DAYS * 24 * 60 * 60)
+    return Deduplicator(redis_client, ttl_days=TTL_DAYS, codec=codec, storage=storage)
+
+
+@pytest.mark.asyncio
+async def test_event_older_than_ttl_is_still_deduplicated(deduplicator, redis_client, make_event):
+    old_date = (datetime.utcnow() - timedelta(days=TTL_DAYS * 3)).strftime("%Y-%m-%dT10:00:00")
+    event = make_event(event_datetime=old_date)
+
+    first = await deduplicator.is_duplicate(event)
+    second = await deduplicator.is_duplicate(event)
+
+    assert not first.is_duplicate
+    assert second.is_duplicate
+    bucket, _ = deduplicator.storage.bucket_key(first.event_hash, event)
+    assert await redis_client.ttl(bucket) > (TTL_DAYS * 24 * 60 * 60) - 60
+
+
+@pytest.mark.asyncio
+async def test_recent_event_bucket_expires_after_its_day(deduplicator, redis_client, make_event):
+    today = datetime.utcnow().strftime("%Y-%m-%dT00:00:01")
+    result = await deduplicator.is_duplicate(make_event(event_datetime=today))
+
+    bucket, _ = deduplicator.storage.bucket_key(result.event_hash, make_event(event_datetime=today))
+    assert await redis_client.ttl(bucket) > TTL_DAYS * 24 * 60 * 60
+
+
+@pytest.mark.asyncio
+async def test_impossible_date_falls_back_to_undated_bucket(deduplicator, make_event):
+    event = make_event(event_datetime="2026-13-45T10:00:00")
+
+    first = await deduplicator.is_duplicate(event)
+    second = await deduplicator.is_duplicate(event)
+
+    assert not first.is_duplicate
+    assert second.is_duplicate
+    bucket, _ = deduplicator.storage.bucket_key(first.event_hash, event)
+    assert f":{BucketStorage.UNDATED}:" in bucket
+
+
+@pytest.mark.asyncio
+async def test_far_future_date_does_not_create_an_immortal_bucket(deduplicator, redis_client, make_event):
+    event = make_event(event_datetime="2999-12-31T10:00:00")
+
+    first = await deduplicator.is_duplicate(event)
+    second = await deduplicator.is_duplicate(event)
+
+    assert not first.is_duplicate
+    assert second.is_duplicate
+    bucket, _ = deduplicator.storage.bucket_key(first.event_hash, event)
+    assert f":{BucketStorage.UNDATED}:" in bucket
+    assert 0 < await redis_client.ttl(bucket) <= 2 * TTL_DAYS * 24 * 60 * 60
+
+
+@pytest.mark.asyncio
+async def test_tomorrow_keeps_its_bucket_with_bounded_ttl(deduplicator, redis_client, make_event):
+    tomorrow = (datetime.utcnow() + timedelta(days=1)).strftime("%Y-%m-%dT23:00:00")
+    result = await deduplicator.is_duplicate(make_event(event_datetime=tomorrow))
+
+    bucket, _ = deduplicator.storage.bucket_key(result.event_hash, make_event(event_datetime=tomorrow))
+    assert f":{tomorrow[:10]}:" in bucket
+    assert await redis_client.ttl(bucket) <= 2 * TTL_DAYS * 24 * 60 * 60
@@ -0,0 +1,82 @@
+"""Пакетная проверка is_duplicate_many: один pipeline на шард (fakeredis)."""
+import pytest
+
+from app.deduplicator import Deduplicator
+
+
+class CountingShard:
+    """Шард, который считает отправленные pipeline и команды в них."""
+
+    def __init__(self, client):
+        self.client = client
+        self.pipelines = 0
+        self.commands = 0
+
+    def pipeline(self, *args, **kwargs):
+        self.pipelines += 1
+        return CountingPipeline(self, self.client.pipeline(*args, **kwargs))
+
+
+class CountingPipeline:
+    def __init__(self, shard: CountingShard, pipe):
+        self.shard = shard
+        self.pipe = pipe
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    async def execute(self, *args, **kwargs):
+        self.shard.commands += len(self.pipe.command_stack)
+        return await self.pipe.execute(*args, **kwargs)
+
+
+@pytest.fixture
+def shards(make_shards):
+    return [CountingShard(client) for client in make_shards(3)]
+
+
+@pytest.fixture
+def deduplicator(shards):
+    return Deduplicator(shards[0], shard_count=len(shards), redis_pool=shards)
+
+
+@pytest.mark.asyncio
+async def test_batch_sends_one_pipeline_per_shard(deduplicator, shards, make_event):
+    events = [make_event(index) for index in range(30)]
+
+    results = await deduplicator.is_duplicate_many(events)
+
+    assert [result.event_hash for result in results] == [deduplicator.calculate_hash(event) for event in events]
+    assert not any(result.is_duplicate for result in results)
+    assert [shard.pipelines for shard in shards] == [1, 1, 1]
+    assert sum(shard.commands for shard in shards) == len(events)
+    for result in results:
+        shard = shards[deduplicator._get_shard_index(result.event_hash)]
+        assert await shard.client.exists(deduplicator.codec.key(result.event_hash))
+
+
+@pytest.mark.asyncio
+async def test_repeat_inside_batch_is_duplicate(deduplicator, make_event):
+    events = [make_event(1), make_event(2), make_event(1)]
+
+    results = await deduplicator.is_duplicate_many(events)
+
+    assert [result.is_duplicate for result in results] == [False, False, True]
+    assert results[2].original_timestamp is not None
+
+
+@pytest.mark.asyncio
+async def test_second_batch_reports_original_timestamps(deduplicator, make_event):
+    events = [make_event(index) for index in range(10)]
+    await deduplicator.is_duplicate_many(events)
+
+    results = await deduplicator.is_duplicate_many(events + [make_event(99)])
+
+    assert [result.is_duplicate for result in results] == [True] * 10 + [False]
+    assert all(result.original_timestamp is not None for result in results[:10])
+
+
+@pytest.mark.asyncio
+async def test_empty_batch_does_not_touch_redis(deduplicator, shards):
+    assert await deduplicator.is_duplicate_many([]) == []
+    assert all(shard.pipelines == 0 for shard in shards)
@@ -0,0 +1,396 @@
+"""KafkaService и партиционер продюсера на поддельных клиентах aiokafka (без брокера)."""
+import asyncio
+import hashlib
+from types import SimpleNamespace
+
+import pytest
+from aiokafka import TopicPartition
+from aiokafka.errors import KafkaError
+
+from app.services import kafka_service as kafka_service_module
+from app.services.kafka_service import KafkaService, PartitionPipelines
+from app.sharding import ModuloRouter, ShardAffinityPartitioner
+
+TOPIC = "events"
+
+
+def event_hash(index: int) -> str:
+    return hashlib.sha256(str(index).encode()).hexdigest()
+
+
+class PartitionedConsumer:
+    """Консьюмер с заранее разложенными по партициям сообщениями; getmany отдает их порциями."""
+
+    def __init__(self, messages_by_partition):
+        self.pending = {
+            TopicPartition(TOPIC, partition): [SimpleNamespace(value=value) for value in values]
+            for partition, values in messages_by_partition.items()
+        }
+        self.fetched = []
+
+    async def getmany(self, *partitions, timeout_ms=0, max_records=None):
+        await asyncio.sleep(0)
+        records = {}
+        for tp in partitions:
+            batch = self.pending.get(tp, [])[:max_records]
+            self.pending[tp] = self.pending.get(tp, [])[len(batch):]
+            if batch:
+                records[tp] = batch
+                self.fetched.append((tp.partition, len(batch)))
+        return records
+
+
+async def wait_for(condition, timeout: float = 1.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_affinity_partitioner_keeps_shard_partitions():
+    router = ModuloRouter(2)
+    partitioner = ShardAffinityPartitioner(router)
+    partitions = list(range(6))
+
+    used = set()
+    for index in range(200):
+        key = event_hash(index)
+        partition = partitioner(key.encode(), partitions, partitions)
+        assert partition % 2 == router.shard(key)
+        assert partitioner(key.encode(), partitions, partitions) == partition
+        used.add(partition)
+    # Внутри шарда события расходятся по всем его партициям
+    assert used == set(partitions)
+
+
+def test_affinity_partitioner_with_fewer_partitions_than_shards():
+    router = ModuloRouter(4)
+    partitioner = ShardAffinityPartitioner(router)
+
+    for index in range(50):
+        key = event_hash(index)
+        assert partitioner(key.encode(), [0, 1], [0, 1]) == router.shard(key) % 2
+
+
+def test_affinity_partitioner_without_key_uses_available_partitions():
+    partitioner = ShardAffinityPartitioner(ModuloRouter(2))
+
+    assert {partitioner(None, [0, 1, 2], [2]) for _ in range(20)} == {2}
+
+
+@pytest.mark.asyncio
+async def test_partition_pipelines_process_each_assigned_partition():
+    service = KafkaService()
+    service.running = True
+    consumer = PartitionedConsumer({0: [{"n": n} for n in range(5)], 1: [{"n": n} for n in range(5, 8)]})
+    processed = []
+
+    async def callback(value):
+        processed.append(value["n"])
+
+    pipelines = PartitionPipelines(service, consumer, callback, max_concurrency=2, max_records=2)
+    await pipelines.on_partitions_assigned([TopicPartition(TOPIC, 0), TopicPartition(TOPIC, 1)])
+    await wait_for(lambda: len(processed) == 8)
+
+    assert sorted(processed) == list(range(8))
+    assert pipelines.stats() == {"assigned": [0, 1], "processed": {0: 5, 1: 3}}
+    # Каждая партиция читается своими порциями не больше max_records
+    assert all(count <= 2 for _, count in consumer.fetched)
+
+    await pipelines.stop()
+    assert pipelines.stats()["assigned"] == []
+
+
+@pytest.mark.asyncio
+async def test_revoked_partition_pipeline_stops_and_others_continue():
+    service = KafkaService()
+    service.running = True
+    consumer = PartitionedConsumer({0: [], 1: []})
+    processed = []
+
+    async def callback(value):
+        processed.append(value)
+
+    pipelines = PartitionPipelines(service, consumer, callback, max_concurrency=2, max_records=10)
+    first, second = TopicPartition(TOPIC, 0), TopicPartition(TOPIC, 1)
+    await pipelines.on_partitions_assigned([first, second])
+    await pipelines.on_partitions_revoked([first])
+
+    consumer.pending[first].append(SimpleNamespace(value="revoked"))
+    consumer.pending[second].append(SimpleNamespace(value="kept"))
+    await wait_for(lambda: processed)
+    await asyncio.sleep(0.05)
+
+    assert processed == ["kept"]
+    assert pipelines.stats()["assigned"] == [1]
+    await pipelines.stop()
+
+
+@pytest.mark.asyncio
+async def test_partition_pipeline_survives_callback_errors():
+    service = KafkaService()
+    service.running = True
+    consumer = PartitionedConsumer({0: [{"n": n} for n in range(4)]})
+    processed = []
+
+    async def callback(value):
+        if value["n"] == 1:
+            raise ValueError("broken message")
+        processed.append(value["n"])
+
+    pipelines = PartitionPipelines(service, consumer, callback, max_concurrency=2, max_records=10)
+    await pipelines.on_partitions_assigned([TopicPartition(TOPIC, 0)])
+    await wait_for(lambda: pipelines.stats()["processed"][0] == 4)
+
+    assert processed == [0, 2, 3]
+    await pipelines.stop()
+
+
+class FakeProducer:
+    """Продюсер без брокера: send возвращает future, подтверждение выдает тест."""
+
+    instances = []
+
+    def __init__(self, **options):
+        self.options = options
+        self.futures = []
+        self.flushed = False
+        self.stopped = False
+        FakeProducer.instances.append(self)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        self.stopped = True
+
+    async def flush(self):
+        self.flushed = True
+        for future, _ in self.futures:
+            if not future.done():
+                future.set_result(SimpleNamespace(partition=0))
+
+    async def send(self, topic, value, key=None):
+        future = asyncio.get_running_loop().create_future()
+        self.futures.append((future, value))
+        return future
+
+    def acknowledge(self, index, partition=0):
+        self.futures[index][0].set_result(SimpleNamespace(partition=partition))
+
+
+@pytest.fixture
+def batched_service(monkeypatch):
+    FakeProducer.instances.clear()
+    monkeypatch.setattr("app.services.kafka_service.AIOKafkaProducer", FakeProducer)
+    return KafkaService()
+
+
+@pytest.mark.asyncio
+async def test_batched_producer_options_fall_back_to_gzip(batched_service, monkeypatch):
+    monkeypatch.setitem(kafka_service_module.COMPRESSION_CODECS, "lz4", lambda: False)
+
+    await batched_service.connect_producer(batched=True, linger_ms=20, max_batch_size=65536,
+                                           compression_type="lz4", max_in_flight=100)
+
+    producer, = FakeProducer.instances
+    assert producer.options["linger_ms"] == 20
+    assert producer.options["max_batch_size"] == 65536
+    assert producer.options["compression_type"] == "gzip"
+    assert batched_service.producer_stats()["mode"] == "batched"
+
+
+@pytest.mark.asyncio
+async def test_unknown_compression_is_rejected(batched_service):
+    with pytest.raises(ValueError, match="brotli"):
+        await batched_service.connect_producer(batched=True, compression_type="brotli")
+
+
+@pytest.mark.asyncio
+async def test_batched_send_returns_before_acknowledgement(batched_service):
+    await batched_service.connect_producer(batched=True, compression_type=None)
+    producer, = FakeProducer.instances
+
+    assert await batched_service.send_message(TOPIC, {"n": 1}, key="a")
+    assert await batched_service.send_batch(TOPIC, [{"n": 2}, {"n": 3}], keys=["b", "c"])
+    assert batched_service.producer_stats()["in_flight"] == 3
+
+    producer.acknowledge(0, partition=0)
+    producer.acknowledge(1, partition=1)
+    producer.acknowledge(2, partition=1)
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+    stats = batched_service.producer_stats()
+    assert (stats["in_flight"], stats["delivered"], stats["failed"]) == (0, 3, 0)
+    # Подтверждения одной итерации учитываются пакетами по партициям
+    assert stats["batches"] == 2 and stats["avg_batch_messages"] == 1.5
+
+
+@pytest.mark.asyncio
+async def test_in_flight_limit_blocks_until_acknowledged(batched_service):
+    await batched_service.connect_producer(batched=True, compression_type=None, max_in_flight=2)
+    producer, = FakeProducer.instances
+    await batched_service.send_message(TOPIC, {"n": 1})
+    await batched_service.send_message(TOPIC, {"n": 2})
+
+    third = asyncio.create_task(batched_service.send_message(TOPIC, {"n": 3}))
+    await asyncio.sleep(0.01)
+    assert not third.done() and len(producer.futures) == 2
+
+    producer.acknowledge(0)
+    assert await asyncio.wait_for(third, 1.0)
+    assert len(producer.futures) == 3
+
+
+@pytest.mark.asyncio
+async def test_failed_acknowledgement_is_counted(batched_service):
+    await batched_service.connect_producer(batched=True, compression_type=None)
+    producer, = FakeProducer.instances
+
+    confirmed = asyncio.create_task(batched_service.send_message(TOPIC, {"n": 1}, confirm=True))
+    await asyncio.sleep(0)
+    producer.futures[0][0].set_exception(KafkaError("broker is down"))
+
+    assert not await confirmed
+    await asyncio.sleep(0)
+    stats = batched_service.producer_stats()
+    assert (stats["delivered"], stats["failed"]) == (0, 1)
+    assert "broker is down" in stats["last_error"]
+
+
+@pytest.mark.asyncio
+async def test_disconnect_flushes_pending_messages(batched_service):
+    await batched_service.connect_producer(batched=True, compression_type=None)
+    producer, = FakeProducer.instances
+    await batched_service.send_batch(TOPIC, [{"n": 1}, {"n": 2}])
+
+    await batched_service.disconnect_producer(timeout=1.0)
+
+    assert producer.flushed and producer.stopped
+    assert batched_service.producer_stats()["delivered"] == 2
+
+
+class BatchedConsumer:
+    """Консьюмер, у которого getmany по очереди отдает заданные пакеты, затем пустые ответы."""
+
+    def __init__(self, service: KafkaService, batches):
+        self.service = service
+        self.batches = list(batches)
+        self.calls = []
+
+    async def getmany(self, *partitions, timeout_ms=0, max_records=None):
+        self.calls.append((timeout_ms, max_records))
+        await asyncio.sleep(0)
+        if not self.batches:
+            self.service.stop_consuming()
+            return {}
+        return {
+            TopicPartition(TOPIC, partition): [SimpleNamespace(value=value) for value in values]
+            for partition, values in self.batches.pop(0).items()
+        }
+
+
+@pytest.mark.asyncio
+async def test_consume_batches_passes_each_fetch_as_one_batch():
+    service = KafkaService()
+    consumer = BatchedConsumer(service, [{0: [1, 2], 1: [3]}, {}, {1: [4]}, {0: [5]}])
+    service.consumers[TOPIC] = consumer
+    batches = []
+
+    async def callback(messages):
+        batches.append(messages)
+        if messages == [4]:
+            raise ValueError("broken batch")
+
+    await asyncio.wait_for(service.consume_batches(TOPIC, callback, max_records=50, timeout_ms=20), 1.0)
+
+    # Пустой ответ callback не вызывает, ошибка пакета не останавливает чтение
+    assert batches == [[1, 2, 3], [4], [5]]
+    assert set(consumer.calls) == {(20, 50)}
+    assert not service.running
+
+
+class StreamingConsumer:
+    """Поток сообщений одной партиции с учетом pause/resume."""
+
+    def __init__(self, values):
+        self.values = list(values)
+        self.partition = TopicPartition(TOPIC, 0)
+        self.paused_partitions = set()
+        self.pauses = 0
+        self.fetched = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(0)
+        assert not self.paused_partitions, "fetched from a paused partition"
+        if not self.values:
+            raise StopAsyncIteration
+        self.fetched += 1
+        return SimpleNamespace(value=self.values.pop(0))
+
+    def assignment(self):
+        return {self.partition}
+
+    def pause(self, *partitions):
+        self.pauses += 1
+        self.paused_partitions.update(partitions)
+
+    def paused(self):
+        return set(self.paused_partitions)
+
+    def resume(self, *partitions):
+        self.paused_partitions.difference_update(partitions)
+
+
+@pytest.mark.asyncio
+async def test_full_queue_pauses_partitions_until_half_drained():
+    service = KafkaService()
+    consumer = StreamingConsumer(range(20))
+    service.consumers[TOPIC] = consumer
+    gate = asyncio.Event()
+    processed = []
+
+    async def callback(value):
+        await gate.wait()
+        processed.append(value)
+
+    task = asyncio.create_task(service.consume_messages(TOPIC, callback, max_concurrency=2, queue_size=4))
+    await wait_for(lambda: consumer.paused_partitions)
+
+    stats = service.consumer_stats()
+    assert stats["paused"] and stats["pauses"] == 1
+    assert (stats["queue_depth"], stats["queue_size"]) == (4, 4)
+    # В памяти не больше очереди и сообщений у воркеров
+    assert consumer.fetched - len(processed) <= 4 + 2 + 1
+
+    gate.set()
+    await asyncio.wait_for(task, 1.0)
+
+    assert sorted(processed) == list(range(20))
+    stats = service.consumer_stats()
+    assert not stats["paused"] and stats["pauses"] >= 1 and stats["paused_seconds"] > 0
+    assert consumer.paused_partitions == set()
+
+
+@pytest.mark.asyncio
+async def test_queued_messages_are_processed_before_stop():
+    service = KafkaService()
+    consumer = StreamingConsumer(range(6))
+    service.consumers[TOPIC] = consumer
+    processed = []
+
+    async def callback(value):
+        await asyncio.sleep(0.01)
+        if value == 2:
+            raise ValueError("broken message")
+        processed.append(value)
+
+    await asyncio.wait_for(service.consume_messages(TOPIC, callback, max_concurrency=1, queue_size=10), 1.0)
+
+    assert processed == [0, 1, 3, 4, 5]
+    assert service.consumer_stats()["pauses"] == 0
+    assert not service.running
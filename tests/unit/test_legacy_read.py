@@ -0,0 +1,55 @@
+"""Чтение ключей хеша v1 после перехода на v2 при нескольких шардах (fakeredis)."""
+import pytest
+
+from app.dedup_codec import DedupKeyCodec, hash_v1
+from app.deduplicator import Deduplicator
+
+SHARD_COUNT = 4
+
+
+@pytest.fixture
+def shards(make_shards):
+    return make_shards(SHARD_COUNT)
+
+
+def make_deduplicator(shards, codec: DedupKeyCodec) -> Deduplicator:
+    return Deduplicator(shards[0], shard_count=SHARD_COUNT, redis_pool=shards, codec=codec)
+
+
+@pytest.mark.asyncio
+async def test_v1_key_on_other_shard_is_duplicate_after_switch_to_v2(shards, make_event):
+    old = make_deduplicator(shards, DedupKeyCodec())
+    new = make_deduplicator(shards, DedupKeyCodec(legacy_read=True, hash_version=2))
+
+    # Событие, у которого хеши v1 и v2 выбирают разные шарды
+    event = next(
+        event for event in map(make_event, range(1000))
+        if old._get_shard_index(hash_v1(event)) != new._get_shard_index(new.calculate_hash(event))
+    )
+    assert not (await old.is_duplicate(event)).is_duplicate
+
+    result = await new.is_duplicate(event)
+    assert result.is_duplicate
+    assert result.original_timestamp is not None
+
+
+@pytest.mark.asyncio
+async def test_batch_with_mixed_shards_sees_only_old_events(shards, make_event):
+    old = make_deduplicator(shards, DedupKeyCodec())
+    new = make_deduplicator(shards, DedupKeyCodec(legacy_read=True, hash_version=2))
+
+    events = [make_event(index) for index in range(40)]
+    await old.is_duplicate_many(events[:20])
+
+    results = await new.is_duplicate_many(events)
+    assert [result.is_duplicate for result in results] == [True] * 20 + [False] * 20
+
+
+@pytest.mark.asyncio
+async def test_without_legacy_read_v1_keys_are_not_consulted(shards, make_event):
+    old = make_deduplicator(shards, DedupKeyCodec())
+    new = make_deduplicator(shards, DedupKeyCodec(hash_version=2))
+
+    event = make_event(1)
+    await old.is_duplicate(event)
+    assert not (await new.is_duplicate(event)).is_duplicate
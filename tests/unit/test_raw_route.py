@@ -0,0 +1,105 @@
+"""Маршрут /api/event/raw: проверка полей, ответы и исходные байты в Kafka (fakeredis)."""
+import orjson
+import pytest
+from starlette.requests import Request
+
+from app.api import events as events_api
+from app.deduplicator import Deduplicator
+from app.models import EventModel
+
+
+class RecordingKafka:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, topic, message, key=None, confirm=False):
+        self.sent.append((message, key))
+        return True
+
+
+class RecordingPostgres:
+    def __init__(self):
+        self.saved = []
+
+    async def save_event(self, event, event_hash):
+        self.saved.append((event, event_hash))
+        return True
+
+
+@pytest.fixture
+def services(monkeypatch, redis_client):
+    kafka, postgres, deduplicator = RecordingKafka(), RecordingPostgres(), Deduplicator(redis_client)
+    monkeypatch.setattr(events_api, "write_path_mode", "api")
+    monkeypatch.setattr(events_api, "kafka_service", kafka)
+    monkeypatch.setattr(events_api, "postgres_service", postgres)
+    monkeypatch.setattr(events_api, "deduplicator", deduplicator)
+    monkeypatch.setattr(events_api, "dedup_batcher", None)
+    return kafka, postgres, deduplicator
+
+
+async def post_raw(body: bytes):
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    request = Request({"type": "http", "method": "POST", "path": "/api/event/raw", "headers": []}, receive)
+    return await events_api.process_raw_event(request)
+
+
+@pytest.mark.asyncio
+async def test_new_event_is_forwarded_as_original_bytes(services, make_event):
+    kafka, postgres, deduplicator = services
+    event = make_event(extra_field=[1, 2])
+    body = orjson.dumps(event) + b"\n"
+
+    response = await post_raw(body)
+    await response.background()
+
+    event_hash = deduplicator.calculate_hash(event)
+    assert response.status_code == 200
+    assert orjson.loads(response.body) == {
+        "status": "accepted", "is_duplicate": False,
+        "message": "Event accepted for processing and storage", "event_hash": event_hash,
+    }
+    (message, key), = kafka.sent
+    assert isinstance(message, bytes) and key == event_hash
+    assert orjson.loads(message) == {**event, "_dedup_hash": event_hash}
+    assert postgres.saved == [(event, event_hash)]
+
+
+@pytest.mark.asyncio
+async def test_repeat_is_rejected_with_same_hash_as_model_route(services, make_event):
+    kafka, postgres, deduplicator = services
+    event = make_event()
+    model_response = await events_api.process_event(EventModel(**event), kafka, deduplicator, postgres)
+
+    response = await post_raw(orjson.dumps(event))
+
+    assert orjson.loads(response.body) == {
+        "status": "rejected", "is_duplicate": True,
+        "message": "Event is a duplicate", "event_hash": orjson.loads(model_response.body)["event_hash"],
+    }
+    assert response.background is None
+
+
+@pytest.mark.asyncio
+async def test_invalid_json_is_rejected(services):
+    response = await post_raw(b'{"client_id": ')
+
+    assert response.status_code == 422
+    assert orjson.loads(response.body) == {"detail": "Invalid JSON"}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("body", [
+    b'["client_id"]',
+    b'{"client_id": "c", "event_datetime": "d", "event_name": "e", "product_id": "p", "sid": "s"}',
+    b'{"client_id": 1, "event_datetime": "d", "event_name": "e", "product_id": "p", "sid": "s", "r": "r"}',
+])
+async def test_event_without_string_dedup_fields_is_rejected(services, body):
+    kafka, _, _ = services
+
+    response = await post_raw(body)
+
+    assert response.status_code == 422
+    assert "string fields" in orjson.loads(response.body)["detail"]
+    assert kafka.sent == []
@@ -0,0 +1,97 @@
+"""Режим Redis Cluster: подключение и метрики на поддельном кластерном клиенте."""
+import fakeredis.aioredis
+import pytest
+from redis.asyncio.cluster import ClusterNode
+
+from app.deduplicator import Deduplicator
+from app.services import redis_service as redis_service_module
+from app.services.redis_service import RedisService
+
+
+class FakeRedisCluster:
+    """Кластерный клиент без кластера: запоминает параметры, pipeline идут в fakeredis."""
+
+    instances = []
+
+    def __init__(self, startup_nodes, **options):
+        self.startup_nodes = startup_nodes
+        self.options = options
+        self.client = fakeredis.aioredis.FakeRedis()
+        self.nodes = [ClusterNode(node.host, node.port, server_type="primary") for node in startup_nodes]
+        self.pipelines = 0
+        self.initialized = False
+        FakeRedisCluster.instances.append(self)
+
+    async def initialize(self):
+        self.initialized = True
+
+    def get_primaries(self):
+        return self.nodes
+
+    def get_nodes(self):
+        return self.nodes
+
+    def pipeline(self, *args, **kwargs):
+        self.pipelines += 1
+        return self.client.pipeline(*args, **kwargs)
+
+
+@pytest.fixture
+def cluster_service(monkeypatch):
+    FakeRedisCluster.instances.clear()
+    monkeypatch.setattr(redis_service_module, "RedisCluster", FakeRedisCluster)
+    return RedisService()
+
+
+@pytest.mark.asyncio
+async def test_cluster_nodes_replace_standalone_shards(cluster_service):
+    await cluster_service.connect(
+        port=7000,
+        shard_count=4,
+        cluster_nodes=["node-a:7001", "node-b"],
+        cluster_retry_attempts=3,
+        pool_options={"max_connections": 8},
+    )
+
+    cluster, = FakeRedisCluster.instances
+    assert cluster.initialized
+    assert [(node.host, node.port) for node in cluster.startup_nodes] == [("node-a", 7001), ("node-b", 7000)]
+    assert cluster.options["cluster_error_retry_attempts"] == 3
+    assert cluster.options["max_connections"] == 8
+    assert cluster_service.cluster_mode
+    assert cluster_service.redis_pool == [cluster] and cluster_service.shard_count == 1
+    assert cluster_service.connection_pools == {}
+
+
+@pytest.mark.asyncio
+async def test_cluster_pool_stats_are_reported_per_node(cluster_service):
+    await cluster_service.connect(cluster_nodes=["node-a:7001", "node-b:7002"])
+
+    stats = cluster_service.pool_stats()
+
+    assert [node["endpoint"] for node in stats] == ["node-a:7001", "node-b:7002"]
+    assert all(node["in_use"] == 0 for node in stats)
+    assert cluster_service.get_connection_count() == 2
+
+
+@pytest.mark.asyncio
+async def test_reshard_is_rejected_in_cluster_mode(cluster_service):
+    with pytest.raises(ValueError, match="REDIS_RESHARD_FROM"):
+        await cluster_service.connect(cluster_nodes=["node-a:7001"], reshard_from="modulo:2")
+    assert FakeRedisCluster.instances == []
+
+
+@pytest.mark.asyncio
+async def test_batch_goes_to_cluster_in_one_pipeline(cluster_service, make_event):
+    await cluster_service.connect(cluster_nodes=["node-a:7001"])
+    cluster, = FakeRedisCluster.instances
+    deduplicator = Deduplicator(cluster_service.redis, shard_count=cluster_service.shard_count,
+                                redis_pool=cluster_service.redis_pool)
+    events = [make_event(index) for index in range(20)]
+
+    await deduplicator.is_duplicate_many(events)
+    results = await deduplicator.is_duplicate_many(events)
+
+    # Раскладку по слотам и узлам делает кластерный pipeline redis-py
+    assert cluster.pipelines == 2
+    assert all(result.is_duplicate for result in results)
@@ -0,0 +1,55 @@
+"""Метрики пулов соединений Redis: ожидание, отказы и узлы кластера."""
+import fakeredis
+import fakeredis.aioredis
+import pytest
+import redis.asyncio as redis
+from redis.asyncio.cluster import ClusterNode
+
+from app.services.redis_service import MeteredConnectionPool, cluster_node_stats
+
+
+@pytest.mark.asyncio
+async def test_pool_wait_timeout_is_not_a_connection_error():
+    pool = MeteredConnectionPool(
+        connection_class=fakeredis.aioredis.FakeAsyncRedisConnection,
+        server=fakeredis.FakeServer(),
+        max_connections=1,
+        timeout=0.05,
+    )
+    held = await pool.get_connection()
+    with pytest.raises(redis.ConnectionError):
+        await pool.get_connection()
+    await pool.release(held)
+
+    stats = pool.stats()
+    assert stats["timeouts"] == 1
+    assert stats["connection_errors"] == 0
+    assert stats["acquired"] == 1
+
+
+@pytest.mark.asyncio
+async def test_unreachable_redis_is_counted_as_connection_error():
+    # На порт 1 никто не слушает: соединение выдано пулом, но подключиться не удалось
+    pool = MeteredConnectionPool(host="127.0.0.1", port=1, max_connections=1, timeout=0.05,
+                                 socket_connect_timeout=0.5)
+    with pytest.raises(redis.ConnectionError):
+        await pool.get_connection()
+
+    stats = pool.stats()
+    assert stats["timeouts"] == 0
+    assert stats["connection_errors"] == 1
+    await pool.disconnect()
+
+
+def test_cluster_node_stats_reports_connections_in_use():
+    node = ClusterNode("127.0.0.1", 7000, server_type="primary", max_connections=2)
+    first = node.acquire_connection()
+    node.acquire_connection()
+    node.release(first)
+
+    stats = cluster_node_stats(node)
+    assert stats["endpoint"] == "127.0.0.1:7000"
+    assert (stats["in_use"], stats["idle"], stats["exhausted"]) == (1, 1, False)
+
+    node.acquire_connection()
+    assert cluster_node_stats(node)["exhausted"]
@@ -0,0 +1,166 @@
+"""Решардинг: чтение обеих раскладок и фоновый перенос ключей (fakeredis)."""
+import pytest
+
+from app.dedup_codec import DedupKeyCodec
+from app.dedup_storage import BucketStorage, KeyStorage
+from app.deduplicator import Deduplicator
+from app.reshard import ShardMigrator
+from app.sharding import ModuloRouter, ReshardRouter
+
+TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+@pytest.fixture
+def shards(make_shards):
+    # Разные адреса: мигратор не переносит ключи между шардами одного Redis
+    return make_shards(3)
+
+
+@pytest.fixture
+def events(make_event):
+    return [make_event(index) for index in range(60)]
+
+
+def make_deduplicator(shards, router, storage=None) -> Deduplicator:
+    codec = DedupKeyCodec()
+    return Deduplicator(shards[0], shard_count=router.shard_count, redis_pool=shards, codec=codec,
+                        storage=storage or KeyStorage(codec, TTL_SECONDS), router=router)
+
+
+def make_migrator(shards, codec=None, storage=None, **options) -> ShardMigrator:
+    codec = codec or DedupKeyCodec()
+    storage = storage or KeyStorage(codec, TTL_SECONDS)
+    router = ReshardRouter(ModuloRouter(3), ModuloRouter(2))
+    return ShardMigrator(shards, router, codec, storage.key_patterns(), **{"delete_grace": 0, **options})
+
+
+def test_reshard_router_reports_previous_shard_only_for_moved_hashes():
+    router = ReshardRouter(ModuloRouter(3), ModuloRouter(2))
+    hashes = [f"{index:064x}" for index in range(12)]
+
+    for event_hash in hashes:
+        assert router.shard(event_hash) == ModuloRouter(3).shard(event_hash)
+        previous = router.previous_shard(event_hash)
+        if ModuloRouter(2).shard(event_hash) == router.shard(event_hash):
+            assert previous is None
+        else:
+            assert previous == ModuloRouter(2).shard(event_hash)
+    assert router.name == "modulo:2->modulo:3"
+
+
+@pytest.mark.asyncio
+async def test_events_written_before_reshard_stay_duplicates(shards, events):
+    await make_deduplicator(shards[:2], ModuloRouter(2)).is_duplicate_many(events)
+
+    resharding = make_deduplicator(shards, ReshardRouter(ModuloRouter(3), ModuloRouter(2)))
+    assert all(result.is_duplicate for result in await resharding.is_duplicate_many(events))
+
+
+@pytest.mark.asyncio
+async def test_single_event_check_reads_previous_layout(shards, events):
+    await make_deduplicator(shards[:2], ModuloRouter(2)).is_duplicate_many(events)
+
+    resharding = make_deduplicator(shards, ReshardRouter(ModuloRouter(3), ModuloRouter(2)))
+    for event in events:
+        assert (await resharding.is_duplicate(event)).is_duplicate
+    assert not (await resharding.is_duplicate(events[0], "f" * 64)).is_duplicate
+
+
+@pytest.mark.asyncio
+async def test_migrator_moves_keys_to_new_layout(shards, events):
+    await make_deduplicator(shards[:2], ModuloRouter(2)).is_duplicate_many(events)
+
+    migrator = make_migrator(shards, batch_size=7)
+    await migrator.run()
+
+    assert migrator.finished and migrator.errors == 0
+    assert migrator.moved > 0
+    assert migrator.stats()["pending_deletes"] == 0
+    for shard, client in enumerate(shards):
+        async for key in client.scan_iter(match="event_dedup:*"):
+            assert migrator.router.shard(migrator.codec.key_hash(key)) == shard
+            assert await client.ttl(key) > 0
+    assert not await shards[0].exists(ShardMigrator.LOCK_KEY)
+
+    # После миграции достаточно новой раскладки
+    migrated = make_deduplicator(shards, ModuloRouter(3))
+    assert all(result.is_duplicate for result in await migrated.is_duplicate_many(events))
+
+
+@pytest.mark.asyncio
+async def test_migrator_moves_bucket_fields(shards, events):
+    codec = DedupKeyCodec("compact")
+    storage = BucketStorage(codec, TTL_SECONDS, prefix_chars=1)
+    await make_deduplicator(shards[:2], ModuloRouter(2), storage).is_duplicate_many(events)
+
+    migrator = make_migrator(shards, codec, storage)
+    await migrator.run()
+
+    assert migrator.moved > 0
+    for shard, client in enumerate(shards):
+        async for bucket in client.scan_iter(match=BucketStorage.PREFIX + "*"):
+            for field in await client.hkeys(bucket):
+                assert migrator.router.shard(field.hex()) == shard
+            assert await client.ttl(bucket) > 0
+
+    migrated = make_deduplicator(shards, ModuloRouter(3), storage)
+    assert all(result.is_duplicate for result in await migrated.is_duplicate_many(events))
+
+
+@pytest.mark.asyncio
+async def test_source_copies_are_kept_until_delete_grace_passes(shards, events, monkeypatch):
+    await make_deduplicator(shards[:2], ModuloRouter(2)).is_duplicate_many(events)
+    keys_before = [set(await client.keys("event_dedup:*")) for client in shards[:2]]
+
+    now = 1000.0
+    monkeypatch.setattr("app.reshard.time.monotonic", lambda: now)
+    migrator = make_migrator(shards, delete_grace=10)
+    await shards[0].set(ShardMigrator.LOCK_KEY, migrator.lock_owner)
+    for shard in range(2):
+        await migrator._migrate_shard(shard)
+    await migrator._delete_moved()
+
+    # Ключи уже в новой раскладке, но источники пока не тронуты: их читают проверки в полете
+    assert migrator.moved > 0
+    assert migrator.stats()["pending_deletes"] == migrator.moved
+    for client, keys in zip(shards, keys_before):
+        assert keys <= set(await client.keys("event_dedup:*"))
+
+    now += 10
+    await migrator._delete_moved()
+    assert migrator.stats()["pending_deletes"] == 0
+    for shard, client in enumerate(shards):
+        for key in await client.keys("event_dedup:*"):
+            assert migrator.router.shard(migrator.codec.key_hash(key)) == shard
+
+
+@pytest.mark.asyncio
+async def test_migrator_skips_when_another_worker_holds_the_lock(shards):
+    await shards[0].set(ShardMigrator.LOCK_KEY, "other-worker")
+    migrator = make_migrator(shards)
+
+    await migrator.run()
+
+    assert not migrator.finished
+    assert migrator.scanned == 0
+    assert await shards[0].get(ShardMigrator.LOCK_KEY) == b"other-worker"
+
+
+@pytest.mark.asyncio
+async def test_migrator_does_not_release_a_lock_taken_over_by_another_worker(shards, events):
+    await make_deduplicator(shards[:2], ModuloRouter(2)).is_duplicate_many(events)
+    migrator = make_migrator(shards, batch_size=7)
+
+    original_migrate_batch = migrator._migrate_batch
+
+    async def lose_lock(shard, keys):
+        # Блокировка истекла, и ее взял другой воркер
+        await shards[0].set(ShardMigrator.LOCK_KEY, "other-worker")
+        await original_migrate_batch(shard, keys)
+
+    migrator._migrate_batch = lose_lock
+    with pytest.raises(RuntimeError):
+        await migrator.run()
+
+    assert not migrator.finished
+    assert await shards[0].get(ShardMigrator.LOCK_KEY) == b"other-worker"
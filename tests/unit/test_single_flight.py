@@ -0,0 +1,128 @@
+"""Объединение одновременных проверок одного хеша (fakeredis)."""
+import asyncio
+
+import pytest
+
+from app.deduplicator import Deduplicator
+from app.single_flight import SingleFlight
+
+
+class CountingRedis:
+    """Считает pipeline, отправленные в Redis."""
+
+    def __init__(self, client):
+        self.client = client
+        self.pipelines = 0
+
+    def pipeline(self, *args, **kwargs):
+        self.pipelines += 1
+        return self.client.pipeline(*args, **kwargs)
+
+
+class GatedPipeline:
+    def __init__(self, pipe, gate: asyncio.Event):
+        self.pipe = pipe
+        self.gate = gate
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    async def execute(self, *args, **kwargs):
+        await self.gate.wait()
+        return await self.pipe.execute(*args, **kwargs)
+
+
+class GatedRedis:
+    """Pipeline ждут открытия gate: проверка висит в Redis, пока тест ее не отпустит."""
+
+    def __init__(self, client):
+        self.client = client
+        self.gate = asyncio.Event()
+
+    def pipeline(self, *args, **kwargs):
+        return GatedPipeline(self.client.pipeline(*args, **kwargs), self.gate)
+
+
+class BrokenRedis:
+    def pipeline(self, *args, **kwargs):
+        raise ConnectionError("Redis is down")
+
+
+@pytest.mark.asyncio
+async def test_concurrent_checks_of_one_event_make_one_redis_call(redis_client, make_event):
+    counting = CountingRedis(redis_client)
+    single_flight = SingleFlight()
+    deduplicator = Deduplicator(counting, single_flight=single_flight)
+    event = make_event()
+
+    results = await asyncio.gather(*(deduplicator.is_duplicate(event) for _ in range(10)))
+
+    assert counting.pipelines == 1
+    assert [result.is_duplicate for result in results].count(False) == 1
+    timestamps = {result.original_timestamp for result in results if result.is_duplicate}
+    assert len(timestamps) == 1 and None not in timestamps
+    assert single_flight.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 9, "abandoned": 0}
+
+
+@pytest.mark.asyncio
+async def test_repeats_inside_one_batch_are_coalesced(redis_client, make_event):
+    deduplicator = Deduplicator(redis_client, single_flight=SingleFlight())
+    event = make_event()
+
+    results = await deduplicator.is_duplicate_many([event, dict(event), dict(event)])
+
+    assert [result.is_duplicate for result in results] == [False, True, True]
+
+
+@pytest.mark.asyncio
+async def test_leader_failure_reaches_waiters_and_clears_the_slot(redis_client, make_event):
+    single_flight = SingleFlight()
+    deduplicator = Deduplicator(BrokenRedis(), single_flight=single_flight)
+    event = make_event()
+
+    results = await asyncio.gather(*(deduplicator.is_duplicate(event) for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert len(single_flight) == 0
+
+    # Следующая проверка снова идет в Redis, а не ждет упавшего ведущего
+    deduplicator.redis = redis_client
+    assert not (await deduplicator.is_duplicate(event)).is_duplicate
+
+
+@pytest.mark.asyncio
+async def test_cancelled_leader_does_not_cancel_waiters(redis_client, make_event):
+    gated = GatedRedis(redis_client)
+    single_flight = SingleFlight()
+    deduplicator = Deduplicator(gated, single_flight=single_flight)
+    event = make_event()
+
+    leader = asyncio.create_task(deduplicator.is_duplicate(event))
+    await asyncio.sleep(0)
+    followers = [asyncio.create_task(deduplicator.is_duplicate(event)) for _ in range(3)]
+    await asyncio.sleep(0)
+
+    # Клиент ведущего отключился, пока его проверка ждала Redis
+    leader.cancel()
+    await asyncio.sleep(0)
+    gated.gate.set()
+    results = await asyncio.gather(*followers)
+
+    assert leader.cancelled()
+    assert [result.is_duplicate for result in results].count(False) == 1
+    assert single_flight.stats()["abandoned"] == 1
+    assert len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_single_event_check_does_not_use_batch_path(redis_client, make_event, monkeypatch):
+    deduplicator = Deduplicator(redis_client, single_flight=SingleFlight())
+
+    async def batch_path(*args, **kwargs):
+        raise AssertionError("is_duplicate must not build a batch")
+
+    monkeypatch.setattr(deduplicator, "is_duplicate_many", batch_path)
+    event = make_event()
+
+    assert not (await deduplicator.is_duplicate(event)).is_duplicate
+    assert (await deduplicator.is_duplicate(event)).is_duplicate
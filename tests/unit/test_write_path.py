@@ -0,0 +1,124 @@
+"""Режим WRITE_PATH_MODE=consumer: событие не теряется при сбое отправки в Kafka (fakeredis)."""
+import orjson
+import pytest
+from starlette.requests import Request
+
+from app.api import events as events_api
+from app.deduplicator import Deduplicator
+from app.models import EventModel
+
+
+class FakeKafka:
+    def __init__(self, delivered: bool):
+        self.delivered = delivered
+        self.sent = []
+
+    async def send_batch(self, topic, messages, keys=None, confirm=False):
+        assert confirm
+        if self.delivered:
+            self.sent.extend(messages)
+        return self.delivered
+
+
+class FakePostgres:
+    def __init__(self, available: bool):
+        self.available = available
+        self.saved = []
+        self.rows = []
+
+    async def save_events_batch(self, events, event_hashes, raise_rejected=False):
+        if self.available:
+            self.saved.extend(event_hashes)
+            self.rows.extend(events)
+        return self.available
+
+
+@pytest.fixture
+def deduplicator(monkeypatch, redis_client):
+    monkeypatch.setattr(events_api, "write_path_mode", "consumer")
+    return Deduplicator(redis_client)
+
+
+@pytest.fixture
+def event(make_event):
+    return make_event()
+
+
+@pytest.fixture
+def post_event(event):
+    async def post(kafka, postgres, deduplicator):
+        return await events_api.process_event(EventModel(**event), kafka, deduplicator, postgres)
+    return post
+
+
+@pytest.fixture
+def post_raw_event(event, monkeypatch):
+    async def post(kafka, postgres, deduplicator):
+        monkeypatch.setattr(events_api, "kafka_service", kafka)
+        monkeypatch.setattr(events_api, "postgres_service", postgres)
+        monkeypatch.setattr(events_api, "deduplicator", deduplicator)
+        body = orjson.dumps(event)
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        request = Request({"type": "http", "method": "POST", "path": "/api/event/raw", "headers": []}, receive)
+        return await events_api.process_raw_event(request)
+    return post
+
+
+@pytest.mark.asyncio
+async def test_confirmed_publish_is_accepted(deduplicator, post_event):
+    kafka, postgres = FakeKafka(delivered=True), FakePostgres(available=True)
+
+    response = await post_event(kafka, postgres, deduplicator)
+
+    assert response.status_code == 200
+    assert len(kafka.sent) == 1 and not postgres.saved
+
+
+@pytest.mark.asyncio
+async def test_failed_publish_falls_back_to_postgres(deduplicator, post_event, event):
+    kafka, postgres = FakeKafka(delivered=False), FakePostgres(available=True)
+
+    response = await post_event(kafka, postgres, deduplicator)
+
+    assert response.status_code == 200
+    assert postgres.saved == [deduplicator.calculate_hash(event)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("route", ["post_event", "post_raw_event"])
+async def test_fallback_rows_match_consumer_rows(deduplicator, event, route, request):
+    post = request.getfixturevalue(route)
+    kafka, postgres = FakeKafka(delivered=False), FakePostgres(available=True)
+
+    response = await post(kafka, postgres, deduplicator)
+
+    # Консьюмер снимает _dedup_hash перед записью: прямая запись API должна давать ту же строку
+    assert response.status_code == 200
+    assert postgres.rows == [event]
+
+
+@pytest.mark.asyncio
+async def test_published_message_carries_dedup_hash(deduplicator, post_event, event):
+    kafka, postgres = FakeKafka(delivered=True), FakePostgres(available=True)
+
+    await post_event(kafka, postgres, deduplicator)
+
+    assert kafka.sent == [{**event, "_dedup_hash": deduplicator.calculate_hash(event)}]
+
+
+@pytest.mark.asyncio
+async def test_failed_store_releases_dedup_record_and_asks_for_retry(deduplicator, post_event):
+    kafka, postgres = FakeKafka(delivered=False), FakePostgres(available=False)
+
+    response = await post_event(kafka, postgres, deduplicator)
+    assert response.status_code == 503
+    assert orjson.loads(response.body)["status"] == "error"
+
+    kafka.delivered = True
+    retry = await post_event(kafka, postgres, deduplicator)
+    assert retry.status_code == 200
+    assert orjson.loads(retry.body)["is_duplicate"] is False
+    assert len(kafka.sent) == 1